@@ -1,3 +1,6 @@
+from balancer import exception
+
+
 def http_success_code(code):
     """Attaches response code to a method.
 
@@ -10,3 +13,27 @@ def http_success_code(code):
         func.wsgi_code = code
         return func
     return decorator
+
+
+def get_list_params(req):
+    """Extract pagination, sorting and filtering options of a listing.
+
+    marker, limit, sort_key and sort_dir are returned as keyword arguments,
+    the rest of the query string goes to filters.
+    """
+    filters = dict(req.GET.items())
+    params = {}
+    for key in ('marker', 'sort_key', 'sort_dir'):
+        if key in filters:
+            params[key] = filters.pop(key)
+    if 'limit' in filters:
+        limit = filters.pop('limit')
+        try:
+            params['limit'] = int(limit)
+        except ValueError:
+            raise exception.InvalidLimit(limit=limit)
+        if params['limit'] < 0:
+            raise exception.InvalidLimit(limit=limit)
+    if filters:
+        params['filters'] = filters
+    return params
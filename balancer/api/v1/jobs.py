@@ -0,0 +1,42 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import logging
+
+from openstack.common import wsgi
+
+from balancer.db import api as db_api
+
+LOG = logging.getLogger(__name__)
+
+
+class Controller(object):
+
+    def __init__(self, conf):
+        LOG.debug("Creating jobs controller with config:"
+                                                "jobs.py %s", conf)
+        self.conf = conf
+
+    def show(self, req, id):
+        LOG.debug("Got showJob request. Request: %s", req)
+        return {'job': db_api.job_get(self.conf, id).to_dict()}
+
+
+def create_resource(conf):
+    """Jobs resource factory method"""
+    deserializer = wsgi.JSONRequestDeserializer()
+    serializer = wsgi.JSONResponseSerializer()
+    return wsgi.Resource(Controller(conf), deserializer, serializer)
@@ -44,7 +44,15 @@ class Controller(object):
     def index(self, req):
         LOG.debug("Got index request. Request: %s", req)
         tenant_id = req.headers.get('X-Tenant-Id', "")
-        result = core_api.lb_get_index(self.conf, tenant_id)
+        result = core_api.lb_get_index(self.conf, tenant_id,
+                                       **utils.get_list_params(req))
+        return {'loadbalancers': result}
+
+    def detail(self, req):
+        LOG.debug("Got detail request. Request: %s", req)
+        tenant_id = req.headers.get('X-Tenant-Id', "")
+        lb_ids = req.GET.getall('id') or None
+        result = core_api.lb_get_index_details(self.conf, tenant_id, lb_ids)
         return {'loadbalancers': result}
 
     @utils.http_success_code(202)
@@ -56,13 +64,15 @@ class Controller(object):
         # We need to create LB object and return its id
         tenant_id = req.headers.get('X-Tenant-Id', "")
         params['tenant_id'] = tenant_id
-        lb_id = core_api.create_lb(self.conf, params)
-        return {'loadbalancer': {'id': lb_id}}
+        job = core_api.create_lb(self.conf, params)
+        return {'loadbalancer': {'id': job['lb_id']},
+                'job': {'id': job['id']}}
 
-    @utils.http_success_code(204)
+    @utils.http_success_code(202)
     def delete(self, req, id):
         LOG.debug("Got delete request. Request: %s", req)
-        core_api.delete_lb(self.conf, id)
+        job = core_api.delete_lb(self.conf, id)
+        return {'job': {'id': job['id']}}
 
     def show(self, req, id):
         LOG.debug("Got loadbalancerr info request. Request: %s", req)
@@ -77,8 +87,8 @@ class Controller(object):
     @utils.http_success_code(202)
     def update(self, req, id, body):
         LOG.debug("Got update request. Request: %s", req)
-        core_api.update_lb(self.conf, id, body)
-        return {'loadbalancer': {'id': id}}
+        job = core_api.update_lb(self.conf, id, body)
+        return {'loadbalancer': {'id': id}, 'job': {'id': job['id']}}
 
 
 def create_resource(conf):
@@ -40,7 +40,8 @@ class Controller(object):
 
     def index(self, req, lb_id):
         LOG.debug("Got showNodes request. Request: %s", req)
-        return {'nodes': core_api.lb_show_nodes(self.conf, lb_id)}
+        return {'nodes': core_api.lb_show_nodes(self.conf, lb_id,
+            **utils.get_list_params(req))}
 
     def show(self, req, lb_id, id):
         LOG.debug("Got showNode request. Request: %s", req)
@@ -52,6 +53,12 @@ class Controller(object):
         LOG.debug("Got deleteNode request. Request: %s", req)
         core_api.lb_delete_node(self.conf, lb_id, id)
 
+    @utils.http_success_code(204)
+    def deleteNodes(self, req, lb_id, body):
+        LOG.debug("Got deleteNodes request. Request: %s", req)
+        core_api.lb_delete_nodes(self.conf, lb_id,
+            [node['id'] for node in body['nodes']])
+
     def changeNodeStatus(self, req, lb_id, id, status, body):
         LOG.debug("Got changeNodeStatus request. Request: %s", req)
         result = core_api.lb_change_node_status(self.conf, lb_id, id,
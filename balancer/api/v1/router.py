@@ -25,6 +25,7 @@ from . import nodes
 from . import vips
 from . import probes
 from . import stickies
+from . import jobs
 #from . import tasks
 
 
@@ -57,6 +58,10 @@ class API(wsgi.Router):
                        controller=lb_resource,
                        action="findLBforVM", conditions={'method': ["GET"]})
 
+        mapper.connect("/loadbalancers/{lb_id}/nodes",
+                       controller=nd_resource, action="deleteNodes",
+                       conditions={'method': ["DELETE"]})
+
         mapper.connect("/loadbalancers/{lb_id}/nodes/{id}/{status}",
                        controller=nd_resource, action="changeNodeStatus",
                        conditions={'method': ["PUT"]})
@@ -100,6 +105,11 @@ class API(wsgi.Router):
                        controller=device_resource,
                        action="show_protocols",
                        conditions={'method': ["GET"]})
+
+        jobs_resource = jobs.create_resource(self.conf)
+        mapper.connect("/jobs/{id}", controller=jobs_resource,
+                       action="show", conditions={'method': ["GET"]})
+
        # TODO(yorik-sar): tasks are broken, there is no processing anymore
         #tasks_resource = tasks.create_resource(self.conf)
         #mapper.resource("tasks", "tasks", controller=tasks_resource,
@@ -142,13 +142,15 @@ class Server(object):
         self.children = []
         self.running = True
 
-    def start(self, application, conf, default_port):
+    def start(self, application, conf, default_port, on_start=None):
         """
         Run a WSGI server with the given application.
 
         :param application: The application to run in the WSGI server
         :param conf: a cfg.ConfigOpts object
         :param default_port: Port to bind to if none is specified in conf
+        :param on_start: Callable run by every serving process once it is
+                         started, i.e. after the fork when there are workers
         """
         def kill_children(*args):
             """Kills the entire process group."""
@@ -166,6 +168,7 @@ class Server(object):
             self.running = False
 
         self.application = application
+        self.on_start = on_start
         self.sock = get_socket(conf, default_port)
         conf.register_opt(workers_opt)
 
@@ -175,6 +178,8 @@ class Server(object):
             # Useful for profiling, test, debug etc.
             self.pool = eventlet.GreenPool(size=self.threads)
             self.pool.spawn_n(self._single_run, application, self.sock)
+            if self.on_start is not None:
+                self.on_start()
             return
 
         self.logger.info(_("Starting %d workers") % conf.workers)
@@ -230,6 +235,8 @@ class Server(object):
         eventlet.hubs.use_hub('poll')
         eventlet.patcher.monkey_patch(all=False, socket=True)
         self.pool = eventlet.GreenPool(size=self.threads)
+        if self.on_start is not None:
+            self.on_start()
         try:
             eventlet.wsgi.server(self.sock, self.application,
                     log=WritableLogger(self.logger), custom_pool=self.pool)
@@ -16,35 +16,25 @@
 #    under the License.
 
 import logging
-import functools
-import eventlet
 import copy
 
-from openstack.common import exception
 import balancer.exception as exc
 
 from balancer.core import commands
+from balancer.core import jobs
 from balancer.core import lb_status
 from balancer.core import scheduler
 from balancer import drivers
 from balancer.db import api as db_api
+from balancer.db import session as db_session
 
 
 logger = logging.getLogger(__name__)
 
 
-def asynchronous(func):
-    @functools.wraps(func)
-    def _inner(*args, **kwargs):
-        if kwargs.pop('async', True):
-            eventlet.spawn(func, *args, **kwargs)
-        else:
-            return func(*args, **kwargs)
-    return _inner
-
-
-def lb_get_index(conf, tenant_id=''):
-    lbs = db_api.loadbalancer_get_all_by_project(conf, tenant_id)
+def lb_get_index(conf, tenant_id='', **list_params):
+    lbs = db_api.loadbalancer_get_all_by_project(conf, tenant_id,
+                                                 **list_params)
     lbs = [db_api.unpack_extra(lb) for lb in lbs]
 
     for lb in lbs:
@@ -69,93 +59,153 @@ def lb_get_data(conf, lb_id):
     return lb_dict
 
 
-def lb_show_details(conf, lb_id):
-    lb = db_api.loadbalancer_get(conf, lb_id)
-    sf = db_api.serverfarm_get_all_by_lb_id(conf, lb_id)[0]
-    vips = db_api.virtualserver_get_all_by_sf_id(conf, sf['id'])
-    rs = db_api.server_get_all_by_sf_id(conf, sf['id'])
-    probes = db_api.probe_get_all_by_sf_id(conf, sf['id'])
-    stickies = db_api.sticky_get_all_by_sf_id(conf, sf['id'])
-
+def _lb_details(lb):
+    sf = lb['serverfarms'][0]
     lb_ref = db_api.unpack_extra(lb)
-    lb_ref['nodes'] = [db_api.unpack_extra(rserver) for rserver in rs]
-    lb_ref['virtualIps'] = [db_api.unpack_extra(vip) for vip in vips]
-    lb_ref['healthMonitor'] = [db_api.unpack_extra(probe) for probe in probes]
-    lb_ref['sessionPersistence'] = [db_api.unpack_extra(sticky)\
-            for sticky in stickies]
+    lb_ref['nodes'] = [db_api.unpack_extra(rserver)
+                       for rserver in sf['servers']]
+    lb_ref['virtualIps'] = [db_api.unpack_extra(vip)
+                            for vip in sf['virtualservers']]
+    lb_ref['healthMonitor'] = [db_api.unpack_extra(probe)
+                               for probe in sf['probes']]
+    lb_ref['sessionPersistence'] = [db_api.unpack_extra(sticky)
+                                    for sticky in sf['stickies']]
     return lb_ref
 
 
+def lb_show_details(conf, lb_id):
+    return _lb_details(db_api.loadbalancer_get_details(conf, lb_id))
+
+
+def lb_get_index_details(conf, tenant_id='', lb_ids=None):
+    lbs = db_api.loadbalancer_get_all_details(conf, tenant_id, lb_ids)
+    return [_lb_details(lb) for lb in lbs if lb['serverfarms']]
+
+
 def create_lb(conf, params):
     nodes = params.pop('nodes', [])
     probes = params.pop('healthMonitor', [])
     vips = params.pop('virtualIps', [])
     values = db_api.loadbalancer_pack_extra(params)
-    lb_ref = db_api.loadbalancer_create(conf, values)
-    device = scheduler.schedule_loadbalancer(conf, lb_ref)
-    device_driver = drivers.get_device_driver(conf, device['id'])
-    lb = db_api.unpack_extra(lb_ref)
-    lb['device_id'] = device['id']
-    lb_ref = db_api.loadbalancer_pack_extra(lb)
+    values['status'] = lb_status.BUILD
+    # NOTE: the job is submitted after the commit, a worker must not see
+    #       the load balancer before it is stored.
+    with db_session.transaction(conf):
+        lb_ref = db_api.loadbalancer_create(conf, values)
+        device = scheduler.schedule_loadbalancer(conf, lb_ref)
+        db_api.loadbalancer_update(conf, lb_ref['id'],
+                                   {'device_id': device['id']})
     try:
+        return jobs.submit(conf, 'create_lb', lb_ref['id'], device['type'],
+                           {'nodes': nodes,
+                            'healthMonitor': probes,
+                            'virtualIps': vips})
+    except exc.JobQueueFull:
+        # the job is marked failed by submit, the load balancer would
+        # otherwise stay in BUILD forever
+        db_api.loadbalancer_update(conf, lb_ref['id'],
+                                   {'status': lb_status.ERROR,
+                                    'deployed': 'False'})
+        raise
+
+
+# NOTE: no transaction is held across request_context(), on SQLite it
+#       would keep the database locked during the device calls and block
+#       every other writer.  Rows are committed before the device is
+#       touched and the outcome is recorded afterwards.
+
+
+@jobs.handler('create_lb')
+def run_create_lb(conf, lb_id, params):
+    try:
+        lb_ref = db_api.loadbalancer_get(conf, lb_id)
+        device_driver = drivers.get_device_driver(conf, lb_ref['device_id'])
         with device_driver.request_context() as ctx:
-            commands.create_loadbalancer(ctx, lb_ref, nodes, probes, vips)
-
-    except (exception.Error, exception.Invalid):
-        lb_ref.status = lb_status.ERROR
-        lb_ref.deployed = 'False'
-    else:
-        lb_ref.status = lb_status.ACTIVE
-        lb_ref.deployed = 'True'
-    db_api.loadbalancer_update(conf, lb['id'], lb_ref)
-    return lb_ref['id']
+            commands.create_loadbalancer(ctx, lb_ref, params['nodes'],
+                                         params['healthMonitor'],
+                                         params['virtualIps'])
+    except Exception:
+        db_api.loadbalancer_update(conf, lb_id,
+                                   {'status': lb_status.ERROR,
+                                    'deployed': 'False'})
+        raise
+    db_api.loadbalancer_update(conf, lb_id, {'status': lb_status.ACTIVE,
+                                             'deployed': 'True'})
+    scheduler.lb_status_changed(lb_ref['device_id'], lb_status.BUILD,
+                                lb_status.ACTIVE)
 
 
-@asynchronous
 def update_lb(conf, lb_id, lb_body):
     lb_ref = db_api.loadbalancer_get(conf, lb_id)
-    old_lb_ref = copy.deepcopy(lb_ref)
-    db_api.pack_update(lb_ref, lb_body)
-    new_lb_ref = db_api.loadbalancer_update(conf, lb_id, lb_ref)
-    device_driver = drivers.get_device_driver(conf, lb_ref['device_id'])
-    with device_driver.request_context() as ctx:
-        try:
+    device = db_api.device_get(conf, lb_ref['device_id'])
+    return jobs.submit(conf, 'update_lb', lb_id, device['type'], lb_body)
+
+
+@jobs.handler('update_lb')
+def run_update_lb(conf, lb_id, lb_body):
+    old_lb_ref = None
+    try:
+        with db_session.transaction(conf):
+            lb_ref = db_api.loadbalancer_get(conf, lb_id)
+            old_lb_ref = copy.deepcopy(lb_ref)
+            db_api.pack_update(lb_ref, lb_body)
+            new_lb_ref = db_api.loadbalancer_update(conf, lb_id, lb_ref)
+        device_driver = drivers.get_device_driver(conf, lb_ref['device_id'])
+        with device_driver.request_context() as ctx:
             commands.update_loadbalancer(ctx, old_lb_ref, new_lb_ref)
-        except Exception:
-            db_api.loadbalancer_update(conf, lb_id,
-                                       {'status': lb_status.ERROR})
-            raise
-    db_api.loadbalancer_update(conf, lb_id,
-                               {'status': lb_status.ACTIVE})
+    except Exception:
+        db_api.loadbalancer_update(conf, lb_id, {'status': lb_status.ERROR})
+        if old_lb_ref is not None:
+            scheduler.lb_status_changed(old_lb_ref['device_id'],
+                                        old_lb_ref['status'],
+                                        lb_status.ERROR)
+        raise
+    db_api.loadbalancer_update(conf, lb_id, {'status': lb_status.ACTIVE})
+    scheduler.lb_status_changed(old_lb_ref['device_id'],
+                                old_lb_ref['status'], lb_status.ACTIVE)
 
 
 def delete_lb(conf, lb_id):
+    lb_ref = db_api.loadbalancer_get(conf, lb_id)
+    device = db_api.device_get(conf, lb_ref['device_id'])
+    return jobs.submit(conf, 'delete_lb', lb_id, device['type'])
+
+
+@jobs.handler('delete_lb')
+def run_delete_lb(conf, lb_id, params):
     lb = db_api.loadbalancer_get(conf, lb_id)
     device_driver = drivers.get_device_driver(conf, lb['device_id'])
     with device_driver.request_context() as ctx:
         commands.delete_loadbalancer(ctx, lb)
+    scheduler.lb_status_changed(lb['device_id'], lb['status'], None)
 
 
 def lb_add_nodes(conf, lb_id, nodes):
-    nodes_list = []
-    lb = db_api.loadbalancer_get(conf, lb_id)
-    sf = db_api.serverfarm_get_all_by_lb_id(conf, lb_id)[0]
-    for node in nodes:
-        values = db_api.server_pack_extra(node)
-        values['sf_id'] = sf['id']
-        rs_ref = db_api.server_create(conf, values)
-        device_driver = drivers.get_device_driver(conf, lb['device_id'])
+    with db_session.transaction(conf):
+        lb = db_api.loadbalancer_get(conf, lb_id)
+        sf = db_api.serverfarm_get_all_by_lb_id(conf, lb_id)[0]
+        values_list = []
+        for node in nodes:
+            values = db_api.server_pack_extra(node)
+            values['sf_id'] = sf['id']
+            values_list.append(values)
+        rs_refs = db_api.server_create_many(conf, values_list)
+    device_driver = drivers.get_device_driver(conf, lb['device_id'])
+    try:
         with device_driver.request_context() as ctx:
-            commands.add_node_to_loadbalancer(ctx, sf, rs_ref)
-        nodes_list.append(db_api.unpack_extra(rs_ref))
-    return nodes_list
+            commands.add_nodes_to_loadbalancer(ctx, sf, rs_refs)
+    except Exception:
+        db_api.server_destroy_many(conf, [rs['id'] for rs in rs_refs])
+        raise
+    return map(db_api.unpack_extra, rs_refs)
 
 
-def lb_show_nodes(conf, lb_id):
+def lb_show_nodes(conf, lb_id, **list_params):
     node_list = []
     sf = db_api.serverfarm_get_all_by_lb_id(conf, lb_id)[0]
     node_list = map(db_api.unpack_extra,
-                    db_api.server_get_all_by_sf_id(conf, sf['id']))
+                    db_api.server_get_all_by_sf_id(conf, sf['id'],
+                                                   **list_params))
     return node_list
 
 
@@ -163,13 +213,25 @@ def lb_delete_node(conf, lb_id, lb_node_id):
     lb = db_api.loadbalancer_get(conf, lb_id)
     sf = db_api.serverfarm_get_all_by_lb_id(conf, lb_id)[0]
     rs = db_api.server_get(conf, lb_node_id)
-    db_api.server_destroy(conf, lb_node_id)
     device_driver = drivers.get_device_driver(conf, lb['device_id'])
     with device_driver.request_context() as ctx:
         commands.remove_node_from_loadbalancer(ctx, sf, rs)
+    db_api.server_destroy(conf, lb_node_id)
     return lb_node_id
 
 
+def lb_delete_nodes(conf, lb_id, lb_node_ids):
+    lb = db_api.loadbalancer_get(conf, lb_id)
+    sf = db_api.serverfarm_get_all_by_lb_id(conf, lb_id)[0]
+    rss = [db_api.server_get(conf, lb_node_id, lb_id)
+           for lb_node_id in lb_node_ids]
+    device_driver = drivers.get_device_driver(conf, lb['device_id'])
+    with device_driver.request_context() as ctx:
+        commands.remove_nodes_from_loadbalancer(ctx, sf, rss)
+    db_api.server_destroy_many(conf, [rs['id'] for rs in rss])
+    return lb_node_ids
+
+
 def lb_change_node_status(conf, lb_id, lb_node_id, lb_node_status):
     lb = db_api.loadbalancer_get(conf, lb_id)
     rs = db_api.server_get(conf, lb_node_id)
@@ -244,8 +306,12 @@ def lb_add_probe(conf, lb_id, probe_dict):
     values['sf_id'] = sf_ref['id']
     probe_ref = db_api.probe_create(conf, values)
     device_driver = drivers.get_device_driver(conf, lb_ref['device_id'])
-    with device_driver.request_context() as ctx:
-        commands.add_probe_to_loadbalancer(ctx, sf_ref, probe_ref)
+    try:
+        with device_driver.request_context() as ctx:
+            commands.add_probe_to_loadbalancer(ctx, sf_ref, probe_ref)
+    except Exception:
+        db_api.probe_destroy(conf, probe_ref['id'])
+        raise
     return db_api.unpack_extra(probe_ref)
 
 
@@ -253,10 +319,10 @@ def lb_delete_probe(conf, lb_id, probe_id):
     lb = db_api.loadbalancer_get(conf, lb_id)
     sf = db_api.serverfarm_get_all_by_lb_id(conf, lb_id)[0]
     probe = db_api.probe_get(conf, probe_id)
-    db_api.probe_destroy(conf, probe_id)
     device_driver = drivers.get_device_driver(conf, lb['device_id'])
     with device_driver.request_context() as ctx:
         commands.remove_probe_from_loadbalancer(ctx, sf, probe)
+    db_api.probe_destroy(conf, probe_id)
     return probe_id
 
 
@@ -286,8 +352,12 @@ def lb_add_sticky(conf, lb_id, st):
     values['sf_id'] = sf['id']
     sticky_ref = db_api.sticky_create(conf, values)
     device_driver = drivers.get_device_driver(conf, lb['device_id'])
-    with device_driver.request_context() as ctx:
-        commands.add_sticky_to_loadbalancer(ctx, lb, sticky_ref)
+    try:
+        with device_driver.request_context() as ctx:
+            commands.add_sticky_to_loadbalancer(ctx, lb, sticky_ref)
+    except Exception:
+        db_api.sticky_destroy(conf, sticky_ref['id'])
+        raise
     return db_api.unpack_extra(sticky_ref)
 
 
@@ -317,8 +387,12 @@ def lb_add_vip(conf, lb_id, vip_dict):
     values['sf_id'] = sf_ref['id']
     vip_ref = db_api.virtualserver_create(conf, values)
     device_driver = drivers.get_device_driver(conf, lb_ref['device_id'])
-    with device_driver.request_context() as ctx:
-        commands.create_vip(ctx, vip_ref, sf_ref)
+    try:
+        with device_driver.request_context() as ctx:
+            commands.create_vip(ctx, vip_ref, sf_ref)
+    except Exception:
+        db_api.virtualserver_destroy(conf, vip_ref['id'])
+        raise
     return db_api.unpack_extra(vip_ref)
 
 
@@ -342,6 +416,7 @@ def device_get_index(conf):
 def device_create(conf, **params):
     device_dict = db_api.device_pack_extra(params)
     device = db_api.device_create(conf, device_dict)
+    scheduler.invalidate()
     return device
 
 
@@ -376,9 +451,21 @@ def device_show_protocols(conf):
     return protocols
 
 
+def device_update(conf, device_id, **params):
+    with db_session.transaction(conf):
+        values = dict(db_api.device_get(conf, device_id).iteritems())
+        db_api.pack_update(values, params)
+        device_ref = db_api.device_update(conf, device_id, values)
+    drivers.invalidate_device_driver(device_id)
+    scheduler.invalidate()
+    return device_ref
+
+
 # NOTE(ash): unused func
 def device_delete(conf, device_id):
     db_api.device_destroy(conf, device_id)
+    drivers.device_deleted(device_id)
+    scheduler.invalidate()
 
 #    sc = ServiceController.Instance(conf)
 #    sched = sc.scheduller
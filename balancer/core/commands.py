@@ -116,6 +116,23 @@ def create_rserver(ctx, rs):
         raise
 
 
+@with_rollback
+def create_rservers(ctx, rservers):
+    created = []
+    try:
+        for rs in rservers:
+            if not rs['parent_id']:
+                ctx.device.create_real_server(rs)
+                created.append(rs)
+        db_api.server_update_many(ctx.conf, created, {'deployed': 'True'})
+        yield
+    except Exception:
+        for rs in created:
+            ctx.device.delete_real_server(rs)
+        db_api.server_update_many(ctx.conf, created, {'deployed': 'False'})
+        raise
+
+
 @ignore_exceptions
 def delete_rserver(ctx, rs):
     rss = []
@@ -183,6 +200,24 @@ def delete_rserver_from_server_farm(ctx, server_farm, rserver):
     ctx.device.delete_real_server_from_server_farm(server_farm, rserver)
 
 
+@with_rollback
+def add_rservers_to_server_farm(ctx, server_farm, rservers):
+    try:
+        for rserver in rservers:
+            if (rserver.get('parent_id') and rserver['parent_id'] != ""):
+                rserver['name'] = rserver['parent_id']
+        ctx.device.add_real_servers_to_server_farm(server_farm, rservers)
+        yield
+    except Exception:
+        ctx.device.delete_real_servers_from_server_farm(server_farm, rservers)
+        raise
+
+
+@ignore_exceptions
+def delete_rservers_from_server_farm(ctx, server_farm, rservers):
+    ctx.device.delete_real_servers_from_server_farm(server_farm, rservers)
+
+
 @ignore_exceptions
 def delete_probe(ctx, probe):
     ctx.device.delete_probe(probe)
@@ -201,6 +236,21 @@ def create_probe(ctx, probe):
         raise
 
 
+@with_rollback
+def create_probes(ctx, probes):
+    created = []
+    try:
+        for probe in probes:
+            ctx.device.create_probe(probe)
+            created.append(probe)
+        db_api.probe_update_many(ctx.conf, created, {'deployed': True})
+        yield
+    except Exception:
+        for probe in created:
+            delete_probe(ctx, probe)
+        raise
+
+
 @with_rollback
 def add_probe_to_server_farm(ctx, server_farm, probe):
     try:
@@ -242,6 +292,21 @@ def create_vip(ctx, vip, server_farm):
         raise
 
 
+@with_rollback
+def create_vips(ctx, vips, server_farm):
+    created = []
+    try:
+        for vip in vips:
+            ctx.device.create_virtual_ip(vip, server_farm)
+            created.append(vip)
+        db_api.virtualserver_update_many(ctx.conf, created, {'deployed': True})
+        yield
+    except Exception:
+        for vip in created:
+            delete_vip(ctx, vip)
+        raise
+
+
 def create_loadbalancer(ctx, balancer, nodes, probes, vips):
     lb = db_api.unpack_extra(balancer)
     sf = db_api.serverfarm_create(ctx.conf, {'lb_id': lb['id']})
@@ -251,27 +316,38 @@ def create_loadbalancer(ctx, balancer, nodes, probes, vips):
         predictor_params = {'sf_id': sf['id']}
     db_api.predictor_create(ctx.conf, predictor_params)
     create_server_farm(ctx, sf)
+    node_values_list = []
     for node in nodes:
         node_values = db_api.server_pack_extra(node)
         node_values['sf_id'] = sf['id']
-        rs_ref = db_api.server_create(ctx.conf, node_values)
-        create_rserver(ctx, rs_ref)
-        add_rserver_to_server_farm(ctx, sf, rs_ref)
+        node_values_list.append(node_values)
+    if node_values_list:
+        rs_refs = db_api.server_create_many(ctx.conf, node_values_list)
+        create_rservers(ctx, rs_refs)
+        add_rservers_to_server_farm(ctx, sf, rs_refs)
 
+    probe_values_list = []
     for probe in probes:
         probe_values = db_api.probe_pack_extra(probe)
         probe_values['lb_id'] = lb['id']
         probe_values['sf_id'] = sf['id']
-        probe_ref = db_api.probe_create(ctx.conf, probe_values)
-        create_probe(ctx,  probe_ref)
-        add_probe_to_server_farm(ctx, sf, probe_ref)
-
+        probe_values_list.append(probe_values)
+    if probe_values_list:
+        probe_refs = db_api.probe_create_many(ctx.conf, probe_values_list)
+        create_probes(ctx, probe_refs)
+        for probe_ref in probe_refs:
+            add_probe_to_server_farm(ctx, sf, probe_ref)
+
+    vip_values_list = []
     for vip in vips:
         vip_values = db_api.virtualserver_pack_extra(vip)
         vip_values['lb_id'] = lb['id']
         vip_values['sf_id'] = sf['id']
-        vip_ref = db_api.virtualserver_create(ctx.conf, vip_values)
-        create_vip(ctx, vip_ref, sf)
+        vip_values_list.append(vip_values)
+    if vip_values_list:
+        vip_refs = db_api.virtualserver_create_many(ctx.conf,
+                                                    vip_values_list)
+        create_vips(ctx, vip_refs, sf)
 
 
 def delete_loadbalancer(ctx, lb):
@@ -317,6 +393,17 @@ def remove_node_from_loadbalancer(ctx, sf, rserver):
     delete_rserver(ctx, rserver)
 
 
+def add_nodes_to_loadbalancer(ctx, sf, rservers):
+    create_rservers(ctx, rservers)
+    add_rservers_to_server_farm(ctx, sf, rservers)
+
+
+def remove_nodes_from_loadbalancer(ctx, sf, rservers):
+    delete_rservers_from_server_farm(ctx, sf, rservers)
+    for rserver in rservers:
+        delete_rserver(ctx, rserver)
+
+
 def add_probe_to_loadbalancer(ctx, sf_ref, probe_ref):
     create_probe(ctx, probe_ref)
     add_probe_to_server_farm(ctx, sf_ref, probe_ref)
@@ -328,7 +415,7 @@ def makeDeleteProbeFromLBChain(ctx, balancer, probe):
 
 def remove_probe_from_loadbalancer(ctx, sf_ref, probe_ref):
     remove_probe_from_server_farm(ctx, sf_ref, probe_ref)
-    delete_prove(ctx, probe_ref)
+    delete_probe(ctx, probe_ref)
 
 def add_sticky_to_loadbalancer(ctx, balancer, sticky):
     create_sticky(ctx, sticky)
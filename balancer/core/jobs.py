@@ -0,0 +1,149 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Asynchronous execution of load balancer operations.
+
+Every operation is recorded in the job table before it is queued, so API
+calls return as soon as the job exists and its progress can be polled.
+Jobs run in a bounded pool of workers per device type; when a pool's
+queue is full new jobs are rejected instead of piling up.
+
+Green threads do not survive a fork, so pools are created lazily by the
+process that submits the job and unfinished jobs are recovered by the
+serving processes once they are started.
+"""
+
+import logging
+import os
+
+import eventlet
+from eventlet import queue
+
+from balancer.common import cfg
+from balancer.core import job_status
+from balancer.db import api as db_api
+from balancer import exception as exp
+
+LOG = logging.getLogger(__name__)
+
+bind_opts = [
+    cfg.IntOpt('job_workers', default=4),
+    cfg.IntOpt('job_queue_size', default=64),
+]
+
+HANDLERS = {}
+POOLS = {}
+# pid of the process the pools in POOLS belong to
+POOLS_PID = None
+
+
+def handler(action):
+    """Register the decorated function as the runner of ``action`` jobs.
+
+    The function is called as ``func(conf, lb_id, params)``.
+    """
+    def decorator(func):
+        HANDLERS[action] = func
+        return func
+    return decorator
+
+
+class WorkerPool(object):
+    def __init__(self, conf, size, queue_size):
+        self.conf = conf
+        self.queue = queue.LightQueue(queue_size)
+        self.workers = [eventlet.spawn(self._work) for _i in range(size)]
+
+    def put(self, job_id):
+        try:
+            self.queue.put_nowait(job_id)
+        except queue.Full:
+            raise exp.JobQueueFull(job_id=job_id)
+
+    def _work(self):
+        while True:
+            job_id = self.queue.get()
+            try:
+                run_job(self.conf, job_id)
+            except Exception:
+                LOG.exception("Failed to run job %s", job_id)
+
+
+def get_pool(conf, device_type):
+    global POOLS_PID
+    if POOLS_PID != os.getpid():
+        # inherited pools have no running workers after a fork
+        POOLS.clear()
+        POOLS_PID = os.getpid()
+    try:
+        return POOLS[device_type]
+    except KeyError:
+        conf.register_opts(bind_opts)
+        POOLS[device_type] = WorkerPool(conf, conf.job_workers,
+                                        conf.job_queue_size)
+        return POOLS[device_type]
+
+
+def submit(conf, action, lb_id, device_type, params=None):
+    job_ref = db_api.job_create(conf, {'action': action,
+                                       'lb_id': lb_id,
+                                       'device_type': device_type,
+                                       'status': job_status.QUEUED,
+                                       'params': params or {}})
+    try:
+        get_pool(conf, device_type).put(job_ref['id'])
+    except exp.JobQueueFull:
+        db_api.job_update(conf, job_ref['id'],
+                          {'status': job_status.ERROR,
+                           'message': 'Job queue is full'})
+        raise
+    return job_ref
+
+
+def run_job(conf, job_id):
+    job_ref = db_api.job_get(conf, job_id)
+    LOG.debug("Running job %s: %s of loadbalancer %s", job_id,
+              job_ref['action'], job_ref['lb_id'])
+    db_api.job_update(conf, job_id, {'status': job_status.RUNNING})
+    try:
+        HANDLERS[job_ref['action']](conf, job_ref['lb_id'],
+                                    job_ref['params'])
+    except Exception, e:
+        LOG.exception("Job %s failed", job_id)
+        db_api.job_update(conf, job_id, {'status': job_status.ERROR,
+                                         'message': str(e)})
+    else:
+        db_api.job_update(conf, job_id, {'status': job_status.DONE})
+
+
+def recover(conf, started_at=None):
+    """Requeue jobs that were left unfinished by a previous process.
+
+    Only jobs untouched since ``started_at`` are considered and each one is
+    claimed first, so that server workers recovering at the same time do
+    not run a job twice.
+    """
+    for job_ref in db_api.job_get_all_unfinished(conf,
+                                                 updated_before=started_at):
+        if not db_api.job_claim(conf, job_ref):
+            continue
+        LOG.info("Resuming job %s", job_ref['id'])
+        try:
+            get_pool(conf, job_ref['device_type']).put(job_ref['id'])
+        except exp.JobQueueFull:
+            db_api.job_update(conf, job_ref['id'],
+                              {'status': job_status.ERROR,
+                               'message': 'Job queue is full'})
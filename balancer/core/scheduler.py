@@ -15,7 +15,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 import logging
+import time
 
+from balancer.core import lb_status
 from balancer.db import api as db_api
 from balancer import exception as exp
 from balancer.common import cfg, utils
@@ -28,15 +30,91 @@ bind_opts = [
         default=['balancer.core.scheduler.filter_capabilities']),
     cfg.ListOpt('device_cost_functions',
         default=['balancer.core.scheduler.lbs_on']),
+    cfg.IntOpt('scheduler_cache_ttl', default=300),
 ]
 
+# NOTE: resolved filters and cost functions by their configured names.
+PLUGINS = {}
 
-def schedule_loadbalancer(conf, lb_ref):
-    conf.register_opts(bind_opts)
+
+class DeviceIndex(object):
+    """Devices with their capability sets and active load balancer counts.
+
+    Everything is loaded lazily and at most once per TTL, in between the
+    counts are kept up to date with lb_status_changed().
+    """
+
+    def __init__(self):
+        self.loaded_at = time.time()
+        self.devices = None
+        self.capabilities = {}
+        self.lb_counts = None
+
+    def get_devices(self, conf):
+        if self.devices is None:
+            self.devices = db_api.device_get_all(conf)
+        return self.devices
+
+    def get_capabilities(self, conf, dev_ref):
+        try:
+            return self.capabilities[dev_ref['id']]
+        except KeyError:
+            pass
+        device_driver = drivers.get_device_driver(conf, dev_ref['id'])
+        capabilities = {}
+        for key, values in (device_driver.get_capabilities() or {}).\
+                iteritems():
+            capabilities[key] = frozenset(values)
+        self.capabilities[dev_ref['id']] = capabilities
+        return capabilities
+
+    def get_lb_count(self, conf, device_id):
+        if self.lb_counts is None:
+            self.lb_counts = db_api.lb_count_active_by_devices(conf)
+        return self.lb_counts.get(device_id, 0)
+
+    def lb_status_changed(self, device_id, old_status, new_status):
+        if self.lb_counts is None or old_status == new_status:
+            return
+        if old_status == lb_status.ACTIVE:
+            self.lb_counts[device_id] = self.lb_counts.get(device_id, 1) - 1
+        elif new_status == lb_status.ACTIVE:
+            self.lb_counts[device_id] = self.lb_counts.get(device_id, 0) + 1
+
+
+DEVICE_INDEX = DeviceIndex()
+
+
+def get_device_index(conf):
+    global DEVICE_INDEX
+
+    if time.time() - DEVICE_INDEX.loaded_at > conf.scheduler_cache_ttl:
+        DEVICE_INDEX = DeviceIndex()
+    return DEVICE_INDEX
+
+
+def invalidate():
+    """Drop the device index, e.g. when devices are added or removed."""
+    global DEVICE_INDEX
+
+    DEVICE_INDEX = DeviceIndex()
+
+
+def lb_status_changed(device_id, old_status, new_status):
+    """Account a load balancer status change in the device LB counts.
+
+    A deleted load balancer has the new status None.
+    """
+    DEVICE_INDEX.lb_status_changed(device_id, old_status, new_status)
+
+
+def get_plugins(conf):
+    key = (tuple(conf.device_filters), tuple(conf.device_cost_functions))
+    try:
+        return PLUGINS[key]
+    except KeyError:
+        pass
     device_filters = [utils.import_class(foo) for foo in conf.device_filters]
-    all_devices = db_api.device_get_all(conf)
-    if not all_devices:
-        raise exp.DeviceNotFound
     cost_functions = []
     for fullname in conf.device_cost_functions:
         conf_name = 'device_cost_%s_weight' % fullname.rpartition('.')[-1]
@@ -46,19 +124,28 @@ def schedule_loadbalancer(conf, lb_ref):
             conf.register_opt(cfg.FloatOpt(conf_name, default=1.))
             weight = getattr(conf, conf_name)
         cost_functions.append((utils.import_class(fullname), weight))
-    filtered_devices = [dev for dev in all_devices
-                        if all(filt(conf, lb_ref, dev)
-                        for filt in device_filters)]
-    if not filtered_devices:
-        raise exp.NoValidDevice
-    costed = []
-    for dev in filtered_devices:
+    PLUGINS[key] = device_filters, cost_functions
+    return PLUGINS[key]
+
+
+def schedule_loadbalancer(conf, lb_ref):
+    conf.register_opts(bind_opts)
+    device_filters, cost_functions = get_plugins(conf)
+    all_devices = get_device_index(conf).get_devices(conf)
+    if not all_devices:
+        raise exp.DeviceNotFound
+    best = None
+    for dev in all_devices:
+        if not all(filt(conf, lb_ref, dev) for filt in device_filters):
+            continue
         w = 0.
         for cost_func, weight in cost_functions:
             w += weight * cost_func(conf, lb_ref, dev)
-        costed.append((w, dev))
-    costed.sort()
-    return costed[0][1]
+        if best is None or w < best[0]:
+            best = (w, dev)
+    if best is None:
+        raise exp.NoValidDevice
+    return best[1]
 
 
 def filter_capabilities(conf, lb_ref, dev_ref):
@@ -68,15 +155,12 @@ def filter_capabilities(conf, lb_ref, dev_ref):
         conf.register_opt(cfg.ListOpt('device_filter_capabilities',
                                       default=['algorithm']))
         device_filter_capabilities = conf.device_filter_capabilities
-    device_driver = drivers.get_device_driver(conf, dev_ref['id'])
-    capabilities = device_driver.get_capabilities()
-    if capabilities is None:
-        capabilities = {}
+    capabilities = DEVICE_INDEX.get_capabilities(conf, dev_ref)
     for opt in device_filter_capabilities:
         lb_req = lb_ref.get(opt)
         if not lb_req:
             continue
-        dev_caps = capabilities.get(opt + 's', [])
+        dev_caps = capabilities.get(opt + 's', ())
         if not (lb_req in dev_caps):
             LOG.debug('Device %s does not support %s "%s"', dev_ref['id'], opt,
                     lb_req)
@@ -85,4 +169,4 @@ def filter_capabilities(conf, lb_ref, dev_ref):
 
 
 def lbs_on(conf, lb_ref, dev_ref):
-    return db_api.lb_count_active_by_device(conf, dev_ref['id'])
+    return DEVICE_INDEX.get_lb_count(conf, dev_ref['id'])
@@ -22,10 +22,16 @@
 import functools
 import datetime
 
+from sqlalchemy import and_, or_, func
+from sqlalchemy.orm import joinedload_all, subqueryload
+from sqlalchemy.orm.attributes import set_committed_value
+
 from balancer.db import models
+from balancer.db.base import DictBase
 from balancer.db.session import get_session
 from balancer import exception
 from balancer.core import lb_status
+from balancer.core import job_status
 
 
 # XXX(akscram): pack_ and unpack_ are helper methods to compatibility
@@ -36,21 +42,163 @@ def pack_extra(model, values):
 
 
 def unpack_extra(obj_ref):
-    obj_dict = dict(obj_ref.iteritems())
+    if isinstance(obj_ref, DictBase):
+        obj_dict = obj_ref.to_dict()
+    else:
+        obj_dict = dict((key, obj_ref[key]) for key in obj_ref)
     obj_dict.update(obj_dict.pop('extra', None) or {})
     return obj_dict
 
 
 def pack_update(obj_ref, values):
     obj_dict = values.copy()
-    for k, v in values.iteritems():
-        if k in obj_ref.keys():
+    keys = set(obj_ref.keys())
+    for k in values:
+        if k in keys:
             obj_ref[k] = obj_dict.pop(k)
     if obj_dict:
-        if obj_ref['extra'] is not None:
-            obj_ref['extra'].update(obj_dict)
+        extra = dict(obj_ref['extra'] or {})
+        extra.update(obj_dict)
+        obj_ref['extra'] = extra
+
+
+def filter_query(query, model, filters, columns):
+    """Filter query by values of the given columns or, for all other keys,
+    by values of extra.
+    """
+    for key, value in filters.iteritems():
+        if key in columns:
+            query = query.filter(getattr(model, key) == value)
+            continue
+        attr = models.ExtraAttribute
+        ids = query.session.query(attr.resource_id).\
+                filter_by(resource_type=model.__tablename__,
+                          key=key,
+                          value=attr.encode(value)).subquery()
+        if key in model.__extra_columns__:
+            # NOTE: values of another type than the column stay in extra
+            column = getattr(model, model.__extra_columns__[key])
+            query = query.filter(or_(column == value, model.id.in_(ids)))
         else:
-            obj_ref['extra'] = obj_dict.copy()
+            query = query.filter(model.id.in_(ids))
+    return query
+
+
+def _extra_attribute_destroy(session, model, query):
+    """Remove the indexed extra of rows which query deletes in bulk."""
+    attr = models.ExtraAttribute
+    ids = query.with_entities(model.id).subquery()
+    session.query(attr).\
+            filter_by(resource_type=model.__tablename__).\
+            filter(attr.resource_id.in_(ids)).\
+            delete(synchronize_session=False)
+
+
+def _sort_criteria(column, value, sort_dir):
+    """Return the conditions selecting rows before and after value.
+
+    NULL is ordered before any other value, the way SQLite and MySQL do,
+    whatever the database; a plain comparison with NULL matches nothing.
+    """
+    if value is None:
+        equal = column == None
+        if sort_dir == 'asc':
+            return equal, column != None
+        return equal, None
+    after = column > value if sort_dir == 'asc' else column < value
+    if column.nullable and sort_dir == 'desc':
+        after = or_(after, column == None)
+    return column == value, after
+
+
+def paginate_query(query, model, marker, limit, sort_key, sort_dir,
+                   sort_keys):
+    """Sort query and return the page of at most limit rows that follows
+    the row with id == marker.
+
+    Without a sort key the query is left unsorted unless a page is
+    requested, in which case rows are sorted by id.  Rows are always
+    sorted by id last, so pages are stable when sort key values repeat.
+    """
+    if sort_key is None:
+        if marker is None and limit is None:
+            return query
+        sort_key = 'id'
+    if sort_key not in sort_keys:
+        raise exception.InvalidSortKey(sort_key=sort_key)
+    if sort_dir not in ('asc', 'desc'):
+        raise exception.InvalidSortDir(sort_dir=sort_dir)
+    keys = [sort_key]
+    if sort_key != 'id':
+        keys.append('id')
+    columns = [model.__table__.c[key] for key in keys]
+    for column in columns:
+        clauses = [column]
+        if column.nullable:
+            clauses.insert(0, column != None)
+        for clause in clauses:
+            query = query.order_by(clause.asc() if sort_dir == 'asc'
+                                                else clause.desc())
+    if marker is not None:
+        marker_ref = query.session.query(model).filter_by(id=marker).first()
+        if not marker_ref:
+            raise exception.MarkerNotFound(marker=marker)
+        criteria = []
+        equal = []
+        for key, column in zip(keys, columns):
+            is_equal, is_after = _sort_criteria(column, marker_ref[key],
+                                                sort_dir)
+            if is_after is not None:
+                criteria.append(and_(*(equal + [is_after])))
+            equal.append(is_equal)
+        query = query.filter(or_(*criteria))
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+# NOTE: SQLite allows at most 999 bound parameters in a statement.
+BULK_CHUNK_SIZE = 500
+
+
+def _create_many(conf, model, values_list):
+    """Insert the rows in one flush.
+
+    Ids are generated beforehand, so the inserts are issued as a single
+    executemany instead of a statement per row.
+    """
+    session = get_session(conf)
+    with session.begin(subtransactions=True):
+        refs = []
+        for values in values_list:
+            ref = model()
+            ref.update(values)
+            if ref['id'] is None:
+                ref['id'] = models.create_uuid()
+            refs.append(ref)
+        session.add_all(refs)
+        return refs
+
+
+def _update_many(conf, model, refs, values):
+    """Set the same column values on all refs with one UPDATE per chunk.
+
+    The refs are updated in place without being marked as changed, so
+    they are not written again by the next flush.
+    """
+    if not refs:
+        return refs
+    session = get_session(conf)
+    ids = [ref['id'] for ref in refs]
+    with session.begin(subtransactions=True):
+        for start in range(0, len(ids), BULK_CHUNK_SIZE):
+            session.query(model).\
+                    filter(model.id.in_(ids[start:start + BULK_CHUNK_SIZE])).\
+                    update(values, synchronize_session=False)
+    for ref in refs:
+        for key, value in values.iteritems():
+            set_committed_value(ref, key, value)
+    return refs
 
 
 device_pack_extra = functools.partial(pack_extra, models.Device)
@@ -82,7 +230,7 @@ def device_get_all(conf):
 
 def device_create(conf, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         device_ref = models.Device()
         device_ref.update(values)
         session.add(device_ref)
@@ -91,7 +239,7 @@ def device_create(conf, values):
 
 def device_update(conf, device_id, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         device_ref = device_get(conf, device_id, session=session)
         device_ref.update(values)
         return device_ref
@@ -99,7 +247,7 @@ def device_update(conf, device_id, values):
 
 def device_destroy(conf, device_id):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         device_ref = device_get(conf, device_id, session=session)
         session.delete(device_ref)
 
@@ -115,9 +263,47 @@ def loadbalancer_get(conf, loadbalancer_id, session=None):
     return loadbalancer_ref
 
 
-def loadbalancer_get_all_by_project(conf, tenant_id):
+def _loadbalancer_details_query(session):
+    # NOTE: servers are joined into the main query while the other, short
+    # collections get one extra query each, so the number of round trips
+    # doesn't depend on how many load balancers are loaded.
+    return session.query(models.LoadBalancer).\
+                   options(joinedload_all('serverfarms.servers'),
+                           subqueryload('serverfarms.virtualservers'),
+                           subqueryload('serverfarms.probes'),
+                           subqueryload('serverfarms.stickies'))
+
+
+def loadbalancer_get_details(conf, loadbalancer_id):
+    session = get_session(conf)
+    loadbalancer_ref = _loadbalancer_details_query(session).\
+                               filter_by(id=loadbalancer_id).first()
+    if not loadbalancer_ref:
+        raise exception.LoadBalancerNotFound(loadbalancer_id=loadbalancer_id)
+    return loadbalancer_ref
+
+
+def loadbalancer_get_all_details(conf, tenant_id, loadbalancer_ids=None):
+    session = get_session(conf)
+    query = _loadbalancer_details_query(session).\
+                    filter_by(tenant_id=tenant_id)
+    if loadbalancer_ids is not None:
+        query = query.filter(models.LoadBalancer.id.in_(loadbalancer_ids))
+    return query.all()
+
+
+def loadbalancer_get_all_by_project(conf, tenant_id, filters=None,
+                                    marker=None, limit=None, sort_key=None,
+                                    sort_dir='asc'):
     session = get_session(conf)
     query = session.query(models.LoadBalancer).filter_by(tenant_id=tenant_id)
+    query = filter_query(query, models.LoadBalancer, filters or {},
+                         ('name', 'status', 'protocol', 'algorithm',
+                          'device_id'))
+    query = paginate_query(query, models.LoadBalancer, marker, limit,
+                           sort_key, sort_dir,
+                           ('id', 'name', 'status', 'protocol', 'algorithm',
+                            'device_id', 'created_at', 'updated_at'))
     return query.all()
 
 
@@ -135,7 +321,7 @@ def loadbalancer_get_all_by_vm_id(conf, vm_id, tenant_id):
 
 def loadbalancer_create(conf, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         lb_ref = models.LoadBalancer()
         lb_ref.update(values)
         session.add(lb_ref)
@@ -144,7 +330,7 @@ def loadbalancer_create(conf, values):
 
 def loadbalancer_update(conf, lb_id, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         lb_ref = loadbalancer_get(conf, lb_id, session=session)
         lb_ref.update(values)
         lb_ref['updated_at'] = datetime.datetime.utcnow()
@@ -153,14 +339,14 @@ def loadbalancer_update(conf, lb_id, values):
 
 def loadbalancer_destroy(conf, lb_id):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         lb_ref = loadbalancer_get(conf, lb_id, session=session)
         session.delete(lb_ref)
 
 
 def lb_count_active_by_device(conf, device_id):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         lbs_count = session.query(models.LoadBalancer).\
                                   filter_by(device_id=device_id).\
                                   filter_by(status=lb_status.ACTIVE).\
@@ -168,6 +354,16 @@ def lb_count_active_by_device(conf, device_id):
         return lbs_count
 
 
+def lb_count_active_by_devices(conf):
+    """Return a dict of the active load balancer counts by device id."""
+    session = get_session(conf)
+    query = session.query(models.LoadBalancer.device_id,
+                          func.count(models.LoadBalancer.id)).\
+                    filter_by(status=lb_status.ACTIVE).\
+                    group_by(models.LoadBalancer.device_id)
+    return dict(query.all())
+
+
 # Probe
 
 
@@ -193,32 +389,42 @@ def probe_get_all_by_sf_id(conf, sf_id):
 
 def probe_create(conf, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         probe_ref = models.Probe()
         probe_ref.update(values)
         session.add(probe_ref)
         return probe_ref
 
 
+def probe_create_many(conf, values_list):
+    return _create_many(conf, models.Probe, values_list)
+
+
 def probe_update(conf, probe_id, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         probe_ref = probe_get(conf, probe_id, session=session)
         probe_ref.update(values)
         return probe_ref
 
 
+def probe_update_many(conf, probe_refs, values):
+    return _update_many(conf, models.Probe, probe_refs, values)
+
+
 def probe_destroy(conf, probe_id):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         probe_ref = probe_get(conf, probe_id, session=session)
         session.delete(probe_ref)
 
 
 def probe_destroy_by_sf_id(conf, sf_id, session=None):
     session = session or get_session(conf)
-    with session.begin():
-        session.query(models.Probe).filter_by(sf_id=sf_id).delete()
+    with session.begin(subtransactions=True):
+        query = session.query(models.Probe).filter_by(sf_id=sf_id)
+        _extra_attribute_destroy(session, models.Probe, query)
+        query.delete()
 
 # Sticky
 
@@ -245,7 +451,7 @@ def sticky_get_all_by_sf_id(conf, sf_id):
 
 def sticky_create(conf, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         sticky_ref = models.Sticky()
         sticky_ref.update(values)
         session.add(sticky_ref)
@@ -254,7 +460,7 @@ def sticky_create(conf, values):
 
 def sticky_update(conf, sticky_id, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         sticky_ref = sticky_get(conf, sticky_id, session=session)
         sticky_ref.update(values)
         return sticky_ref
@@ -262,15 +468,17 @@ def sticky_update(conf, sticky_id, values):
 
 def sticky_destroy(conf, sticky_id):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         sticky_ref = sticky_get(conf, sticky_id, session=session)
         session.delete(sticky_ref)
 
 
 def sticky_destroy_by_sf_id(conf, sf_id, session=None):
     session = session or get_session(conf)
-    with session.begin():
-        session.query(models.Sticky).filter_by(sf_id=sf_id).delete()
+    with session.begin(subtransactions=True):
+        query = session.query(models.Sticky).filter_by(sf_id=sf_id)
+        _extra_attribute_destroy(session, models.Sticky, query)
+        query.delete()
 
 # Server
 
@@ -305,16 +513,17 @@ def server_get_by_address(conf, server_address):
 
 def server_get_by_address_on_device(conf, server_address, device_id):
     session = get_session(conf)
-    server_refs = session.query(models.Server).\
-                         filter_by(address=server_address).\
-                         filter_by(deployed='True')
-    for server_ref in server_refs:
-        sf = serverfarm_get(conf, server_ref['sf_id'], session=session)
-        lb = loadbalancer_get(conf, sf['lb_id'])
-        if device_id == lb['device_id']:
-            return server_ref
-    raise exception.ServerNotFound(server_address=server_address,
-                                   device_id=device_id)
+    server_ref = session.query(models.Server).\
+                         join(models.Server.serverfarm).\
+                         join(models.ServerFarm.loadbalancer).\
+                         filter(models.LoadBalancer.device_id == device_id).\
+                         filter(models.Server.deployed == 'True').\
+                         filter(models.Server.address == server_address).\
+                         first()
+    if not server_ref:
+        raise exception.ServerNotFound(server_address=server_address,
+                                       device_id=device_id)
+    return server_ref
 
 
 def server_get_all_by_parent_id(conf, parent_id):
@@ -323,40 +532,66 @@ def server_get_all_by_parent_id(conf, parent_id):
     return query.all()
 
 
-def server_get_all_by_sf_id(conf, sf_id):
+def server_get_all_by_sf_id(conf, sf_id, filters=None, marker=None,
+                            limit=None, sort_key=None, sort_dir='asc'):
     session = get_session(conf)
     query = session.query(models.Server).filter_by(sf_id=sf_id)
+    query = filter_query(query, models.Server, filters or {},
+                         ('name', 'address', 'port', 'status', 'vm_id'))
+    query = paginate_query(query, models.Server, marker, limit,
+                           sort_key, sort_dir,
+                           ('id', 'name', 'address', 'port', 'weight',
+                            'status'))
     return query.all()
 
 
 def server_create(conf, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         server_ref = models.Server()
         server_ref.update(values)
         session.add(server_ref)
         return server_ref
 
 
+def server_create_many(conf, values_list):
+    return _create_many(conf, models.Server, values_list)
+
+
 def server_update(conf, server_id, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         server_ref = server_get(conf, server_id, session=session)
         server_ref.update(values)
         return server_ref
 
 
+def server_update_many(conf, server_refs, values):
+    return _update_many(conf, models.Server, server_refs, values)
+
+
 def server_destroy(conf, server_id):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         server_ref = server_get(conf, server_id, session=session)
         session.delete(server_ref)
 
 
+def server_destroy_many(conf, server_ids):
+    session = get_session(conf)
+    with session.begin(subtransactions=True):
+        query = session.query(models.Server).\
+                filter(models.Server.id.in_(server_ids))
+        _extra_attribute_destroy(session, models.Server, query)
+        query.delete(synchronize_session=False)
+
+
 def server_destroy_by_sf_id(conf, sf_id, session=None):
     session = session or get_session(conf)
-    with session.begin():
-        session.query(models.Server).filter_by(sf_id=sf_id).delete()
+    with session.begin(subtransactions=True):
+        query = session.query(models.Server).filter_by(sf_id=sf_id)
+        _extra_attribute_destroy(session, models.Server, query)
+        query.delete()
 
 # ServerFarm
 
@@ -378,7 +613,7 @@ def serverfarm_get_all_by_lb_id(conf, lb_id):
 
 def serverfarm_create(conf, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         serverfarm_ref = models.ServerFarm()
         serverfarm_ref.update(values)
         session.add(serverfarm_ref)
@@ -387,7 +622,7 @@ def serverfarm_create(conf, values):
 
 def serverfarm_update(conf, serverfarm_id, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         serverfarm_ref = serverfarm_get(conf, serverfarm_id, session=session)
         serverfarm_ref.update(values)
         return serverfarm_ref
@@ -395,7 +630,7 @@ def serverfarm_update(conf, serverfarm_id, values):
 
 def serverfarm_destroy(conf, serverfarm_id):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         serverfarm_ref = serverfarm_get(conf, serverfarm_id, session=session)
         session.delete(serverfarm_ref)
 
@@ -419,7 +654,7 @@ def predictor_get_all_by_sf_id(conf, sf_id):
 
 def predictor_create(conf, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         predictor_ref = models.Predictor()
         predictor_ref.update(values)
         session.add(predictor_ref)
@@ -428,7 +663,7 @@ def predictor_create(conf, values):
 
 def predictor_update(conf, predictor_id, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         predictor_ref = predictor_get(conf, predictor_id, session=session)
         predictor_ref.update(values)
         return predictor_ref
@@ -436,15 +671,17 @@ def predictor_update(conf, predictor_id, values):
 
 def predictor_destroy(conf, predictor_id):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         predictor_ref = predictor_get(conf, predictor_id, session=session)
         session.delete(predictor_ref)
 
 
 def predictor_destroy_by_sf_id(conf, sf_id, session=None):
     session = session or get_session(conf)
-    with session.begin():
-        session.query(models.Predictor).filter_by(sf_id=sf_id).delete()
+    with session.begin(subtransactions=True):
+        query = session.query(models.Predictor).filter_by(sf_id=sf_id)
+        _extra_attribute_destroy(session, models.Predictor, query)
+        query.delete()
 
 # VirtualServer
 
@@ -474,29 +711,92 @@ def virtualserver_get_all_by_lb_id(conf, lb_id):
 
 def virtualserver_create(conf, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         vserver_ref = models.VirtualServer()
         vserver_ref.update(values)
         session.add(vserver_ref)
         return vserver_ref
 
 
+def virtualserver_create_many(conf, values_list):
+    return _create_many(conf, models.VirtualServer, values_list)
+
+
 def virtualserver_update(conf, vserver_id, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         vserver_ref = virtualserver_get(conf, vserver_id, session=session)
         vserver_ref.update(values)
         return vserver_ref
 
 
+def virtualserver_update_many(conf, vserver_refs, values):
+    return _update_many(conf, models.VirtualServer, vserver_refs, values)
+
+
 def virtualserver_destroy(conf, vserver_id):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         vserver_ref = virtualserver_get(conf, vserver_id, session=session)
         session.delete(vserver_ref)
 
 
 def virtualserver_destroy_by_sf_id(conf, sf_id, session=None):
     session = session or get_session(conf)
-    with session.begin():
-        session.query(models.VirtualServer).filter_by(sf_id=sf_id).delete()
+    with session.begin(subtransactions=True):
+        query = session.query(models.VirtualServer).filter_by(sf_id=sf_id)
+        _extra_attribute_destroy(session, models.VirtualServer, query)
+        query.delete()
+
+# Job
+
+
+def job_get(conf, job_id, session=None):
+    session = session or get_session(conf)
+    job_ref = session.query(models.Job).filter_by(id=job_id).first()
+    if not job_ref:
+        raise exception.JobNotFound(job_id=job_id)
+    return job_ref
+
+
+def job_get_all_unfinished(conf, updated_before=None):
+    session = get_session(conf)
+    query = session.query(models.Job).\
+                    filter(models.Job.status.in_([job_status.QUEUED,
+                                                  job_status.RUNNING]))
+    if updated_before is not None:
+        query = query.filter(models.Job.updated_at < updated_before)
+    return query.order_by(models.Job.created_at).all()
+
+
+def job_claim(conf, job_ref):
+    """Mark the job as taken, unless it changed since it was read.
+
+    Returns False when another process updated the job first.
+    """
+    session = get_session(conf)
+    with session.begin(subtransactions=True):
+        count = session.query(models.Job).\
+                        filter_by(id=job_ref['id'],
+                                  updated_at=job_ref['updated_at']).\
+                        update({'status': job_status.QUEUED,
+                                'updated_at': datetime.datetime.utcnow()},
+                               synchronize_session=False)
+    return count == 1
+
+
+def job_create(conf, values):
+    session = get_session(conf)
+    with session.begin(subtransactions=True):
+        job_ref = models.Job()
+        job_ref.update(values)
+        session.add(job_ref)
+        return job_ref
+
+
+def job_update(conf, job_id, values):
+    session = get_session(conf)
+    with session.begin(subtransactions=True):
+        job_ref = job_get(conf, job_id, session=session)
+        job_ref.update(values)
+        return job_ref
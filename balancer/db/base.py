@@ -22,17 +22,88 @@
 import json
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import object_mapper
+from sqlalchemy.orm import class_mapper
 from sqlalchemy.types import TypeDecorator
-from sqlalchemy import Text
+from sqlalchemy import Integer, String, Text
 
 
 Base = declarative_base()
 
 
 class DictBase(object):
+    # NOTE: maps keys of extra to the attributes of promoted columns, the
+    #       other keys, and values the column would not store as they are,
+    #       are kept in the _extra blob.
+    __extra_columns__ = {}
+
+    def _get_extra(self):
+        # NOTE: always a new dict, changing it doesn't change the object.
+        extra = self._extra
+        if not self.__extra_columns__:
+            return None if extra is None else dict(extra)
+        extra = dict(extra or {})
+        for key, attr in self.__extra_columns__.iteritems():
+            value = getattr(self, attr)
+            if value is not None:
+                extra[key] = value
+        return extra
+
+    def _set_extra(self, values):
+        if values is None:
+            self._extra = None
+            return
+        tail = {}
+        for key, value in values.iteritems():
+            if key not in self.__extra_columns__:
+                tail[key] = value
+        for key, attr in self.__extra_columns__.iteritems():
+            value = values.get(key)
+            if value is not None and not self._fits_column(attr, value):
+                tail[key] = value
+                value = None
+            setattr(self, attr, value)
+        self._extra = tail
+
+    extra = property(_get_extra, _set_extra)
+
+    @classmethod
+    def _fits_column(cls, attr, value):
+        """Tell whether the column reads value back with the same type."""
+        column_type = class_mapper(cls).columns[attr].type
+        if isinstance(column_type, JsonBlob):
+            return True
+        if isinstance(column_type, Integer):
+            return (isinstance(value, (int, long)) and
+                    not isinstance(value, bool))
+        if isinstance(column_type, String):
+            return (isinstance(value, basestring) and
+                    (column_type.length is None or
+                     len(value) <= column_type.length))
+        return False
+
+    @classmethod
+    def _column_names(cls):
+        # NOTE: cached per class, object_mapper() is too slow to look up
+        #       for every row of a listing.
+        names = cls.__dict__.get('_column_names_cache')
+        if names is None:
+            promoted = cls.__extra_columns__.values()
+            names = tuple(col.name for col in class_mapper(cls).columns
+                          if col.name not in promoted)
+            cls._column_names_cache = names
+        return names
+
     def to_dict(self):
-        return dict(self.iteritems())
+        # NOTE: loaded values are read from the instance dict directly,
+        #       expired or unloaded ones go through the attributes.
+        values = self.__dict__
+        result = {}
+        for key in self._column_names():
+            value = values[key] if key in values else getattr(self, key)
+            if key != 'extra' and isinstance(value, dict):
+                value = value.copy()
+            result[key] = value
+        return result
 
     def __setitem__(self, key, value):
         setattr(self, key, value)
@@ -44,10 +115,10 @@ class DictBase(object):
         return getattr(self, key, default)
 
     def __iter__(self):
-        return (col.name for col in object_mapper(self).columns)
+        return iter(self._column_names())
 
     def keys(self):
-        return list(self)
+        return list(self._column_names())
 
     def update(self, values):
         for key, value in values.iteritems():
@@ -56,13 +127,11 @@ class DictBase(object):
             setattr(self, key, value)
 
     def iteritems(self):
-        items = []
-        for key in self:
-            value = getattr(self,  key)
+        for key in self._column_names():
+            value = getattr(self, key)
             if isinstance(value, dict):
                 value = value.copy()
-            items.append((key, value))
-        return iter(items)
+            yield key, value
 
 
 class JsonBlob(TypeDecorator):
@@ -0,0 +1,27 @@
+from sqlalchemy.schema import MetaData, Table, Column
+from sqlalchemy.types import String, Text, DateTime
+
+
+meta = MetaData()
+
+Table('job', meta,
+    Column('id', String(32), primary_key=True),
+    Column('lb_id', String(32)),
+    Column('device_type', String(255)),
+    Column('action', String(255)),
+    Column('status', String(255)),
+    Column('message', Text()),
+    Column('created_at', DateTime, nullable=False),
+    Column('updated_at', DateTime, nullable=False),
+    Column('params', Text()),
+)
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    meta.create_all()
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    meta.tables['job'].drop()
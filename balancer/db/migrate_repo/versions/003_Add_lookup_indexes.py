@@ -0,0 +1,34 @@
+from sqlalchemy.schema import MetaData, Table, Index
+
+
+INDEXES = (
+    ('ix_loadbalancer_tenant_id', 'loadbalancer', ('tenant_id',)),
+    ('ix_loadbalancer_device_id_status', 'loadbalancer',
+        ('device_id', 'status')),
+    ('ix_serverfarm_lb_id', 'serverfarm', ('lb_id',)),
+    ('ix_server_sf_id', 'server', ('sf_id',)),
+    ('ix_server_parent_id', 'server', ('parent_id',)),
+    ('ix_server_address_deployed', 'server', ('address', 'deployed')),
+    ('ix_virtualserver_sf_id', 'virtualserver', ('sf_id',)),
+    ('ix_probe_sf_id', 'probe', ('sf_id',)),
+    ('ix_sticky_sf_id', 'sticky', ('sf_id',)),
+    ('ix_predictor_sf_id', 'predictor', ('sf_id',)),
+    ('ix_job_status', 'job', ('status',)),
+)
+
+
+def get_indexes(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    for name, table_name, columns in INDEXES:
+        table = Table(table_name, meta, autoload=True)
+        yield Index(name, *[table.c[column] for column in columns])
+
+
+def upgrade(migrate_engine):
+    for index in get_indexes(migrate_engine):
+        index.create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    for index in get_indexes(migrate_engine):
+        index.drop(migrate_engine)
@@ -0,0 +1,180 @@
+import json
+
+from migrate import changeset  # NOQA: adds Column.create/drop
+from sqlalchemy.schema import MetaData, Table, Column, ForeignKey, Index
+from sqlalchemy.types import String, Text, Integer
+
+
+meta = MetaData()
+
+extra_attribute = Table('extra_attribute', meta,
+    Column('id', Integer, primary_key=True),
+    Column('resource_type', String(32), nullable=False),
+    Column('resource_id', String(32), nullable=False),
+    Column('key', String(64), nullable=False),
+    Column('value', String(128)),
+)
+
+Index('ix_extra_attribute_resource',
+      extra_attribute.c.resource_type, extra_attribute.c.resource_id)
+Index('ix_extra_attribute_key_value', extra_attribute.c.resource_type,
+      extra_attribute.c.key, extra_attribute.c.value)
+
+EXTRA_TABLES = ('device', 'loadbalancer', 'serverfarm', 'virtualserver',
+                'server', 'probe', 'sticky', 'predictor')
+
+
+def to_string(length):
+    def convert(value):
+        if not isinstance(value, basestring) or len(value) > length:
+            raise TypeError(value)
+        return value
+    return convert
+
+
+def to_integer(value):
+    if isinstance(value, bool) or not isinstance(value, (int, long)):
+        raise TypeError(value)
+    return value
+
+
+# (table, key of extra, column, column type, to column, from column)
+# NOTE: values which the column would not read back unchanged stay in extra.
+PROMOTED = (
+    ('device', 'capabilities', 'capabilities', Text, json.dumps,
+        json.loads),
+    ('virtualserver', 'ipVersion', 'ip_version', lambda: String(40),
+        to_string(40), None),
+    ('probe', 'probeInterval', 'probe_interval', Integer, to_integer, None),
+    ('sticky', 'persistenceType', 'persistence_type', lambda: String(255),
+        to_string(255), None),
+)
+
+
+def encode(value):
+    if isinstance(value, basestring):
+        encoded = value
+    elif value is None or isinstance(value, (bool, int, long, float)):
+        encoded = json.dumps(value)
+    else:
+        return None
+    if len(encoded) > 128:
+        return None
+    return encoded
+
+
+def get_promoted(table_name):
+    return [(key, column, convert, revert)
+            for table, key, column, _type, convert, revert in PROMOTED
+            if table == table_name]
+
+
+def get_tables(migrate_engine):
+    # NOTE: reflected in a new MetaData, the module one outlives a run and
+    #       would keep the columns as they were the previous time.
+    reflected = MetaData(bind=migrate_engine)
+    return dict((name, Table(name, reflected, autoload=True))
+                for name in EXTRA_TABLES)
+
+
+def drop_columns(migrate_engine, table, columns):
+    if migrate_engine.name != 'sqlite':
+        for column in columns:
+            column.drop()
+        return
+    # NOTE: sqlalchemy-migrate rebuilds a SQLite table under the name
+    #       migration_tmp, and SQLite then rewrites the foreign keys of the
+    #       other tables to point to it.  The table is copied to a new name
+    #       instead, so only the copy gets renamed.
+    dropped = set(column.name for column in columns)
+    names = [column.name for column in table.columns
+             if column.name not in dropped]
+    indexes = [(index.name, [column.name for column in index.columns])
+               for index in table.indexes]
+    new_columns = []
+    for name in names:
+        column = table.c[name]
+        foreign_keys = [ForeignKey(foreign_key.target_fullname)
+                        for foreign_key in column.foreign_keys]
+        new_columns.append(Column(name, column.type, *foreign_keys,
+                                  primary_key=column.primary_key,
+                                  nullable=column.nullable))
+    new_table = Table(table.name + '_new', table.metadata, *new_columns)
+    new_table.create()
+    migrate_engine.execute('INSERT INTO %s (%s) SELECT %s FROM %s' %
+                           (new_table.name, ', '.join(names),
+                            ', '.join(names), table.name))
+    table.drop()
+    migrate_engine.execute('ALTER TABLE %s RENAME TO %s' %
+                           (new_table.name, table.name))
+    table = Table(table.name, MetaData(bind=migrate_engine), autoload=True)
+    for name, column_names in indexes:
+        Index(name, *[table.c[column] for column in column_names]).create()
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    extra_attribute.create()
+    tables = get_tables(migrate_engine)
+    for table_name, key, column, column_type, _c, _r in PROMOTED:
+        Column(column, column_type()).create(tables[table_name])
+
+    for table_name, table in tables.iteritems():
+        promoted = get_promoted(table_name)
+        rows = migrate_engine.execute(
+            table.select().with_only_columns([table.c.id, table.c.extra])).\
+                fetchall()
+        attributes = []
+        for row_id, extra in rows:
+            extra = json.loads(extra) if extra else None
+            if not extra:
+                continue
+            values = {}
+            for key, column, convert, _revert in promoted:
+                if extra.get(key) is None:
+                    continue
+                try:
+                    values[column] = convert(extra[key])
+                except (TypeError, ValueError):
+                    continue
+                del extra[key]
+            if values:
+                values['extra'] = json.dumps(extra)
+                migrate_engine.execute(
+                    table.update().where(table.c.id == row_id), values)
+            for key, value in extra.iteritems():
+                encoded = encode(value)
+                if encoded is not None and len(key) <= 64:
+                    attributes.append({'resource_type': table_name,
+                                       'resource_id': row_id,
+                                       'key': key,
+                                       'value': encoded})
+        if attributes:
+            migrate_engine.execute(extra_attribute.insert(), attributes)
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    tables = get_tables(migrate_engine)
+    for table_name, table in tables.iteritems():
+        promoted = get_promoted(table_name)
+        if not promoted:
+            continue
+        columns = [table.c[column] for _k, column, _c, _r in promoted]
+        rows = migrate_engine.execute(table.select().with_only_columns(
+            [table.c.id, table.c.extra] + columns)).fetchall()
+        for row in rows:
+            values = {}
+            for key, column, _convert, revert in promoted:
+                value = row[column]
+                if value is not None:
+                    values[key] = revert(value) if revert else value
+            if not values:
+                continue
+            extra = json.loads(row['extra']) if row['extra'] else {}
+            extra.update(values)
+            migrate_engine.execute(
+                table.update().where(table.c.id == row['id']),
+                {'extra': json.dumps(extra)})
+        drop_columns(migrate_engine, table, columns)
+    extra_attribute.drop()
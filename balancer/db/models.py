@@ -20,11 +20,13 @@
 """SQLAlchemy models for balancer data."""
 
 import datetime
+import json
 import uuid
 
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, Session
+from sqlalchemy.orm.attributes import get_history
 from sqlalchemy import (Column, ForeignKey, Integer, String, Boolean,
-                        DateTime)
+                        DateTime, Text, Index, and_, event)
 
 from balancer.db.base import Base, DictBase, JsonBlob
 
@@ -37,6 +39,7 @@ class Device(DictBase, Base):
     """Represents a load balancer appliance."""
 
     __tablename__ = 'device'
+    __extra_columns__ = {'capabilities': 'capabilities'}
     id = Column(String(32), primary_key=True, default=create_uuid)
     name = Column(String(255))
     type = Column(String(255))
@@ -45,13 +48,17 @@ class Device(DictBase, Base):
     port = Column(Integer)
     user = Column(String(255))
     password = Column(String(255))
-    extra = Column(JsonBlob())
+    capabilities = Column(JsonBlob())
+    _extra = Column('extra', JsonBlob())
 
 
 class LoadBalancer(DictBase, Base):
     """Represents an instance of load balancer applience for a tenant."""
 
     __tablename__ = 'loadbalancer'
+    __table_args__ = (Index('ix_loadbalancer_tenant_id', 'tenant_id'),
+                      Index('ix_loadbalancer_device_id_status',
+                            'device_id', 'status'))
     id = Column(String(32), primary_key=True, default=create_uuid)
     device_id = Column(String(32), ForeignKey('device.id'))
     name = Column(String(255))
@@ -65,7 +72,7 @@ class LoadBalancer(DictBase, Base):
                         onupdate=datetime.datetime.utcnow,
                         nullable=False)
     deployed = Column(String(40))
-    extra = Column(JsonBlob())
+    _extra = Column('extra', JsonBlob())
 
     device = relationship(Device,
                           backref=backref('loadbalancers', order_by=id),
@@ -76,13 +83,14 @@ class ServerFarm(DictBase, Base):
     """Represents a server farm."""
 
     __tablename__ = 'serverfarm'
+    __table_args__ = (Index('ix_serverfarm_lb_id', 'lb_id'),)
     id = Column(String(32), primary_key=True, default=create_uuid)
     lb_id = Column(String(32), ForeignKey('loadbalancer.id'))
     name = Column(String(255))
     type = Column(String(255))
     status = Column(String(255))
     deployed = Column(String(40))
-    extra = Column(JsonBlob())
+    _extra = Column('extra', JsonBlob())
 
     loadbalancer = relationship(LoadBalancer,
                                 backref=backref('serverfarms', order_by=id),
@@ -93,6 +101,8 @@ class VirtualServer(DictBase, Base):
     """Represents a Virtual IP."""
 
     __tablename__ = 'virtualserver'
+    __table_args__ = (Index('ix_virtualserver_sf_id', 'sf_id'),)
+    __extra_columns__ = {'ipVersion': 'ip_version'}
     id = Column(String(32), primary_key=True, default=create_uuid)
     sf_id = Column(String(32), ForeignKey('serverfarm.id'))
     lb_id = Column(String(32), ForeignKey('loadbalancer.id'))
@@ -102,7 +112,8 @@ class VirtualServer(DictBase, Base):
     port = Column(String(255))
     status = Column(String(255))
     deployed = Column(String(40))
-    extra = Column(JsonBlob())
+    ip_version = Column(String(40))
+    _extra = Column('extra', JsonBlob())
 
     serverfarm = relationship(ServerFarm,
                               backref=backref('virtualservers', order_by=id),
@@ -116,6 +127,10 @@ class Server(DictBase, Base):
     """Represents a real server."""
 
     __tablename__ = 'server'
+    __table_args__ = (Index('ix_server_sf_id', 'sf_id'),
+                      Index('ix_server_parent_id', 'parent_id'),
+                      Index('ix_server_address_deployed',
+                            'address', 'deployed'))
     id = Column(String(32), primary_key=True, default=create_uuid)
     sf_id = Column(String(32), ForeignKey('serverfarm.id'))
     name = Column(String(255))
@@ -127,7 +142,7 @@ class Server(DictBase, Base):
     parent_id = Column(Integer)
     deployed = Column(String(40))
     vm_id = Column(Integer)
-    extra = Column(JsonBlob())
+    _extra = Column('extra', JsonBlob())
 
     serverfarm = relationship(ServerFarm,
                               backref=backref('servers', order_by=id),
@@ -138,12 +153,15 @@ class Probe(DictBase, Base):
     """Represents a health monitoring."""
 
     __tablename__ = 'probe'
+    __table_args__ = (Index('ix_probe_sf_id', 'sf_id'),)
+    __extra_columns__ = {'probeInterval': 'probe_interval'}
     id = Column(String(32), primary_key=True, default=create_uuid)
     sf_id = Column(String(32), ForeignKey('serverfarm.id'))
     name = Column(String(255))
     type = Column(String(255))
     deployed = Column(String(40))
-    extra = Column(JsonBlob())
+    probe_interval = Column(Integer)
+    _extra = Column('extra', JsonBlob())
 
     serverfarm = relationship(ServerFarm,
                               backref=backref('probes', order_by=id),
@@ -154,12 +172,15 @@ class Sticky(DictBase, Base):
     """Represents a persistent session."""
 
     __tablename__ = 'sticky'
+    __table_args__ = (Index('ix_sticky_sf_id', 'sf_id'),)
+    __extra_columns__ = {'persistenceType': 'persistence_type'}
     id = Column(String(32), primary_key=True, default=create_uuid)
     sf_id = Column(String(32), ForeignKey('serverfarm.id'))
     name = Column(String(255))
     type = Column(String(255))
     deployed = Column(String(40))
-    extra = Column(JsonBlob())
+    persistence_type = Column(String(255))
+    _extra = Column('extra', JsonBlob())
 
     serverfarm = relationship(ServerFarm,
                               backref=backref('stickies', order_by=id),
@@ -170,17 +191,116 @@ class Predictor(DictBase, Base):
     """Represents a algorithm of selecting server."""
 
     __tablename__ = 'predictor'
+    __table_args__ = (Index('ix_predictor_sf_id', 'sf_id'),)
     id = Column(String(32), primary_key=True, default=create_uuid)
     sf_id = Column(String(32), ForeignKey('serverfarm.id'))
     type = Column(String(255))
     deployed = Column(String(40))
-    extra = Column(JsonBlob())
+    _extra = Column('extra', JsonBlob())
 
     serverfarm = relationship(ServerFarm,
                               backref=backref('predictors', order_by=id),
                               uselist=False)
 
 
+class Job(DictBase, Base):
+    """Represents an asynchronous operation on a load balancer."""
+
+    __tablename__ = 'job'
+    __table_args__ = (Index('ix_job_status', 'status'),)
+    id = Column(String(32), primary_key=True, default=create_uuid)
+    lb_id = Column(String(32))
+    device_type = Column(String(255))
+    action = Column(String(255))
+    status = Column(String(255))
+    message = Column(Text())
+    created_at = Column(DateTime, default=datetime.datetime.utcnow,
+                        nullable=False)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow,
+                        onupdate=datetime.datetime.utcnow,
+                        nullable=False)
+    params = Column(JsonBlob())
+
+
+class ExtraAttribute(Base):
+    """Indexed copy of a scalar value kept in the extra of a model."""
+
+    __tablename__ = 'extra_attribute'
+    __table_args__ = (Index('ix_extra_attribute_resource',
+                            'resource_type', 'resource_id'),
+                      Index('ix_extra_attribute_key_value',
+                            'resource_type', 'key', 'value'))
+    id = Column(Integer, primary_key=True)
+    resource_type = Column(String(32), nullable=False)
+    resource_id = Column(String(32), nullable=False)
+    key = Column(String(64), nullable=False)
+    value = Column(String(128))
+
+    @staticmethod
+    def encode(value):
+        """Return the indexed form of value or None if it isn't indexed.
+
+        Strings are stored as is and other scalars in JSON, so values
+        from a query string match numbers and booleans too.
+        """
+        if isinstance(value, basestring):
+            encoded = value
+        elif value is None or isinstance(value, (bool, int, long, float)):
+            encoded = json.dumps(value)
+        else:
+            return None
+        if len(encoded) > 128:
+            return None
+        return encoded
+
+
+EXTRA_MODELS = (Device, LoadBalancer, ServerFarm, VirtualServer, Server,
+                Probe, Sticky, Predictor)
+
+
+def _extra_attribute_rows(target):
+    rows = []
+    for key, value in (target._extra or {}).iteritems():
+        encoded = ExtraAttribute.encode(value)
+        if encoded is not None and len(key) <= 64:
+            rows.append({'resource_type': target.__tablename__,
+                         'resource_id': target.id,
+                         'key': key,
+                         'value': encoded})
+    return rows
+
+
+def _index_extra(session, flush_context):
+    """Rewrite the indexed extra of the rows written by the flush.
+
+    Done once per flush rather than per row, so bulk inserts stay a
+    constant number of statements.
+    """
+    rows = []
+    stale = {}
+    for obj in session.new:
+        if isinstance(obj, EXTRA_MODELS):
+            rows.extend(_extra_attribute_rows(obj))
+    for obj in session.dirty:
+        if (isinstance(obj, EXTRA_MODELS) and
+                get_history(obj, '_extra').has_changes()):
+            stale.setdefault(obj.__tablename__, []).append(obj.id)
+            rows.extend(_extra_attribute_rows(obj))
+    for obj in session.deleted:
+        if isinstance(obj, EXTRA_MODELS):
+            stale.setdefault(obj.__tablename__, []).append(obj.id)
+    table = ExtraAttribute.__table__
+    for resource_type, ids in stale.iteritems():
+        session.execute(table.delete().where(and_(
+            table.c.resource_type == resource_type,
+            table.c.resource_id.in_(ids))))
+    if rows:
+        session.execute(table.insert(), rows)
+
+
+event.listen(Session, 'after_flush', _index_extra)
+
+
 def register_models(engine):
     """Create tables for models."""
 
@@ -20,88 +20,248 @@
 """Session management functions."""
 
 import os
+import time
 import logging
+import functools
+import contextlib
 
+from eventlet import corolocal
+from eventlet.green import threading as green_threading
 from migrate.versioning import api as versioning_api
 from migrate import exceptions as versioning_exceptions
 from sqlalchemy import create_engine
+from sqlalchemy import event
 from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import NullPool
-from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.exc import DisconnectionError, TimeoutError
+from sqlalchemy.util import queue as sqla_queue
 
 from balancer.common import cfg
 from balancer.db import migrate_repo
 
 
+LOG = logging.getLogger(__name__)
+
 DB_GROUP_NAME = 'sql'
 DB_OPTIONS = (
     cfg.IntOpt('idle_timeout', default=3600),
     cfg.StrOpt('connection', default='sqlite:///balancer.sqlite'),
+    cfg.IntOpt('pool_size', default=5),
+    cfg.IntOpt('max_overflow', default=10),
+    cfg.IntOpt('pool_timeout', default=30),
+    cfg.BoolOpt('pool_pre_ping', default=True),
+    cfg.BoolOpt('green_pool', default=True),
+    cfg.StrOpt('sqlite_journal_mode', default='WAL'),
 )
 
 MAKER = None
 ENGINE = None
+_LOCAL = corolocal.local()
 
 
-class MySQLPingListener(object):
-    """
-    Ensures that MySQL connections checked out of the
-    pool are alive.
+class PoolMetrics(object):
+    """Checkout statistics of the connection pool."""
 
-    Borrowed from:
-    http://groups.google.com/group/sqlalchemy/msg/a4ce563d802c929f
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
 
-    Error codes caught:
-    * 2006 MySQL server has gone away
-    * 2013 Lost connection to MySQL server during query
-    * 2014 Commands out of sync; you can't run this command now
-    * 2045 Can't open shared memory; no answer from server (%lu)
-    * 2055 Lost connection to MySQL server at '%s', system error: %d
+    def record(self, wait_time):
+        self.checkouts += 1
+        self.wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+
+
+POOL_METRICS = PoolMetrics()
 
-    from http://dev.mysql.com/doc/refman/5.6/en/error-messages-client.html
-    """
 
-    def checkout(self, dbapi_con, con_record, con_proxy):
+class MeteredQueuePool(QueuePool):
+    """QueuePool that records checkout times into POOL_METRICS."""
+
+    def _do_get(self):
+        start = time.time()
         try:
-            dbapi_con.cursor().execute('select 1')
-        except dbapi_con.OperationalError, ex:
-            if ex.args[0] in (2006, 2013, 2014, 2045, 2055):
-                logging.warn('Got mysql server has gone away: %s', ex)
+            conn = QueuePool._do_get(self)
+        except TimeoutError:
+            POOL_METRICS.timeouts += 1
+            LOG.warning("Connection pool exhausted: %s", self.status())
+            raise
+        POOL_METRICS.record(time.time() - start)
+        return conn
+
+
+class _GreenQueue(sqla_queue.Queue):
+    def __init__(self, maxsize=0):
+        sqla_queue.Queue.__init__(self, maxsize)
+        self.mutex = green_threading.RLock()
+        self.not_empty = green_threading.Condition(self.mutex)
+        self.not_full = green_threading.Condition(self.mutex)
+
+
+class GreenQueuePool(MeteredQueuePool):
+    """Pool that blocks only the waiting green thread on checkout."""
+
+    def __init__(self, creator, pool_size=5, max_overflow=10, timeout=30,
+                 **kw):
+        MeteredQueuePool.__init__(self, creator, pool_size=pool_size,
+                                  max_overflow=max_overflow,
+                                  timeout=timeout, **kw)
+        self._pool = _GreenQueue(pool_size)
+        if self._max_overflow > -1:
+            self._overflow_lock = green_threading.Lock()
+
+
+def get_pool_metrics():
+    """Return checkout statistics and the state of the pool."""
+    metrics = {'checkouts': POOL_METRICS.checkouts,
+               'timeouts': POOL_METRICS.timeouts,
+               'wait_time': POOL_METRICS.wait_time,
+               'max_wait_time': POOL_METRICS.max_wait_time}
+    if ENGINE is not None and isinstance(ENGINE.pool, QueuePool):
+        metrics.update({'size': ENGINE.pool.size(),
+                        'checkedin': ENGINE.pool.checkedin(),
+                        'checkedout': ENGINE.pool.checkedout(),
+                        'overflow': ENGINE.pool.overflow()})
+    return metrics
+
+
+def _ping_connection(engine):
+    """Ensure that connections checked out of the pool are alive."""
+    def checkout(dbapi_con, con_record, con_proxy):
+        cursor = dbapi_con.cursor()
+        try:
+            cursor.execute('select 1')
+        except engine.dialect.dbapi.Error, ex:
+            if engine.dialect.is_disconnect(ex, dbapi_con, cursor):
+                LOG.warn('Got database server has gone away: %s', ex)
                 raise DisconnectionError("Database server went away")
-            else:
-                raise
+            raise
+        finally:
+            cursor.close()
+    return checkout
 
 
-def get_session(conf, autocommit=True, expire_on_commit=False):
-    """Return a SQLAlchemy session."""
+def _sqlite_journal_mode(journal_mode):
+    def connect(dbapi_con, con_record):
+        dbapi_con.execute('PRAGMA journal_mode = %s' % (journal_mode,))
+    return connect
+
+
+class _UnitOfWork(object):
+    """Session shared by every database call of one operation."""
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.session = None
+
+    def get_session(self):
+        # NOTE: the session and its transaction are opened lazily, so
+        #       operations that never touch the database don't hold a
+        #       connection.
+        if self.session is None:
+            self.session = _make_session(self.conf)
+            self.session.begin()
+        return self.session
+
+
+def _make_session(conf, autocommit=True, expire_on_commit=False):
     global MAKER
 
-    if MAKER is None:
-        MAKER = sessionmaker(autocommit=autocommit,
-                             expire_on_commit=expire_on_commit)
     engine = get_engine(conf)
-    MAKER.configure(bind=engine)
-    session = MAKER()
-    return session
+    if MAKER is None:
+        MAKER = sessionmaker(bind=engine)
+    return MAKER(autocommit=autocommit, expire_on_commit=expire_on_commit)
+
+
+def get_session(conf, autocommit=True, expire_on_commit=False):
+    """Return a SQLAlchemy session.
+
+    Inside of a transaction() block the session of the active unit of
+    work is returned, so all database calls share its transaction.
+    """
+    unit = getattr(_LOCAL, 'unit', None)
+    if unit is not None:
+        return unit.get_session()
+    return _make_session(conf, autocommit, expire_on_commit)
+
+
+@contextlib.contextmanager
+def transaction(conf):
+    """Run the block as a single unit of work.
+
+    Database calls made inside the block (in the current green thread)
+    share one session and are committed once when the block exits, or
+    rolled back together if it raises.  Nested blocks join the
+    outermost one.
+    """
+    if getattr(_LOCAL, 'unit', None) is not None:
+        yield
+        return
+    unit = _LOCAL.unit = _UnitOfWork(conf)
+    try:
+        yield
+    except:
+        if unit.session is not None:
+            unit.session.rollback()
+        raise
+    else:
+        if unit.session is not None:
+            unit.session.commit()
+    finally:
+        _LOCAL.unit = None
+
+
+def transactional(func):
+    """Decorator running func(conf, ...) in a transaction()."""
+    @functools.wraps(func)
+    def __inner(conf, *args, **kwargs):
+        with transaction(conf):
+            return func(conf, *args, **kwargs)
+    return __inner
 
 
 def get_engine(conf):
     """Return a SQLAlchemy engine."""
-    global ENGINE
+    global ENGINE, MAKER, POOL_METRICS
 
     register_conf_opts(conf)
+    if ENGINE is not None and conf.sql.connection == str(ENGINE.url):
+        return ENGINE
     connection_url = make_url(conf.sql.connection)
-    if ENGINE is None or not ENGINE.url == connection_url:
-        engine_args = {'pool_recycle': conf.sql.idle_timeout,
-                       'echo': False,
-                       'convert_unicode': True
-                       }
-        if 'sqlite' in connection_url.drivername:
-            engine_args['poolclass'] = NullPool
-        if 'mysql' in connection_url.drivername:
-            engine_args['listeners'] = [MySQLPingListener()]
-        ENGINE = create_engine(conf.sql.connection, **engine_args)
+    if ENGINE is not None and ENGINE.url == connection_url:
+        return ENGINE
+    engine_args = {'pool_recycle': conf.sql.idle_timeout,
+                   'echo': False,
+                   'convert_unicode': True
+                   }
+    is_sqlite = 'sqlite' in connection_url.drivername
+    # NOTE: in-memory SQLite databases keep the default single
+    #       connection pool, every new connection is a new database.
+    if not is_sqlite or connection_url.database not in (None, '',
+                                                        ':memory:'):
+        if conf.sql.green_pool:
+            engine_args['poolclass'] = GreenQueuePool
+        else:
+            engine_args['poolclass'] = MeteredQueuePool
+        engine_args.update({'pool_size': conf.sql.pool_size,
+                            'max_overflow': conf.sql.max_overflow,
+                            'pool_timeout': conf.sql.pool_timeout})
+        if is_sqlite:
+            engine_args['connect_args'] = {'check_same_thread': False}
+    engine = create_engine(conf.sql.connection, **engine_args)
+    if is_sqlite and conf.sql.sqlite_journal_mode:
+        event.listen(engine, 'connect',
+                     _sqlite_journal_mode(conf.sql.sqlite_journal_mode))
+    if not is_sqlite and conf.sql.pool_pre_ping:
+        event.listen(engine, 'checkout', _ping_connection(engine))
+    if ENGINE is not None:
+        ENGINE.dispose()
+    ENGINE = engine
+    MAKER = None
+    POOL_METRICS = PoolMetrics()
     return ENGINE
 
 
@@ -1,34 +1,108 @@
+import collections
+
+from eventlet import semaphore
+
 from balancer.common import cfg
 from balancer.common import utils
 from balancer.db import api as db_api
 
-drivers_opt = cfg.ListOpt('device_drivers',
+drivers_opts = [
+    cfg.ListOpt('device_drivers',
         default=[
             #'ace=balancer.drivers.cisco_ace.ace_driver.AceDriver',
             #'haproxy=balancer.drivers.haproxy.HaproxyDriver.HaproxyDriver',
             ('stingray=balancer.drivers.riverbed_stingray'
             '.StingrayDriver.StingrayDriver')
         ],
-        help="Balancer devices' drivers.")
+        help="Balancer devices' drivers."),
+    cfg.IntOpt('device_drivers_cache_size', default=100,
+               help="Maximum number of driver instances kept in memory, "
+                    "least recently used ones are dropped first."),
+]
 
-DEVICE_DRIVERS = {}
+# device type -> driver class, resolved once from conf.device_drivers
+DRIVER_CLASSES = None
+# device id -> driver instance, ordered from least to most recently used
+DEVICE_DRIVERS = collections.OrderedDict()
+# device id -> lock serializing request contexts on the device, kept apart
+# from DEVICE_DRIVERS so that evicted and recreated drivers share it
+DEVICE_LOCKS = {}
+# ids of the devices whose driver is replaced once it is no longer in use
+STALE_DRIVERS = set()
 
 
-def get_device_driver(conf, device_id):
-    try:
-        return DEVICE_DRIVERS[device_id]
-    except KeyError:
-        conf.register_opt(drivers_opt)
+def get_driver_classes(conf):
+    global DRIVER_CLASSES
+    if DRIVER_CLASSES is None:
+        conf.register_opts(drivers_opts)
         drivers = {}
         for driver_str in conf.device_drivers:
             driver_type, _sep, driver = driver_str.partition('=')
             drivers[driver_type.lower()] = utils.import_class(driver)
+        DRIVER_CLASSES = drivers
+    return DRIVER_CLASSES
+
+
+def get_device_lock(device_id):
+    if device_id is None:
+        return semaphore.Semaphore()
+    try:
+        return DEVICE_LOCKS[device_id]
+    except KeyError:
+        return DEVICE_LOCKS.setdefault(device_id, semaphore.Semaphore())
 
+
+def get_device_driver(conf, device_id):
+    """Return the driver of the device, building it if needed.
+
+    A driver is never dropped while it is in use, a device must not be
+    worked on through two driver instances at once.
+    """
+    driver = DEVICE_DRIVERS.pop(device_id, None)
+    if (driver is not None and device_id in STALE_DRIVERS and
+            not driver.in_use()):
+        STALE_DRIVERS.discard(device_id)
+        driver = None
+    if driver is None:
+        drivers = get_driver_classes(conf)
         device_ref = db_api.device_get(conf, device_id)
         try:
             cls = drivers[device_ref['type'].lower()]
         except KeyError:
             raise NotImplementedError("Driver not found for type %s" % \
                                         (device_ref['type'],))
-        DEVICE_DRIVERS[device_id] = cls(conf, device_ref)
-        return DEVICE_DRIVERS[device_id]
+        # device_get may have switched green threads, another one could
+        # have built the driver meanwhile
+        driver = DEVICE_DRIVERS.pop(device_id, None)
+        if driver is None:
+            driver = cls(conf, device_ref)
+    DEVICE_DRIVERS[device_id] = driver
+    if len(DEVICE_DRIVERS) > conf.device_drivers_cache_size:
+        # least recently used first, drivers in use stay over the limit
+        for old_id, old_driver in DEVICE_DRIVERS.items():
+            if len(DEVICE_DRIVERS) <= conf.device_drivers_cache_size:
+                break
+            if not old_driver.in_use():
+                del DEVICE_DRIVERS[old_id]
+                STALE_DRIVERS.discard(old_id)
+    return driver
+
+
+def invalidate_device_driver(device_id):
+    """Forget the driver of the device, the next call builds a new one.
+
+    A driver in use is replaced by the first call after it is done.
+    """
+    driver = DEVICE_DRIVERS.get(device_id)
+    if driver is None:
+        return
+    if driver.in_use():
+        STALE_DRIVERS.add(device_id)
+    else:
+        del DEVICE_DRIVERS[device_id]
+
+
+def device_deleted(device_id):
+    DEVICE_DRIVERS.pop(device_id, None)
+    STALE_DRIVERS.discard(device_id)
+    DEVICE_LOCKS.pop(device_id, None)
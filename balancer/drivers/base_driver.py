@@ -15,6 +15,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 from balancer.core import commands
+from balancer import drivers
 
 
 class DeviceRequestContext(commands.RollbackContext):
@@ -28,11 +29,27 @@ class BaseDriver(object):
     def __init__(self, conf, device_ref):
         self.conf = conf
         self.device_ref = device_ref
+        self.lock = drivers.get_device_lock(device_ref.get('id'))
 
     def request_context(self):
+        # Drivers keep per-device state, so only one request context
+        # works with the device at a time
+        self.lock.acquire()
+        mgr = self._request_context()
+        mgr.context.add_rollback(self._release_lock)
+        return mgr
+
+    def _request_context(self):
         return commands.RollbackContextManager(
                 DeviceRequestContext(self.conf, self))
 
+    def _release_lock(self, good):
+        self.lock.release()
+
+    def in_use(self):
+        """Tell whether a request still works with the driver state."""
+        return self.lock.locked()
+
     def checkNone(self, obj):
         if bool(obj):
             if obj != 'None':
@@ -90,6 +107,19 @@ class BaseDriver(object):
     def delete_real_server_from_server_farm(self, serverfarm, rserver):
         raise NotImplementedError
 
+    def add_real_servers_to_server_farm(self, serverfarm, rservers):
+        """Add several rservers at once.
+
+        Drivers that can push a whole batch to the device in one operation
+        should override this; the default falls back to one call per rserver.
+        """
+        for rserver in rservers:
+            self.add_real_server_to_server_farm(serverfarm, rserver)
+
+    def delete_real_servers_from_server_farm(self, serverfarm, rservers):
+        for rserver in rservers:
+            self.delete_real_server_from_server_farm(serverfarm, rserver)
+
     def add_probe_to_server_farm(self, serverfarm, probe):
         raise NotImplementedError
 
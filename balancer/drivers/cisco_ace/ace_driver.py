@@ -16,16 +16,112 @@
 #    under the License.
 
 import hashlib
-import urllib2
+import httplib
+import re
+import socket
+import sys
+import time
+import urlparse
 import base64
 import logging
 import ipaddr
-from balancer.drivers.base_driver import BaseDriver, is_sequence
+from balancer.core import commands
+from balancer.drivers.base_driver import BaseDriver, DeviceRequestContext
+from balancer.drivers.base_driver import is_sequence
 import openstack.common.exception
 
 
 logger = logging.getLogger(__name__)
 
+# Status of each command line echoed back by the XML agent
+COMMAND_STATUS_RE = re.compile(r'<command>\s*(.*?)\s*</command>\s*'
+                               r'<status\s+code="[^"]*"\s+text="([^"]*)"',
+                               re.S)
+
+
+# Fragments which change the sections kept in AceRunningConfig
+RUNNING_CONFIG_WRITE_RE = re.compile(
+        r'^\s*(no\s+)?(int|interface|class-map|policy-map|nat-pool|class)\b',
+        re.M)
+
+
+class AceCommandError(openstack.common.exception.Error):
+    pass
+
+
+class AceRunningConfig(object):
+    '''
+    Parsed running-config of the device, indexes the sections used by
+    the driver: VLAN interfaces with their nat-pools, class-maps and
+    policy-maps
+    '''
+    def __init__(self, text):
+        self.interfaces = {}
+        self.nat_pools = []
+        self.class_maps = {}
+        self.policy_maps = {}
+        section = None
+        for line in text.splitlines():
+            if not line.strip() or line.lstrip().startswith('<'):
+                continue
+            if not line[0].isspace():
+                section = self._start_section(line.split())
+            elif section is not None:
+                section.append(line.strip())
+        for vlan, lines in self.interfaces.iteritems():
+            for line in lines:
+                words = line.split()
+                if words[0] == 'nat-pool' and len(words) > 3:
+                    self.nat_pools.append(self._parse_nat_pool(vlan, words))
+
+    def _start_section(self, words):
+        if len(words) == 3 and words[0] == 'interface' and words[1] == 'vlan':
+            return self.interfaces.setdefault(words[2], [])
+        elif words[0] == 'class-map' and len(words) > 1:
+            return self.class_maps.setdefault(words[-1], [])
+        elif words[0] == 'policy-map' and len(words) > 1:
+            return self.policy_maps.setdefault(words[-1], [])
+        return None
+
+    @staticmethod
+    def _parse_nat_pool(vlan, words):
+        # nat-pool <id> <ip1> [<ip2>] [netmask] <netmask> [pat]
+        pat = words[-1] == 'pat'
+        if pat:
+            words = words[:-1]
+        ips = [word for word in words[2:] if word != 'netmask']
+        nat_pool = {'vlan': vlan, 'id': words[1], 'ip1': ips[0],
+                    'ip2': ips[1] if len(ips) > 2 else ips[0],
+                    'netmask': ips[-1]}
+        if pat:
+            nat_pool['pat'] = True
+        return nat_pool
+
+    def get_nat_pool_ids(self):
+        return set(nat_pool['id'] for nat_pool in self.nat_pools)
+
+    def policy_map_has_classes(self, name):
+        return any(line.split()[0] == 'class'
+                   for line in self.policy_maps.get(name, ()))
+
+
+class AceRequestContextManager(commands.RollbackContextManager):
+    '''
+    Submits the commands buffered by the driver before the rollback stack
+    is unwound, so a rejected batch rolls the whole request back
+    '''
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        driver = self.context.device
+        if exc_type is None:
+            try:
+                driver.flush_batch()
+            except Exception:
+                exc_type, exc_value, exc_tb = sys.exc_info()
+        # Rollback commands go to the device right away
+        driver.batch = None
+        return super(AceRequestContextManager, self).__exit__(
+                exc_type, exc_value, exc_tb)
+
 
 class AceDriver(BaseDriver):
     def __init__(self,  conf,  device_ref):
@@ -35,36 +131,137 @@ class AceDriver(BaseDriver):
         base64str = base64.encodestring('%s:%s' % \
             (device_ref['user'], device_ref['password']))[:-1]
         self.authheader = "Basic %s" % base64str
+        self.connection = None
+        # CLI fragments waiting to be submitted, only within request context
+        self.batch = None
+        device_extra = device_ref.get('extra') or {}
+        self.running_config_ttl = float(
+                device_extra.get('running_config_ttl') or 60)
+        self.running_config = None
+        self.running_config_time = None
+
+    def _request_context(self):
+        self.batch = []
+        return AceRequestContextManager(DeviceRequestContext(self.conf, self))
+
+    def _post(self, data):
+        '''
+        Sends data to the XML agent over a kept alive connection,
+        a connection closed by the device is reopened once
+        '''
+        url = urlparse.urlsplit(self.url)
+        headers = {'Authorization': self.authheader,
+                   'Content-Type': 'application/x-www-form-urlencoded'}
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = httplib.HTTPSConnection(url.hostname,
+                                                          url.port)
+            try:
+                self.connection.request('POST', url.path, data, headers)
+                response = self.connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+                continue
+            if response.status != 200:
+                raise AceCommandError('XML agent of %s replied %s %s' %
+                        (self.device_ref['ip'], response.status,
+                         response.reason))
+            return body
 
     def deployConfig(self, s):
-        request = urllib2.Request(self.url)
-        request.add_header("Authorization", self.authheader)
+        if RUNNING_CONFIG_WRITE_RE.search(s):
+            self.running_config = None
+        if self.batch is not None:
+            self.batch.append(s)
+            return 'OK'
         d = "xml_cmd=<request_raw>\nconfigure\n%s\nend\n</request_raw>" % s
         logger.debug("send data to ACE:\n" + d)
-        try:
-            message = urllib2.urlopen(request, d)
-            s = message.read()
-        except Exception:
-            raise
+        s = self._post(d)
         logger.debug("data from ACE:\n" + s)
         if 'XML_CMD_SUCCESS' in s:
             return 'OK'
         else:
             return 'Error'
 
+    def deployBatch(self, fragments):
+        '''
+        Submits several CLI fragments in one request, each one in its own
+        configure ... end block, raises AceCommandError naming the
+        fragments the device rejected
+        '''
+        d = "xml_cmd=<request_raw>\n%s</request_raw>" % "".join(
+                "configure\n%s\nend\n" % fragment for fragment in fragments)
+        logger.debug("send data to ACE:\n" + d)
+        s = self._post(d)
+        logger.debug("data from ACE:\n" + s)
+        failed = self.get_failed_fragments(s, fragments)
+        if failed:
+            raise AceCommandError('ACE %s rejected commands:\n%s' %
+                    (self.device_ref['ip'],
+                     '\n'.join('%s: %s' % (fragment, text)
+                               for fragment, text in failed)))
+
+    def get_failed_fragments(self, response, fragments):
+        '''
+        Returns (fragment, error) for every fragment with a rejected
+        command line
+        '''
+        statuses = COMMAND_STATUS_RE.findall(response)
+        if not statuses:
+            if 'XML_CMD_SUCCESS' in response:
+                return []
+            return [(fragment, 'no status') for fragment in fragments]
+        # Command lines are echoed in the order they were sent
+        lines = []
+        for fragment in fragments:
+            for line in ['configure'] + fragment.split('\n') + ['end']:
+                if line.strip():
+                    lines.append((line.strip(), fragment))
+        failed = []
+        position = 0
+        for command, text in statuses:
+            fragment = None
+            for index in range(position, len(lines)):
+                if lines[index][0] == command.strip():
+                    fragment = lines[index][1]
+                    position = index + 1
+                    break
+            if text != 'XML_CMD_SUCCESS' and \
+                    not (failed and failed[-1][0] is fragment):
+                failed.append((fragment or command, text))
+        return failed
+
+    def flush_batch(self):
+        if not self.batch:
+            return
+        fragments, self.batch = self.batch, []
+        self.deployBatch(fragments)
+
     def getConfig(self, s):
-        request = urllib2.Request(self.url)
-        request.add_header("Authorization", self.authheader)
+        # The running config has to reflect the commands issued so far
+        self.flush_batch()
         data = "xml_cmd=<request_raw>\nshow runn %s\n</request_raw>" % s
         logger.debug("send data to ACE:\n" + data)
-        try:
-            message = urllib2.urlopen(request, data)
-            s = message.read()
-        except Exception:
-            raise
+        s = self._post(data)
         logger.debug("data from ACE:\n" + s)
         return s
 
+    def get_running_config(self):
+        '''
+        Returns the running-config snapshot, it is fetched in one request
+        and kept until it expires or the driver changes a section of it
+        '''
+        now = time.time()
+        if (self.running_config is None or
+                now - self.running_config_time > self.running_config_ttl):
+            self.running_config = AceRunningConfig(self.getConfig(''))
+            self.running_config_time = now
+        return self.running_config
+
     def create_nat_pool(self, nat_pool):
         cmd = "int vlan " + str(nat_pool['vlan']) + \
             "\nnat-pool " + str(nat_pool['id']) + " %s" % nat_pool['ip1']
@@ -105,45 +302,17 @@ class AceDriver(BaseDriver):
         self.deployConfig(cmd)
 
     def get_nat_pools(self):
-        vlan_interfaces = self.getConfig("| i interface vlan").split('\n')
-        result = []
-        for vlan in vlan_interfaces:
-            s = self.getConfig("int vlan %s | i nat-pool" % vlan).split('\n')
-            for f in s:
-                f = f.split()
-            r = []
-            for w in f:
-                if len(w) > 4:
-                    r.append(w)
-            if len(r) > 0:
-                res = {}
-                res['vlan'] = vlan[-1]
-                res['id'] = r[0]
-                res['ip1'] = r[1]
-                if len(r) > 3:
-                    res['ip2'] = r[2]
-                    res['netmask'] = r[3]
-                else:
-                    res['ip2'] = r[1]
-                    res['netmask'] = r[2]
-                result.append(res)
-        return result
+        return self.get_running_config().nat_pools
 
     def find_nat_pool_for_vip(self, vip):
         if '4' in vip.get('ipVersion'):
-            ip = ipaddr.IPv4Address(vip['address'])
             network = ipaddr.IPv4Network(vip['address'] + "/" + vip['mask'])
         else:
-            ip = ipaddr.IPv6Address(vip['address'])
             network = ipaddr.IPv6Network(vip['address'] + "/" + vip['mask'])
-        nat_pools = self.get_nat_pools()
-        for nat_pool in nat_pools:
-            if (nat_pool['ip1'] in network.iterhosts() and
-                nat_pool['ip2'] in network.iterhosst()):
-                ip = nat_pool['ip1']
-                network_nat = ipaddr.ip_network(ip + "/" + nat_pool['netmask'])
-                if ip in network_nat:
-                    return nat_pool
+        for nat_pool in self.get_nat_pools():
+            if (ipaddr.IPAddress(nat_pool['ip1']) in network and
+                    ipaddr.IPAddress(nat_pool['ip2']) in network):
+                return nat_pool
         return None
 
     def generate_nat_pool_for_vip(self, vip):
@@ -159,16 +328,12 @@ class AceDriver(BaseDriver):
             network = ipaddr.IPv4Network(vip['address'] + "/" + vip['mask'])
         else:
             network = ipaddr.IPv6Network(vip['address'] + "/" + vip['mask'])
-        ips = []
-        for ip in network.iterhosts():
-            ips.append(ip)
-        nat_pool['ip1'] = ips[-1]
-        ids = []
-        for i in self.get_nat_pools():
-            ids.append(i.get('id'))
+        nat_pool['ip1'] = str(network.broadcast - 1)
+        ids = self.get_running_config().get_nat_pool_ids()
         for i in range(1, 2000):
-            if not i in ids:
+            if not str(i) in ids:
                 nat_pool['id'] = i
+                break
         nat_pool['pat'] = True
         return nat_pool
 
@@ -712,7 +877,7 @@ class AceDriver(BaseDriver):
         cmd = "no policy-map type loadbalance first-match " + \
               vip['id'] + "-l7slb"
         self.deployConfig(cmd)
-        if (self.getConfig("policy-map %s" % pmap).find("class") <= 0):
+        if not self.get_running_config().policy_map_has_classes(pmap):
             if vip_extra.get('allVLANs'):
                 cmd = "no service-policy input " + pmap
                 self.deployConfig(cmd)
@@ -0,0 +1,73 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import logging
+
+import eventlet
+from eventlet import event
+from eventlet import semaphore
+
+
+logger = logging.getLogger(__name__)
+
+
+class DeployQueue(object):
+    '''
+    Serializes config mutations on one device and deploys all changes
+    submitted within the window in one go
+    '''
+    def __init__(self, deploy, window=0.1, lock=None):
+        self.deploy = deploy
+        self.window = window
+        self.lock = lock or semaphore.Semaphore()
+        self.waiters = []
+        self.timer = None
+        self.deploys = 0
+
+    def acquire(self):
+        self.lock.acquire()
+
+    def release(self):
+        self.lock.release()
+
+    def submit(self):
+        '''
+            Must be called with the lock held, returns an event
+            which receives the result of the deploy
+        '''
+        waiter = event.Event()
+        self.waiters.append(waiter)
+        if self.timer is None:
+            self.timer = eventlet.spawn_after(self.window, self._flush)
+        return waiter
+
+    def _flush(self):
+        with self.lock:
+            self.timer = None
+            waiters, self.waiters = self.waiters, []
+            if not waiters:
+                return
+            logger.debug('[HAPROXY] Deploying changes of %d requests',
+                         len(waiters))
+            self.deploys += 1
+            try:
+                result = self.deploy()
+            except Exception:
+                logger.exception('[HAPROXY] Deploy failed')
+                result = False
+        for waiter in waiters:
+            waiter.send(result)
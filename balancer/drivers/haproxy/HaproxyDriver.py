@@ -15,16 +15,31 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import hashlib
 import logging
+import re
+import subprocess
 
+import eventlet
+
+from openstack.common import exception
 from balancer.drivers import base_driver
+from balancer.drivers.haproxy.DeployQueue import DeployQueue
 from balancer.drivers.haproxy.RemoteControl import RemoteConfig, RemoteService
 from balancer.drivers.haproxy.RemoteControl import RemoteInterface
-from balancer.drivers.haproxy.RemoteControl import RemoteSocketOperation
+from balancer.drivers.haproxy.RemoteControl import RemoteSocketBatch
 
 
 logger = logging.getLogger(__name__)
 
+SLOT_PREFIX = 'slot'
+SLOT_OWNER_RE = re.compile(r'#\s*rserver\s+(\S+)')
+
+
+class DeployFailed(exception.Error):
+    pass
+
 
 class HaproxyDriver(base_driver.BaseDriver):
     def __init__(self, conf, device_ref):
@@ -55,24 +70,290 @@ class HaproxyDriver(base_driver.BaseDriver):
             self.haproxy_socket = '/tmp/haproxy.sock'
         else:
             self.haproxy_socket = device_extra['socket']
+        if ((device_extra.get('socket_mode') is None) or
+                (device_extra['socket_mode'] == "None")):
+            self.socket_mode = 'semicolon'
+        else:
+            self.socket_mode = device_extra['socket_mode']
+        if ((device_extra.get('reload_mode') is None) or
+                (device_extra['reload_mode'] == "None")):
+            self.reload_mode = 'soft'
+        else:
+            self.reload_mode = device_extra['reload_mode']
+        if ((device_extra.get('pid_file') is None) or
+                (device_extra['pid_file'] == "None")):
+            self.pid_file = '/var/run/haproxy.pid'
+        else:
+            self.pid_file = device_extra['pid_file']
+        if ((device_extra.get('local_validation') is None) or
+                (device_extra['local_validation'] == "None")):
+            self.local_validation = 'builtin'
+        else:
+            self.local_validation = device_extra['local_validation']
+        self.local_haproxy = device_extra.get('local_haproxy') or 'haproxy'
+        self.runtime_api = str(device_extra.get('runtime_api')).lower() in \
+                ('true', '1', 'yes')
+        self.server_slots = int(device_extra.get('server_slots') or 10)
+        self.persist_delay = float(device_extra.get('persist_delay') or 5)
         self.config_file = None
         self.config_was_deployed = True
+        self.config_needs_reload = False
+        self.socket_batch = None
+        # backend name -> {'free': [slot, ...], 'used': {rserver id: slot}}
+        self.runtime_slots = {}
+        # (backend name, slot) -> server line not yet in the device config
+        self.runtime_pending = {}
+        self.runtime_undo = []
+        self.persist_timer = None
+        self.deploy_queue = DeployQueue(self._deploy_config,
+                float(device_extra.get('deploy_window') or 0.1), self.lock)
+        self.deploy_waiter = None
+        self.snapshot = None
+        # sha1 of the config which is known to be on the device
+        self.deployed_hash = None
+        self.deploy_counters = {'performed': 0, 'skipped': 0}
 
     def request_context(self):
-        mgr = super(HaproxyDriver, self).request_context()
-        mgr.context.add_rollback(self.finalize_config)
+        # Only one request context mutates the device state at a time,
+        # the device lock is shared with the deploy queue and released
+        # as soon as the changes are submitted, so deploys can be batched
+        self.deploy_queue.acquire()
+        mgr = self._request_context()
+        self.snapshot = (self.config_file and self.config_file.copy(),
+                         self.config_was_deployed, self.config_needs_reload)
+        mgr.context.add_rollback(self._finish_request)
         return mgr
 
-    def _get_config(self):
+    def in_use(self):
+        # Changes waiting for a deploy or to be persisted live only here
+        return (super(HaproxyDriver, self).in_use() or
+                self.deploy_queue.timer is not None or
+                self.persist_timer is not None)
+
+    def _finish_request(self, good):
+        # One rollback, so a failure to send the socket commands
+        # can not leave the device locked
+        try:
+            self.finalize_config(good)
+            self._flush_socket_commands(good)
+        finally:
+            self._wait_for_deploy(good)
+
+    def _wait_for_deploy(self, good):
+        waiter, self.deploy_waiter = self.deploy_waiter, None
+        self.snapshot = None
+        self.deploy_queue.release()
+        if waiter is not None and not waiter.wait():
+            raise DeployFailed('Failed to deploy haproxy configuration '
+                               'on device %s' % self.device_ref['ip'])
+
+    def _new_socket_batch(self):
+        return RemoteSocketBatch(self.device_ref, self.haproxy_socket,
+                                 self.socket_mode)
+
+    def _get_socket_batch(self):
+        if self.socket_batch is None:
+            self.socket_batch = self._new_socket_batch()
+        return self.socket_batch
+
+    def _flush_socket_commands(self, good):
+        '''
+            Send all admin socket commands queued during the request
+            context in one socket session
+        '''
+        batch, self.socket_batch = self.socket_batch, None
+        undo, self.runtime_undo = self.runtime_undo, []
+        if not good:
+            for func in reversed(undo):
+                func()
+            return
+        if batch:
+            logger.debug('[HAPROXY] Sending %d queued socket commands',
+                         len(batch))
+            commands = list(batch.commands)
+            failed = [(command, result) for command, result in
+                      zip(commands, batch.execute()) if result.strip()]
+            if failed:
+                for command, result in failed:
+                    logger.error('[HAPROXY] Socket command "%s" failed: %s',
+                                 command, result)
+                # The runtime state is unknown now, reload haproxy with
+                # the config which already has all the changes
+                self._load_config()
+                self.config_was_deployed = False
+                self.config_needs_reload = True
+                if self.deploy_waiter is None:
+                    self.deploy_waiter = self.deploy_queue.submit()
+                return
+        if undo:
+            self._schedule_persist()
+
+    def run_socket_commands(self, commands):
+        '''
+            Run admin socket commands (enable server, disable server,
+            set weight, show stat, ...) in one socket session right away
+            and return per-command results
+        '''
+        batch = self._new_socket_batch()
+        for command in commands:
+            batch.add(command)
+        return batch.execute()
+
+    def _load_config(self):
         if self.config_file == None:
-            self.config_file = HaproxyConfigFile('%s/%s' % (self.localpath,
-                                            self.configfilename))
             remote = RemoteConfig(self.device_ref, self.localpath,
                                   self.remotepath, self.configfilename)
             remote.get_config()
+            self.config_file = HaproxyConfigFile('%s/%s' % (self.localpath,
+                                            self.configfilename))
+            self.deployed_hash = self.config_file.get_hash()
+            for (backend_name, slot), line in \
+                    self.runtime_pending.iteritems():
+                self._apply_slot_line(backend_name, slot, line)
+        return self.config_file
+
+    def _get_config(self):
+        config_file = self._load_config()
         self.config_was_deployed = False
+        self.config_needs_reload = True
         logger.debug("Marking as not deployed")
-        return self.config_file
+        return config_file
+
+    """
+       Runtime API fast path: backends get a fixed number of server slots
+       which are filled, drained and weighted via the admin socket.
+       The config file follows lazily on the persist timer
+    """
+    def _get_runtime_slots(self, backend_name):
+        slots = self.runtime_slots.get(backend_name)
+        if slots is None:
+            slots = {'free': [], 'used': {}, 'lines': {}}
+            section = self._load_config().get_section('backend',
+                                                      backend_name)
+            for line in (section or []):
+                words = line.split()
+                if (len(words) < 2 or words[0] != 'server' or
+                        not words[1].startswith(SLOT_PREFIX)):
+                    continue
+                slots['lines'][words[1]] = line
+                owner = SLOT_OWNER_RE.search(line)
+                if owner:
+                    slots['used'][owner.group(1)] = words[1]
+                else:
+                    slots['free'].append(words[1])
+            self.runtime_slots[backend_name] = slots
+        return slots
+
+    def _apply_slot_line(self, backend_name, slot, line):
+        if self.config_file is not None:
+            section = self.config_file.get_section('backend', backend_name)
+            if section is not None:
+                section.set_server(slot, line)
+
+    def _set_slot_line(self, backend_name, slot, line):
+        key = (backend_name, slot)
+        lines = self.runtime_slots[backend_name]['lines']
+        old_line = lines.get(slot)
+        old_pending = self.runtime_pending.get(key)
+
+        def undo():
+            lines[slot] = old_line
+            if old_pending is None:
+                self.runtime_pending.pop(key, None)
+            else:
+                self.runtime_pending[key] = old_pending
+        self.runtime_undo.append(undo)
+        lines[slot] = line
+        self.runtime_pending[key] = line
+        self._apply_slot_line(backend_name, slot, line)
+
+    @staticmethod
+    def _free_slot_line(slot):
+        return '\tserver %s 0.0.0.0:80 check disabled' % slot
+
+    @staticmethod
+    def _used_slot_line(slot, haproxy_rserver, rserver_id):
+        return ('\tserver %s %s:%s weight %s maxconn %s check%s # rserver %s' %
+                (slot, haproxy_rserver.address, haproxy_rserver.port,
+                 haproxy_rserver.weight, haproxy_rserver.maxconn,
+                 ' disabled' if haproxy_rserver.disabled else '', rserver_id))
+
+    def _runtime_add_rserver(self, backend_name, haproxy_rserver):
+        slots = self._get_runtime_slots(backend_name)
+        rserver_id = haproxy_rserver.name
+        if rserver_id in slots['used'] or not slots['free']:
+            return False
+        slot = slots['free'].pop(0)
+        slots['used'][rserver_id] = slot
+
+        def undo():
+            slots['used'].pop(rserver_id, None)
+            slots['free'].insert(0, slot)
+        self.runtime_undo.append(undo)
+        logger.debug('[HAPROXY] Filling slot %s/%s with rserver %s' %
+                     (backend_name, slot, rserver_id))
+        batch = self._get_socket_batch()
+        batch.set_server_addr(backend_name, slot, haproxy_rserver.address,
+                              haproxy_rserver.port)
+        batch.set_weight(backend_name, slot, haproxy_rserver.weight)
+        batch.set_server_state(backend_name, slot, 'ready')
+        self._set_slot_line(backend_name, slot,
+                            self._used_slot_line(slot, haproxy_rserver,
+                                                 rserver_id))
+        return True
+
+    def _runtime_delete_rserver(self, backend_name, rserver_id):
+        slots = self._get_runtime_slots(backend_name)
+        slot = slots['used'].pop(rserver_id, None)
+        if slot is None:
+            return False
+        slots['free'].append(slot)
+
+        def undo():
+            slots['free'].remove(slot)
+            slots['used'][rserver_id] = slot
+        self.runtime_undo.append(undo)
+        logger.debug('[HAPROXY] Draining slot %s/%s of rserver %s' %
+                     (backend_name, slot, rserver_id))
+        batch = self._get_socket_batch()
+        batch.set_server_state(backend_name, slot, 'maint')
+        batch.set_server_addr(backend_name, slot, '0.0.0.0', 80)
+        self._set_slot_line(backend_name, slot, self._free_slot_line(slot))
+        return True
+
+    def _runtime_set_rserver_state(self, backend_name, rserver_id, state):
+        slots = self._get_runtime_slots(backend_name)
+        slot = slots['used'].get(rserver_id)
+        if slot is None:
+            return False
+        batch = self._get_socket_batch()
+        batch.set_server_state(backend_name, slot, state)
+        line = slots['lines'].get(slot)
+        if line is not None:
+            line = line.replace(' disabled', '')
+            if state == 'maint':
+                line = line.replace(' # rserver', ' disabled # rserver')
+            self._set_slot_line(backend_name, slot, line)
+        return True
+
+    def _schedule_persist(self):
+        if self.runtime_pending and self.persist_timer is None:
+            self.persist_timer = eventlet.spawn_after(self.persist_delay,
+                                                      self.persist_config)
+
+    def persist_config(self):
+        '''
+            Write runtime changes to the device config without reloading,
+            coalesces all changes made since the last write
+        '''
+        self.persist_timer = None
+        if not self.runtime_pending:
+            return
+        logger.debug('[HAPROXY] Persisting %d runtime changes',
+                     len(self.runtime_pending))
+        with self.request_context():
+            self._load_config()
+            self.config_was_deployed = False
 
     def add_probe_to_server_farm(self, serverfarm, probe):
         '''
@@ -146,24 +427,59 @@ class HaproxyDriver(base_driver.BaseDriver):
     def delete_stickiness(self, sticky):
         pass
 
-    def add_real_server_to_server_farm(self, serverfarm, rserver):
-        haproxy_serverfarm = HaproxyBackend()
-        haproxy_serverfarm.name = serverfarm['id']
+    def _make_haproxy_rserver(self, rserver):
         haproxy_rserver = HaproxyRserver()
         haproxy_rserver.name = rserver['id']
         haproxy_rserver.weight = rserver.get('weight') or 1
         haproxy_rserver.address = rserver['address']
         haproxy_rserver.port = rserver.get('port') or 0
         haproxy_rserver.maxconn = rserver['extra'].get('maxCon') or 10000
+        return haproxy_rserver
+
+    def add_real_server_to_server_farm(self, serverfarm, rserver):
+        haproxy_serverfarm = HaproxyBackend()
+        haproxy_serverfarm.name = serverfarm['id']
+        haproxy_rserver = self._make_haproxy_rserver(rserver)
         #Modify remote config file, check and restart remote haproxy
         logger.debug('[HAPROXY] Creating rserver %s in the '
                      'backend block %s' %
                      (haproxy_rserver.name, haproxy_serverfarm.name))
 
+        if self.runtime_api and self._runtime_add_rserver(
+                haproxy_serverfarm.name, haproxy_rserver):
+            return
         config_file = self._get_config()
         config_file.add_rserver_to_backend_block(haproxy_serverfarm,
                                              haproxy_rserver)
 
+    def add_real_servers_to_server_farm(self, serverfarm, rservers):
+        '''
+        Adds the whole batch either through the runtime API or through
+        the config file. If the backend doesn't have enough free slots for
+        every rserver a reload is needed anyway, so nothing goes through
+        the socket.
+        '''
+        haproxy_serverfarm = HaproxyBackend()
+        haproxy_serverfarm.name = serverfarm['id']
+        haproxy_rservers = map(self._make_haproxy_rserver, rservers)
+        logger.debug('[HAPROXY] Creating %d rservers in the '
+                     'backend block %s' %
+                     (len(haproxy_rservers), haproxy_serverfarm.name))
+        if self.runtime_api:
+            slots = self._get_runtime_slots(haproxy_serverfarm.name)
+            if (len(haproxy_rservers) <= len(slots['free']) and
+                    not [haproxy_rserver
+                         for haproxy_rserver in haproxy_rservers
+                         if haproxy_rserver.name in slots['used']]):
+                for haproxy_rserver in haproxy_rservers:
+                    self._runtime_add_rserver(haproxy_serverfarm.name,
+                                              haproxy_rserver)
+                return
+        config_file = self._get_config()
+        for haproxy_rserver in haproxy_rservers:
+            config_file.add_rserver_to_backend_block(haproxy_serverfarm,
+                                                     haproxy_rserver)
+
     def delete_real_server_from_server_farm(self, serverfarm, rserver):
         haproxy_serverfarm = HaproxyBackend()
         haproxy_serverfarm.name = serverfarm['id']
@@ -173,6 +489,9 @@ class HaproxyDriver(base_driver.BaseDriver):
         logger.debug('[HAPROXY] Deleting rserver %s in the '
                      'backend block %s' %
                      (haproxy_rserver.name, haproxy_serverfarm.name))
+        if self.runtime_api and self._runtime_delete_rserver(
+                haproxy_serverfarm.name, haproxy_rserver.name):
+            return
         config_file = self._get_config()
         config_file.del_rserver_from_backend_block(haproxy_serverfarm,
                                                haproxy_rserver)
@@ -205,6 +524,7 @@ class HaproxyDriver(base_driver.BaseDriver):
         haproxy_virtualserver.name = virtualserver['id']
         haproxy_virtualserver.bind_address = virtualserver['address']
         config_file = self._get_config()
+        config_file.delete_block(haproxy_virtualserver)
         #Check ip for using in the another frontend
         if not config_file.find_string_in_the_block('frontend',
             haproxy_virtualserver.bind_address):
@@ -214,28 +534,29 @@ class HaproxyDriver(base_driver.BaseDriver):
             remote_interface = RemoteInterface(self.device_ref,
                                                haproxy_virtualserver)
             remote_interface.del_ip()
-        config_file.delete_block(haproxy_virtualserver)
 
     def get_statistics(self, serverfarm, rserver):
-        haproxy_rserver = HaproxyRserver()
-        haproxy_rserver.name = rserver['id']
-        haproxy_serverfarm = HaproxyBackend()
-        haproxy_serverfarm.name = serverfarm['id']
-        remote_socket = RemoteSocketOperation(self.device_ref,
-                                        haproxy_serverfarm, haproxy_rserver,
-                                        self.interface, self.haproxy_socket)
-        out = remote_socket.get_statistics()
+        server_name = rserver['id']
+        if self.runtime_api:
+            # Rservers added through the runtime API live in a slot
+            slots = self._get_runtime_slots(serverfarm['id'])
+            server_name = slots['used'].get(server_name, server_name)
+        out = self.run_socket_commands(['show stat'])[0]
+        prefix = '%s,%s,' % (serverfarm['id'], server_name)
         statistics = {}
-        if out:
-            status_line = out.split(",")
+        for line in out.splitlines():
+            if not line.startswith(prefix):
+                continue
+            status_line = line.split(",")
             statistics['weight'] = status_line[18]
             statistics['state'] = status_line[17]
-            statistics['connCurrent'] = [4]
-            statistics['connTotal'] = [7]
-            statistics['connFail'] = [13]
-            statistics['connMax'] = [5]
-            statistics['connRateLimit'] = [34]
-            statistics['bandwRateLimit'] = [35]
+            statistics['connCurrent'] = status_line[4]
+            statistics['connTotal'] = status_line[7]
+            statistics['connFail'] = status_line[13]
+            statistics['connMax'] = status_line[5]
+            statistics['connRateLimit'] = status_line[34]
+            statistics['bandwRateLimit'] = status_line[35]
+            break
 # NOTE: broken because use indeterminate state variable
 #        logger.debug('[HAPROXY] statistics rserver state is \'%s\'',
 #                statistics.state)
@@ -252,19 +573,23 @@ class HaproxyDriver(base_driver.BaseDriver):
         haproxy_rserver.name = rserver['id']
         haproxy_serverfarm = HaproxyBackend()
         haproxy_serverfarm.name = serverfarm['id']
+        if self.runtime_api and self._runtime_set_rserver_state(
+                haproxy_serverfarm.name, haproxy_rserver.name,
+                'maint' if type_of_operation == 'suspend' else 'ready'):
+            return
         config_file = self._get_config()
 
-        remote_socket = RemoteSocketOperation(self.device_ref,
-                                        haproxy_serverfarm, haproxy_rserver,
-                                        self.interface, self.haproxy_socket)
+        socket_batch = self._get_socket_batch()
         if type_of_operation == 'suspend':
             config_file.enable_disable_reserver_in_backend_block(
                              haproxy_serverfarm, haproxy_rserver, 'disable')
-            remote_socket.suspend_server()
+            socket_batch.disable_server(haproxy_serverfarm.name,
+                                        haproxy_rserver.name)
         elif type_of_operation == 'activate':
             config_file.enable_disable_reserver_in_backend_block(
                              haproxy_serverfarm, haproxy_rserver, 'enable')
-            remote_socket.activate_server()
+            socket_batch.enable_server(haproxy_serverfarm.name,
+                                       haproxy_rserver.name)
 
     def create_server_farm(self, serverfarm, predictor):
         if not bool(serverfarm['id']):
@@ -285,6 +610,15 @@ class HaproxyDriver(base_driver.BaseDriver):
 
         config_file = self._get_config()
         config_file.add_backend(haproxy_serverfarm)
+        if self.runtime_api:
+            slots = ['%s%d' % (SLOT_PREFIX, i)
+                     for i in range(1, self.server_slots + 1)]
+            config_file.add_lines_to_backend_block(haproxy_serverfarm,
+                    [self._free_slot_line(slot).strip() for slot in slots])
+            self.runtime_slots[haproxy_serverfarm.name] = {
+                    'free': slots, 'used': {},
+                    'lines': dict((slot, self._free_slot_line(slot))
+                                  for slot in slots)}
 
     def delete_server_farm(self, serverfarm):
         if not bool(serverfarm['id']):
@@ -295,28 +629,115 @@ class HaproxyDriver(base_driver.BaseDriver):
 
         config_file = self._get_config()
         config_file.delete_block(haproxy_serverfarm)
+        self.runtime_slots.pop(haproxy_serverfarm.name, None)
+        for key in self.runtime_pending.keys():
+            if key[0] == haproxy_serverfarm.name:
+                del self.runtime_pending[key]
+
+    def _reload_service(self):
+        '''
+            Apply deployed config with reload_mode, full restart
+            is used only when reload fails or is disabled
+        '''
+        service = RemoteService(self.device_ref,
+                                '%s/%s' % (self.remotepath,
+                                           self.configfilename),
+                                self.pid_file)
+        if self.reload_mode in RemoteService.RELOAD_MODES:
+            if service.reload(self.reload_mode):
+                return True
+            logger.warning('[HAPROXY] %s reload failed, restarting haproxy',
+                           self.reload_mode)
+        elif self.reload_mode != 'restart':
+            logger.error('[HAPROXY] unknown reload mode %s, restarting '
+                         'haproxy', self.reload_mode)
+        return service.restart()
 
     """
        Putting config back on device
     """
     def finalize_config(self, good):
-        if good and not self.config_was_deployed:
-            logger.debug("[HAPROXY] Deploying configuration")
-            remote = RemoteConfig(self.device_ref, self.localpath,
-                                  self.remotepath, self.configfilename)
-            remote.put_config()
-            if remote.validate_config():
-                service = RemoteService(self.device_ref)
-                if service.restart():
-                    self.config_was_deployed = True
-                else:
-                    logger.error("[HAPROXY] failed to restart haproxy")
-                    self.config_was_deployed = False
-            else:
-                logger.error('[HAPROXY] Configurations has failed validation')
+        if not good:
+            # Drop edits of the failed request, keep the ones of
+            # the requests which are waiting for deploy
+            (self.config_file, self.config_was_deployed,
+             self.config_needs_reload) = self.snapshot
+            return True
+        if self.config_file is not None and not self.config_was_deployed:
+            self.deploy_waiter = self.deploy_queue.submit()
+        return True
+
+    def _deploy_config(self):
+        config_file, self.config_file = self.config_file, None
+        if config_file is None or self.config_was_deployed:
+            return True
+        config_hash = config_file.get_hash()
+        if config_hash == self.deployed_hash:
+            logger.debug("[HAPROXY] Configuration is not changed, "
+                         "skipping deploy")
+            self.deploy_counters['skipped'] += 1
+            self._mark_deployed()
+            return True
+        logger.debug("[HAPROXY] Deploying configuration")
+        self.deploy_counters['performed'] += 1
+        config_file.save()
+        if not self._validate_locally(config_file):
+            logger.error('[HAPROXY] Configuration has failed local '
+                         'validation, it is not uploaded')
+            self.config_was_deployed = True
+            return False
+        remote = RemoteConfig(self.device_ref, self.localpath,
+                              self.remotepath, self.configfilename)
+        remote.put_config()
+        # Local haproxy binary already did the same check
+        if (self.local_validation != 'haproxy' and
+                not remote.validate_config()):
+            logger.error('[HAPROXY] Configurations has failed validation')
+            self.config_was_deployed = True
+            return False
+        if not remote.commit_config():
+            self.config_was_deployed = True
+            return False
+        if self.config_needs_reload and not self._reload_service():
+            logger.error("[HAPROXY] failed to restart haproxy")
+            self.config_was_deployed = True
+            return False
+        self.deployed_hash = config_hash
+        self._mark_deployed()
+        return True
+
+    def _validate_locally(self, config_file):
+        '''
+            Check the rendered config before it leaves the host:
+            builtin - structural checks of HaproxyConfigFile,
+            haproxy - local haproxy -c, none - no checks
+        '''
+        if self.local_validation == 'builtin':
+            errors = config_file.validate()
+            for error in errors:
+                logger.error('[HAPROXY] %s', error)
+            return not errors
+        elif self.local_validation == 'haproxy':
+            try:
+                process = subprocess.Popen([self.local_haproxy, '-c', '-f',
+                                            config_file.get_config_file()],
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.STDOUT)
+                out = process.communicate()[0]
+            except OSError, e:
+                logger.error('[HAPROXY] unable to run %s: %s',
+                             self.local_haproxy, e)
                 return False
+            if process.returncode != 0:
+                logger.error('[HAPROXY] local validation failed: %s', out)
+            return process.returncode == 0
         return True
 
+    def _mark_deployed(self):
+        self.config_was_deployed = True
+        self.config_needs_reload = False
+        self.runtime_pending.clear()
+
 
 class HaproxyConfigBlock:
     def __init__(self):
@@ -376,116 +797,176 @@ class HaproxyRserver():
         self.weight = 1
 
 
+class HaproxyConfigSection(object):
+    '''
+        One section (global, defaults, listen, backend, frontend)
+        of haproxy config file. Server lines are indexed by name
+    '''
+    def __init__(self, header):
+        self.header = header
+        words = header.split()
+        self.type = words[0] if words else ''
+        self.name = words[1] if len(words) > 1 else ''
+        self.lines = collections.OrderedDict()
+        self._counter = 0
+
+    def append(self, line):
+        words = line.split()
+        if len(words) > 1 and words[0] == 'server':
+            key = ('server', words[1])
+        else:
+            self._counter += 1
+            key = ('line', self._counter)
+        self.lines[key] = line
+
+    def copy(self):
+        section = HaproxyConfigSection(self.header)
+        section.lines = self.lines.copy()
+        section._counter = self._counter
+        return section
+
+    def get_server(self, name):
+        return self.lines.get(('server', name))
+
+    def set_server(self, name, line):
+        self.lines[('server', name)] = line
+
+    def del_server(self, name):
+        return self.lines.pop(('server', name), None)
+
+    def remove_lines_containing(self, substring):
+        for key, line in self.lines.items():
+            if substring in line:
+                del self.lines[key]
+
+    def contains(self, substring):
+        return any(substring in line for line in self.lines.itervalues())
+
+    def __iter__(self):
+        return self.lines.itervalues()
+
+
 class HaproxyConfigFile:
+    '''
+        Haproxy config file parsed into memory once, sections are kept
+        in their original order and indexed by type and name. Changes are
+        kept in memory until save() writes the file back
+    '''
+    SECTION_TYPES = ('global', 'defaults', 'listen', 'backend', 'frontend')
+
     def __init__(self, haproxy_config_file_path='/tmp/haproxy.cfg'):
         self.haproxy_config_file_path = haproxy_config_file_path
+        self.preamble = []
+        # sections in file order, several defaults sections may share a key
+        self.sections = None
+        # (type, name) -> section, the last one wins like in haproxy
+        self.index = None
 
     def get_config_file(self):
         return self.haproxy_config_file_path
 
+    def copy(self):
+        config_file = HaproxyConfigFile(self.haproxy_config_file_path)
+        if self.sections is not None:
+            config_file.preamble = list(self.preamble)
+            config_file.sections = []
+            config_file.index = {}
+            for section in self.sections:
+                config_file._insert_section(section.copy())
+        return config_file
+
+    def _get_sections(self):
+        if self.sections is None:
+            self._read_config_file()
+        return self.sections
+
+    def _insert_section(self, section):
+        self.sections.append(section)
+        self.index[(section.type, section.name)] = section
+
+    def get_section(self, block_type, name):
+        self._get_sections()
+        return self.index.get((block_type, name))
+
     def add_lines_to_backend_block(self, HaproxyBackend, NewLines):
         '''
              Add lines to backend section config file
         '''
-        new_config_file = self._read_config_file()
         logger.debug('[HAPROXY] add lines to backend %s' % HaproxyBackend.name)
-        for i in new_config_file.keys():
-            if (i.find(HaproxyBackend.type) == 0 and
-                    i.find('%s' % HaproxyBackend.name) >= 0):
-                for j in NewLines:
-                    logger.debug('[HAPROXY] add line \'%s\'' % j)
-                    new_config_file[i].append("\t%s" % j)
-        self._write_config_file(new_config_file)
+        section = self.get_section(HaproxyBackend.type, HaproxyBackend.name)
+        if section is not None:
+            for j in NewLines:
+                logger.debug('[HAPROXY] add line \'%s\'' % j)
+                section.append("\t%s" % j)
 
     def del_lines_from_backend_block(self, HaproxyBackend, DelLines):
         '''
             Delete lines from backend section config file
         '''
-        new_config_file = self._read_config_file()
         logger.debug('[HAPROXY] delete lines from backend %s',
                 HaproxyBackend.name)
-        for i in new_config_file.keys():
-            if (i.find(HaproxyBackend.type) == 0 and
-                    i.find('%s' % HaproxyBackend.name) >= 0):
-                logger.debug('[HAPROXY] found %s' % new_config_file[i])
-                for s in DelLines:
-                    for j in new_config_file[i]:
-                        if j.find(s) >= 0:
-                            logger.debug('[HAPROXY] delete line \'%s\'' % s)
-                            new_config_file[i].remove(j)
-        self._write_config_file(new_config_file)
+        section = self.get_section(HaproxyBackend.type, HaproxyBackend.name)
+        if section is not None:
+            for s in DelLines:
+                logger.debug('[HAPROXY] delete line \'%s\'' % s)
+                section.remove_lines_containing(s)
 
     def add_rserver_to_backend_block(self, HaproxyBackend, HaproxyRserver):
         '''
             Add real server to backend section config file
         '''
-        new_config_file = self._read_config_file()
         logger.debug('[HAPROXY] backend %s rserver %s' % (HaproxyBackend.name,
                                                           HaproxyRserver.name))
         if HaproxyBackend.name == '':
             logger.error('[HAPROXY] Empty backend name')
             return 'BACKEND NAME ERROR'
-        for i in new_config_file.keys():
-            if i.find(HaproxyBackend.type) == 0 and i.find('%s' %
-                                          HaproxyBackend.name) >= 0:
-                new_config_file[i].append('\tserver %s %s:%s %s maxconn %s'
-                                              ' inter %s rise %s fall %s' %
+        section = self.get_section(HaproxyBackend.type, HaproxyBackend.name)
+        if section is not None:
+            section.set_server(HaproxyRserver.name,
+                '\tserver %s %s:%s %s maxconn %s inter %s rise %s fall %s' %
                 (HaproxyRserver.name, HaproxyRserver.address,
                 HaproxyRserver.port, HaproxyRserver.check,
                 HaproxyRserver.maxconn, HaproxyRserver.inter,
                 HaproxyRserver.rise, HaproxyRserver.fall))
-        self._write_config_file(new_config_file)
 
     def del_rserver_from_backend_block(self, HaproxyBackend, HaproxyRserver):
         '''
             Delete real server to backend section config file
         '''
-        new_config_file = self._read_config_file()
         logger.debug('[HAPROXY] From backend %s delete rserver %s' %
                           (HaproxyBackend.name, HaproxyRserver.name))
         if HaproxyBackend.name == '':
             logger.error('[HAPROXY] Empty backend name')
             return 'BACKEND NAME ERROR'
-        for i in new_config_file.keys():
-            if i.find(HaproxyBackend.type) == 0 and i.find('%s' %
-                                         HaproxyBackend.name) >= 0:
-                for j in new_config_file[i]:
-                    logger.debug('[HAPROXY] found %s' % new_config_file[i])
-                    if (j.find('server') >= 0 and
-                        j.find(HaproxyRserver.name) >= 0):
-                        new_config_file[i].remove(j)
-        self._write_config_file(new_config_file)
+        section = self.get_section(HaproxyBackend.type, HaproxyBackend.name)
+        if section is not None:
+            section.del_server(HaproxyRserver.name)
 
     def enable_disable_reserver_in_backend_block(self, HaproxyBackend,
                                 HaproxyRserver, type_of_operation):
         '''
             Disable/Enable server in the backend section config file
         '''
-        new_config_file = self._read_config_file()
         logger.debug('[HAPROXY] backend %s rserver %s' % (HaproxyBackend.name,
                                                           HaproxyRserver.name))
         if HaproxyBackend.name == '':
             logger.error('[HAPROXY] Empty backend name')
             return 'BACKEND NAME ERROR'
-        for i in new_config_file.keys():
-            if i.find(HaproxyBackend.type) == 0 and i.find('%s' %
-                                         HaproxyBackend.name) >= 0:
-                for j in new_config_file[i]:
-                    logger.debug('[HAPROXY] found %s' % new_config_file[i])
-                    if 'server' in j and HaproxyRserver.name in j:
-                        if type_of_operation == 'disable':
-                            tmp_str = ('%s disabled' % j)
-                        elif type_of_operation == 'enable':
-                            tmp_str = j.replace(' disabled', '')
-                        new_config_file[i].remove(j)
-                        new_config_file[i].append(tmp_str)
-        self._write_config_file(new_config_file)
+        section = self.get_section(HaproxyBackend.type, HaproxyBackend.name)
+        if section is None:
+            return
+        line = section.get_server(HaproxyRserver.name)
+        if line is None:
+            return
+        line = line.replace(' disabled', '')
+        if type_of_operation == 'disable':
+            line = '%s disabled' % line
+        section.set_server(HaproxyRserver.name, line)
 
     def add_frontend(self, HaproxyFronted, HaproxyBackend=None):
         '''
             Add frontend section to haproxy config file
         '''
-        new_config_file = self._read_config_file()
         if HaproxyFronted.name == '':
             logger.error('[HAPROXY] Empty fronted name')
             return 'FRONTEND NAME ERROR'
@@ -493,121 +974,131 @@ class HaproxyConfigFile:
             logger.error('[HAPROXY] Empty bind adrress or port')
             return 'FRONTEND ADDRESS OR PORT ERROR'
         logger.debug('[HAPROXY] Adding frontend %s' % HaproxyFronted.name)
-        new_config_block = []
-        new_config_block.append('\tbind %s:%s' % (HaproxyFronted.bind_address,
-                                                     HaproxyFronted.bind_port))
-        new_config_block.append('\tmode %s' % HaproxyFronted.mode)
+        section = self._add_section('frontend %s' % HaproxyFronted.name)
+        section.append('\tbind %s:%s' % (HaproxyFronted.bind_address,
+                                         HaproxyFronted.bind_port))
+        section.append('\tmode %s' % HaproxyFronted.mode)
         if HaproxyBackend is not None:
-            new_config_block.append('\tdefault_backend %s' %
-                                           HaproxyBackend.name)
-        new_config_file['frontend %s' % HaproxyFronted.name] = new_config_block
-        self._write_config_file(new_config_file)
+            section.append('\tdefault_backend %s' % HaproxyBackend.name)
         return HaproxyFronted.name
 
     def delete_block(self, HaproxyBlock):
         '''
             Delete fronend section from haproxy config file
         '''
-        new_config_file = self._read_config_file()
         if HaproxyBlock.name == '':
             logger.error('[HAPROXY] Empty block name')
             return 'BLOCK NAME ERROR'
         logger.debug('[HAPROXY] Try to delete block %s %s' %
                          (HaproxyBlock.type, HaproxyBlock.name))
-        for i in new_config_file.keys():
-            if i.find(HaproxyBlock.type) == 0 and i.find('%s' %
-                                         HaproxyBlock.name) >= 0:
-                logger.debug('[HAPROXY] Delete block %s %s' %
-                          (HaproxyBlock.type, HaproxyBlock.name))
-                del new_config_file[i]
-        self._write_config_file(new_config_file)
+        section = self.get_section(HaproxyBlock.type, HaproxyBlock.name)
+        if section is not None:
+            self.sections.remove(section)
+            del self.index[(section.type, section.name)]
+            logger.debug('[HAPROXY] Delete block %s %s' %
+                      (HaproxyBlock.type, HaproxyBlock.name))
 
     def find_string_in_the_block(self, block_type, check_string):
         """
             Find string in the block
         """
-        new_config_file = self._read_config_file()
-        for i in new_config_file.keys():
-            if (i.find(block_type) == 0 and
-                        new_config_file[i].find(check_string) >= 0):
+        for section in self._get_sections():
+            if section.type == block_type and section.contains(check_string):
                 return True
-            else:
-                return False
+        return False
 
     def add_backend(self, HaproxyBackend):
         '''
             Add backend section to haproxy config file
         '''
-        new_config_file = self._read_config_file()
         if HaproxyBackend.name == '':
             logger.error('[HAPROXY] Empty backend name')
             return 'BACKEND NAME ERROR'
         logger.debug('[HAPROXY] Adding backend')
-        new_config_block = []
-        new_config_block.append('\tbalance %s' % HaproxyBackend.balance)
-        new_config_file['backend %s' % HaproxyBackend.name] =\
-                                                         new_config_block
-        self._write_config_file(new_config_file)
+        section = self._add_section('backend %s' % HaproxyBackend.name)
+        section.append('\tbalance %s' % HaproxyBackend.balance)
         return HaproxyBackend.name
 
+    def _add_section(self, header):
+        section = HaproxyConfigSection(header)
+        old_section = self.get_section(section.type, section.name)
+        if old_section is not None:
+            self.sections.remove(old_section)
+        self._insert_section(section)
+        return section
+
     def _read_config_file(self):
-        haproxy_config_file = open(self.haproxy_config_file_path, 'r')
-        config_file = {}
-        block_name = ''
-        current_block = []
-        for line in haproxy_config_file:
-            if not line.strip():
-                continue
-            tmp_line = line.strip()
-            if tmp_line.find('global') == 0:
-                config_file[block_name] = current_block
-                block_name = line.rstrip()
-                current_block = []
-                continue
-            elif tmp_line.find('defaults') == 0:
-                config_file[block_name] = current_block
-                block_name = line.rstrip()
-                current_block = []
-                continue
-            elif tmp_line.find('listen') == 0:
-                config_file[block_name] = current_block
-                block_name = line.rstrip()
-                current_block = []
-                continue
-            elif tmp_line.find('backend') == 0:
-                config_file[block_name] = current_block
-                block_name = line.rstrip()
-                current_block = []
-                continue
-            elif tmp_line.find('frontend') == 0:
-                config_file[block_name] = current_block
-                block_name = line.rstrip()
-                current_block = []
-                continue
-            else:
-                current_block.append(line.rstrip())
-        #Writing last block
-        config_file[block_name] = current_block
-        haproxy_config_file.close()
-        return config_file
+        self.preamble = []
+        self.sections = []
+        self.index = {}
+        section = None
+        with open(self.haproxy_config_file_path, 'r') as haproxy_config_file:
+            for line in haproxy_config_file:
+                if not line.strip():
+                    continue
+                words = line.split()
+                if words[0] in self.SECTION_TYPES:
+                    section = HaproxyConfigSection(line.rstrip())
+                    self._insert_section(section)
+                elif section is None:
+                    self.preamble.append(line.rstrip())
+                else:
+                    section.append(line.rstrip())
+
+    def render(self):
+        out = list(self.preamble)
+        for section in self._get_sections():
+            out.append(section.header)
+            out.extend(section)
+        return ''.join('%s\n' % l for l in out)
 
-    def _write_config_file(self, config_file):
-        haproxy_config_file = open(self.haproxy_config_file_path, 'w+')
+    def validate(self):
+        '''
+            Structural checks of the config, returns list of errors.
+            Only the things haproxy itself refuses to start with are checked
+        '''
+        errors = []
+        sections = self._get_sections()
+        backends = set(section.name for section in sections
+                       if section.type in ('backend', 'listen'))
+        for section in sections:
+            section_type, name = section.type, section.name
+            if section_type in ('global', 'defaults'):
+                continue
+            if not name:
+                errors.append('%s section without name' % section_type)
+            servers = set()
+            for line in section:
+                words = line.split('#', 1)[0].split()
+                if not words:
+                    continue
+                if words[0] == 'server':
+                    if len(words) < 3:
+                        errors.append('%s %s: incomplete server line "%s"' %
+                                      (section_type, name, line.strip()))
+                    elif words[1] in servers:
+                        errors.append('%s %s: duplicate server %s' %
+                                      (section_type, name, words[1]))
+                    servers.add(words[1] if len(words) > 1 else None)
+                elif (words[0] in ('default_backend', 'use_backend') and
+                        (len(words) < 2 or words[1] not in backends) and
+                        # backend name computed at runtime from a sample
+                        not (len(words) > 1 and '%[' in words[1])):
+                    errors.append('%s %s: unknown backend in "%s"' %
+                                  (section_type, name, line.strip()))
+        return errors
+
+    def get_hash(self):
+        return hashlib.sha1(self.render()).hexdigest()
+
+    def save(self):
+        '''
+            Write the in-memory config back to the file
+        '''
         logger.debug('[HAPROXY] writing configuration to %s' %
                                             self.haproxy_config_file_path)
-        haproxy_config_file.write('global\n')
-        for v in config_file['global']:
-            haproxy_config_file.write('%s\n' % v)
-        del config_file['global']
-        haproxy_config_file.write('defaults\n')
-        for v in config_file['defaults']:
-            haproxy_config_file.write('%s\n' % v)
-        del config_file['defaults']
-        for k, v in sorted(config_file.iteritems()):
-            haproxy_config_file.write('%s\n' % k)
-            for out_line in v:
-                haproxy_config_file.write('%s\n' % out_line)
-        haproxy_config_file.close()
+        with open(self.haproxy_config_file_path, 'w+') as haproxy_config_file:
+            haproxy_config_file.write(self.render())
 
 if __name__ == '__main__':
     pass
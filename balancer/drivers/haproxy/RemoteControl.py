@@ -1,10 +1,135 @@
 import logging
+import pipes
+import re
+import socket
+import threading
+import time
+
 import paramiko
 
 
 logger = logging.getLogger(__name__)
 
 
+class SSHConnectionPool(object):
+    '''
+    Keeps one established SSH connection per device and shares it
+    between all remote operations and green threads
+    '''
+    def __init__(self, keepalive=30, idle_timeout=300):
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._device_locks = {}
+        self._clients = {}
+
+    def _device_lock(self, key):
+        with self._lock:
+            return self._device_locks.setdefault(key, threading.Lock())
+
+    @staticmethod
+    def _is_alive(client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _connect(self, host, user, password):
+        logger.debug('[HAPROXY] opening ssh connection to %s@%s' %
+                     (user, host))
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(host, username=user, password=password)
+        transport = client.get_transport()
+        if transport is not None and self.keepalive:
+            transport.set_keepalive(self.keepalive)
+        return client
+
+    def get(self, host, user, password):
+        self.evict_idle()
+        key = (host, user)
+        with self._device_lock(key):
+            entry = self._clients.get(key)
+            if entry is not None:
+                client = entry[0]
+                if self._is_alive(client):
+                    entry[1] = time.time()
+                    return client
+                logger.debug('[HAPROXY] ssh connection to %s@%s is dead, '
+                             'reconnecting' % (user, host))
+                self._close(client)
+            client = self._connect(host, user, password)
+            self._clients[key] = [client, time.time()]
+            return client
+
+    def invalidate(self, host, user):
+        with self._device_lock((host, user)):
+            entry = self._clients.pop((host, user), None)
+        if entry is not None:
+            self._close(entry[0])
+
+    def evict_idle(self):
+        deadline = time.time() - self.idle_timeout
+        with self._lock:
+            idle = [key for key, (client, last_used) in self._clients.items()
+                    if last_used < deadline]
+            evicted = [self._clients.pop(key)[0] for key in idle]
+        for client in evicted:
+            self._close(client)
+
+    def close_all(self):
+        with self._lock:
+            clients = [client for client, _last in self._clients.values()]
+            self._clients.clear()
+        for client in clients:
+            self._close(client)
+
+    @staticmethod
+    def _close(client):
+        try:
+            client.close()
+        except Exception:
+            logger.exception('[HAPROXY] failed to close ssh connection')
+
+
+SSH_POOL = SSHConnectionPool()
+
+
+class PooledSSHClient(object):
+    '''
+    SSHClient look-alike which borrows the device connection from the pool,
+    close() only hands it back
+    '''
+    def __init__(self, host, user, password, pool=None):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.pool = pool or SSH_POOL
+        self.client = None
+
+    def connect(self):
+        self.client = self.pool.get(self.host, self.user, self.password)
+
+    def close(self):
+        self.client = None
+
+    def _call(self, method, *args):
+        if self.client is None:
+            self.connect()
+        try:
+            return getattr(self.client, method)(*args)
+        except (paramiko.SSHException, socket.error, EOFError), e:
+            logger.warning('[HAPROXY] ssh connection to %s@%s failed: %s, '
+                           'reconnecting' % (self.user, self.host, e))
+            self.pool.invalidate(self.host, self.user)
+            self.connect()
+            return getattr(self.client, method)(*args)
+
+    def exec_command(self, command):
+        return self._call('exec_command', command)
+
+    def open_sftp(self):
+        return self._call('open_sftp')
+
+
 class RemoteConfig(object):
     def __init__(self, device_ref, localpath, remotepath, configfilename):
         self.host = device_ref['ip']
@@ -13,15 +138,15 @@ class RemoteConfig(object):
         self.remotepath = remotepath
         self.configfilename = configfilename
         self.localpath = localpath
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.staging_path = '/tmp/%s.remote' % configfilename
+        self.ssh = PooledSSHClient(self.host, self.user, self.password)
 
     def get_config(self):
         logger.debug('[HAPROXY] copying config from the '
                      'remote server %s/%s to %s/%s' %
                       (self.remotepath, self.configfilename,
                        self.localpath, self.configfilename))
-        self.ssh.connect(self.host, username=self.user, password=self.password)
+        self.ssh.connect()
         sftp = self.ssh.open_sftp()
         sftp.get('%s/%s' % (self.remotepath, self.configfilename),
                  '%s/%s' % (self.localpath, self.configfilename))
@@ -30,23 +155,41 @@ class RemoteConfig(object):
         return True
 
     def put_config(self):
+        '''
+            Upload config to the staging path, the live config
+            is replaced by commit_config only
+        '''
         logger.debug('[HAPROXY] copying configuration to the remote server')
-        self.ssh.connect(self.host, username=self.user, password=self.password)
+        self.ssh.connect()
         sftp = self.ssh.open_sftp()
         sftp.put('%s/%s' % (self.localpath, self.configfilename),
-                 '/tmp/%s.remote' % self.configfilename)
-        self.ssh.exec_command('sudo mv /tmp/%s.remote %s/%s' %
-                               (self.configfilename, self.remotepath,
-                                   self.configfilename))
+                 self.staging_path)
         sftp.close()
         self.ssh.close()
         return True
 
-    def validate_config(self):
-        self.ssh.connect(self.host, username=self.user, password=self.password)
-        stdout = self.ssh.exec_command('haproxy -c -f %s/%s' %
-                                       (self.remotepath,
+    def commit_config(self):
+        '''
+            Atomically replace the live config with the staged one,
+            rename is done within the config directory
+        '''
+        logger.debug('[HAPROXY] installing staged configuration')
+        new_path = '%s/.%s.new' % (self.remotepath, self.configfilename)
+        self.ssh.connect()
+        stdout = self.ssh.exec_command('sudo cp %s %s && sudo mv -f %s %s/%s' %
+                                       (self.staging_path, new_path, new_path,
+                                        self.remotepath,
                                         self.configfilename))[1]
+        status = stdout.channel.recv_exit_status()
+        self.ssh.close()
+        if status != 0:
+            logger.error('[HAPROXY] failed to install configuration')
+        return status == 0
+
+    def validate_config(self):
+        self.ssh.connect()
+        stdout = self.ssh.exec_command('haproxy -c -f %s' %
+                                       self.staging_path)[1]
         ssh_out = stdout.read()
         self.ssh.close()
         logger.debug('[HAPROXY] ssh_out - %s - %s' % (ssh_out,
@@ -63,45 +206,55 @@ class RemoteService(object):
     '''
     Operations with haproxy daemon
     '''
-    def __init__(self, device_ref):
+    RELOAD_MODES = ('soft', 'master-worker', 'service')
+
+    def __init__(self, device_ref, config_path='/etc/haproxy/haproxy.cfg',
+                 pid_file='/var/run/haproxy.pid'):
         self.host = device_ref['ip']
         self.user = device_ref['user']
         self.password = device_ref['password']
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.config_path = config_path
+        self.pid_file = pid_file
+        self.ssh = PooledSSHClient(self.host, self.user, self.password)
 
-    def start(self):
-        self.ssh.connect(self.host, username=self.user, password=self.password)
+    def _run(self, action, command):
+        self.ssh.connect()
 
-        logger.debug('[HAPROXY] starting service haproxy')
-        stdout = self.ssh.exec_command('sudo service haproxy start')[1]
+        logger.debug('[HAPROXY] %s haproxy' % action)
+        stdout = self.ssh.exec_command(command)[1]
         status = stdout.channel.recv_exit_status()
-        logger.debug('[HAPROXY] haproxy start result - {0}'.format(status))
+        logger.debug('[HAPROXY] haproxy {0} result - {1}'.format(action,
+                                                                  status))
 
         self.ssh.close()
         return status == 0
 
-    def stop(self):
-        self.ssh.connect(self.host, username=self.user, password=self.password)
-
-        logger.debug('[HAPROXY] stopping service haproxy')
-        stdout = self.ssh.exec_command('sudo service haproxy stop')[1]
-        status = stdout.channel.recv_exit_status()
-        logger.debug('[HAPROXY] haproxy stop result - {0}'.format(status))
+    def start(self):
+        return self._run('start', 'sudo service haproxy start')
 
-        self.ssh.close()
-        return status == 0
+    def stop(self):
+        return self._run('stop', 'sudo service haproxy stop')
 
     def restart(self):
-        self.ssh.connect(self.host, username=self.user, password=self.password)
+        return self._run('restart', 'sudo service haproxy restart')
 
-        logger.debug('[HAPROXY] restarting haproxy')
-        stdout = self.ssh.exec_command('sudo service haproxy restart')[1]
-        status = stdout.channel.recv_exit_status()
-        logger.debug('[HAPROXY] haproxy restart result - {0}'.format(status))
-
-        self.ssh.close()
-        return status == 0
+    def reload(self, mode='soft'):
+        '''
+            Reload haproxy without dropping established connections:
+            soft - start new process and let the old pids finish (-sf),
+            master-worker - ask the master process to reload (USR2),
+            service - init script reload
+        '''
+        if mode == 'soft':
+            command = ('sudo haproxy -D -f %s -p %s -sf $(cat %s)' %
+                       (self.config_path, self.pid_file, self.pid_file))
+        elif mode == 'master-worker':
+            command = 'sudo kill -USR2 $(cat %s)' % self.pid_file
+        elif mode == 'service':
+            command = 'sudo service haproxy reload'
+        else:
+            raise ValueError('Unknown haproxy reload mode %s' % mode)
+        return self._run('%s reload' % mode, command)
 
 
 class RemoteInterface(object):
@@ -112,11 +265,10 @@ class RemoteInterface(object):
         self.host = device_ref['ip']
         self.user = device_ref['user']
         self.password = device_ref['password']
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.ssh = PooledSSHClient(self.host, self.user, self.password)
 
     def add_ip(self):
-        self.ssh.connect(self.host, username=self.user, password=self.password)
+        self.ssh.connect()
         logger.debug('[HAPROXY] trying to add IP-%s to inteface %s' %
                                 (self.IP,  self.interface))
         stdin, stdout, stderr = self.ssh.exec_command('ip addr show dev %s' %
@@ -134,7 +286,7 @@ class RemoteInterface(object):
         return True
 
     def del_ip(self):
-        self.ssh.connect(self.host, username=self.user, password=self.password)
+        self.ssh.connect()
         stdin, stdout, stderr = self.ssh.exec_command('ip addr show dev %s' %
                                (self.interface))
         ssh_out = stdout.read()
@@ -163,8 +315,7 @@ class RemoteSocketOperation(object):
         self.password = device_ref['password']
         self.backend_name = backend.name
         self.rserver_name = rserver['id']
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.ssh = PooledSSHClient(self.host, self.user, self.password)
 
     def suspend_server(self):
         self._operation_with_server_via_socket('disable')
@@ -175,7 +326,7 @@ class RemoteSocketOperation(object):
         return True
 
     def _operation_with_server_via_socket(self, operation):
-        self.ssh.connect(self.host, username=self.user, password=self.password)
+        self.ssh.connect()
         stdin, stdout, stderr = self.ssh.exec_command(
                 'echo %s server %s/%s | sudo socat stdio unix-connect:%s' %
                 (operation,  self.backend_name,
@@ -194,7 +345,7 @@ class RemoteSocketOperation(object):
             Get statistics from rserver / server farm
             for all serverafarm use BACKEND as self.rserver_name
         """
-        self.ssh.connect(self.host, username=self.user, password=self.password)
+        self.ssh.connect()
         stdin, stdout, stderr = self.ssh.exec_command(
            'echo show stat | sudo socat stdio unix-connect:%s | grep %s,%s ' %
             (self.haproxy_socket, self.backend_name, self.rserver_name))
@@ -204,3 +355,97 @@ class RemoteSocketOperation(object):
                     ssh_out)
         self.ssh.close()
         return ssh_out
+
+
+class RemoteSocketBatch(object):
+    '''
+    Sends a number of commands to the haproxy admin socket
+    over one socket session
+    '''
+    def __init__(self, device_ref, haproxy_socket, mode='semicolon'):
+        if mode not in ('semicolon', 'prompt'):
+            raise ValueError('Unknown haproxy socket mode %s' % mode)
+        self.haproxy_socket = haproxy_socket
+        self.mode = mode
+        self.host = device_ref['ip']
+        self.user = device_ref['user']
+        self.password = device_ref['password']
+        self.ssh = PooledSSHClient(self.host, self.user, self.password)
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def add(self, command):
+        self.commands.append(command)
+
+    def enable_server(self, backend_name, rserver_name):
+        self.add('enable server %s/%s' % (backend_name, rserver_name))
+
+    def disable_server(self, backend_name, rserver_name):
+        self.add('disable server %s/%s' % (backend_name, rserver_name))
+
+    def set_weight(self, backend_name, rserver_name, weight):
+        self.add('set weight %s/%s %s' % (backend_name, rserver_name,
+                                          weight))
+
+    def set_server_addr(self, backend_name, rserver_name, address, port):
+        self.add('set server %s/%s addr %s port %s' % (backend_name,
+                                                     rserver_name, address,
+                                                     port))
+
+    def set_server_state(self, backend_name, rserver_name, state):
+        self.add('set server %s/%s state %s' % (backend_name, rserver_name,
+                                                state))
+
+    def show_stat(self):
+        self.add('show stat')
+
+    def execute(self):
+        '''
+            Run all queued commands, returns the list of
+            per-command outputs in the order commands were added
+        '''
+        commands, self.commands = self.commands, []
+        if not commands:
+            return []
+        if self.mode == 'prompt':
+            payload = 'prompt\n%s\nquit\n' % '\n'.join(commands)
+        else:
+            payload = '%s\n' % ';'.join(commands)
+        self.ssh.connect()
+        stdin, stdout, stderr = self.ssh.exec_command(
+                'printf %%s %s | sudo socat stdio unix-connect:%s' %
+                (pipes.quote(payload), self.haproxy_socket))
+        ssh_out = stdout.read()
+        self.ssh.close()
+        if self.mode == 'prompt':
+            results = self._split_prompt_output(ssh_out, len(commands))
+        else:
+            results = self._split_output(ssh_out, len(commands))
+        for command, result in zip(commands, results):
+            logger.debug('[HAPROXY] socket command "%s". Result is "%s"' %
+                         (command, result or 'ok'))
+        return results
+
+    @staticmethod
+    def _split_output(output, count):
+        # Every response on the admin socket is terminated by an empty line
+        results = []
+        current = []
+        for line in output.split('\n'):
+            if line:
+                current.append(line)
+            elif len(results) < count:
+                results.append('\n'.join(current))
+                current = []
+        results.extend([''] * (count - len(results)))
+        return results
+
+    @staticmethod
+    def _split_prompt_output(output, count):
+        # The first chunk belongs to the "prompt" command itself
+        chunks = re.split(r'(?:^|\n)> ', output)[1:count + 1]
+        results = [chunk.strip('\n') for chunk in chunks]
+        results.extend([''] * (count - len(results)))
+        return results
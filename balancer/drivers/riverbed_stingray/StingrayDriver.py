@@ -1,20 +1,61 @@
 # vim: tabstop=4 shiftwidth=4 softtabstop=4
 
 import logging
+import sys
 import base64
 import urlparse
 import json
 import requests
 
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from requests.exceptions import HTTPError
-from balancer.drivers.base_driver import BaseDriver
+from requests.packages.urllib3.util.retry import Retry
+from openstack.common import exception
+from balancer.core import commands
+from balancer.drivers.base_driver import BaseDriver, DeviceRequestContext
 
 from pprint import pprint
 
 logger = logging.getLogger(__name__)
 
 
+class ObjectConflict(exception.Error):
+    pass
+
+
+class StingrayObject(object):
+    ''' Config object fetched from Stingray during a request context.
+    Edits are applied to properties and collected in changes until they
+    are flushed to the device.
+    '''
+    def __init__(self, properties, etag):
+        self.properties = properties
+        self.etag = etag
+        self.changes = {}
+
+    def update(self, properties):
+        self.properties.update(properties)
+        self.changes.update(properties)
+
+
+class StingrayRequestContextManager(commands.RollbackContextManager):
+    ''' Flushes the objects cached by the driver before the rollback stack
+    is unwound, so a rejected PUT rolls the whole request back
+    '''
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        driver = self.context.device
+        if exc_type is None:
+            try:
+                driver.flush_objects()
+            except Exception:
+                exc_type, exc_value, exc_tb = sys.exc_info()
+        # Rollback edits go to the device right away
+        driver.objects = None
+        return super(StingrayRequestContextManager, self).__exit__(
+                exc_type, exc_value, exc_tb)
+
+
 class StingrayDriver(BaseDriver):
     ''' Most (all?) parameters can be found in db.models.py. They all inherit
     from a class which implements the functions allowing for dictionary
@@ -43,38 +84,90 @@ class StingrayDriver(BaseDriver):
         self.basic_auth = HTTPBasicAuth(device_ref['user'],
                             device_ref['password'])
 
-    def send_request(self, url_extension, method, payload=None):
+        #Connection settings can be tuned through the device extra
+        device_extra = device_ref.get('extra') or {}
+        self.timeout = (float(device_extra.get('connect_timeout') or 10),
+                        float(device_extra.get('read_timeout') or 60))
+        self.session = self.create_session(
+                int(device_extra.get('pool_size') or 4),
+                int(device_extra.get('max_retries') or 3),
+                float(device_extra.get('retry_backoff') or 0.5))
+        #target -> StingrayObject, only set within a request context
+        self.objects = None
+
+    def _request_context(self):
+        ''' Objects read within the context are cached and their edits
+        are sent in one PUT per object when the context ends
+        '''
+        self.objects = {}
+        return StingrayRequestContextManager(
+                DeviceRequestContext(self.conf, self))
+
+    def flush_objects(self):
+        for target in sorted(self.objects):
+            obj = self.objects[target]
+            if obj.changes:
+                self.put_object(target, obj)
+
+    def put_object(self, target, obj):
+        ''' Sends the changes of the object, refusing to overwrite it if it
+        was modified on the device after it had been read
+        '''
+        headers = {}
+        if obj.etag is not None:
+            headers['If-Match'] = obj.etag
+        try:
+            self.send_request(target, 'PUT', {'properties': obj.changes},
+                              headers)
+        except HTTPError as e:
+            if e.response.status_code == 412:
+                raise ObjectConflict('Stingray object %s was modified '
+                                     'concurrently' % (target,))
+            raise
+        obj.changes = {}
+
+    def create_session(self, pool_size, max_retries, retry_backoff):
+        ''' Creates the HTTP session shared by all requests to the device.
+        Connections are kept alive in a pool, idempotent requests (GET, PUT
+        and DELETE) are retried with backoff on connection errors and
+        when the device is unavailable.
+        '''
+        retry = Retry(total=max_retries, backoff_factor=retry_backoff,
+                      status_forcelist=(502, 503, 504),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.auth = self.basic_auth
+        session.verify = False
+        #If-Match not implemented by REST team as of yet
+        session.headers.update({'Content-Type': 'application/json',
+                                'Accept': 'application/json',
+                                'If-Match': 'NEW'})
+        return session
+
+    def send_request(self, url_extension, method, payload=None,
+                     headers=None):
         ''' Wrapper around the python requests library. Ensures that valiidity
         of the SSL certificate is ignored and that requests include HTTP Basic
         Auth.
         '''
         #Generate appropriate url
         target_url = urlparse.urljoin(self.url, url_extension)
-        #Create headers dictionary
-        #If-Match not implemented by REST team as of yet
-        headers = {'Content-Type': 'application/json',
-                    'Accept': 'application/json',
-                    'If-Match': 'NEW'}
 
         logger.debug("Request to Stingray:\n" + method
                         + ':' + str(payload))
+        #Stingray API on wiki explains what method is approprite
+        if method in ('PUT', 'POST'):
+            data = json.dumps(payload)
+        else:
+            data = None
         try:
-            #Send request
-            #Stingray API on wiki explains what method is approprite
-            if method == 'GET':
-                response = requests.get(target_url, headers=headers,
-                                auth=self.basic_auth, verify=False)
-            elif method == 'PUT':
-                response = requests.put(target_url, headers=headers,
-                                data=json.dumps(payload),
-                                auth=self.basic_auth, verify=False)
-            elif method == 'POST':
-                response = requests.post(target_url, headers=headers,
-                                data=json.dumps(payload),
-                                auth=self.basic_auth, verify=False)
-            elif method == 'DELETE':
-                response = requests.delete(target_url, headers=headers,
-                                auth=self.basic_auth, verify=False)
+            #Send request over the pooled connections of the device
+            response = self.session.request(method, target_url, data=data,
+                                            headers=headers,
+                                            timeout=self.timeout)
         except Exception:
             '''Most likely could not reach the specified URL.
             Useful to let errors be passed on to be dealt with in
@@ -88,51 +181,62 @@ class StingrayDriver(BaseDriver):
 
         return response
 
-    def rest_add_to_list(self, target, field_name,
-                            item_to_add, dict_to_add_to):
-        ''' Given a target url, property name and dictionary add the new item
-        to the list stored in field and return the new list in the correct
-        Stingray REST format. Can be used regardless of whether field currently
-        exists.
+    def get_properties(self, target):
+        ''' Returns the properties of the object at target. Within a request
+        context the object is fetched only once and the returned dictionary
+        reflects the edits made so far.
         '''
-        #TODO: Get new version of REST so list syntax used
-        #Requests data from Stingray and extract current list
-        current_json = self.send_request(target, 'GET')
-        current = self.response_to_dict(current_json)
+        if self.objects is not None and target in self.objects:
+            return self.objects[target].properties
+
+        response = self.send_request(target, 'GET')
+        properties = self.response_to_dict(response).get('properties', {})
+        if self.objects is not None:
+            self.objects[target] = StingrayObject(properties,
+                                                  response.headers.get('ETag'))
+        return properties
+
+    def set_properties(self, target, properties):
+        ''' Modifies properties of the object at target. Objects cached in
+        the request context are only modified locally until the context ends.
+        '''
+        if self.objects is not None and target in self.objects:
+            self.objects[target].update(properties)
+        else:
+            self.send_request(target, 'PUT', {'properties': properties})
 
-        try:
-            old_list = current['properties'][field_name]
-        except KeyError:
-            old_list = ''
+    def delete_object(self, target):
+        if self.objects is not None:
+            self.objects.pop(target, None)
+        self.send_request(target, 'DELETE')
+
+    def rest_add_to_list(self, target, field_name, item_to_add):
+        ''' Given a target url and property name add the new item to the
+        list stored in field and return the new list in the correct Stingray
+        REST format. Can be used regardless of whether field currently exists.
+        '''
+        #TODO: Get new version of REST so list syntax used
+        old_list = self.get_properties(target).get(field_name, '')
 
         #Add new node to list (Stored as space seperated variable string)
         new_list = old_list + ' ' + item_to_add
         new_list = new_list.strip()
 
-        #Put in correct dictionary form
-        dict_to_add_to['properties'][field_name] = new_list
+        self.set_properties(target, {field_name: new_list})
+        return new_list
 
-        return dict_to_add_to
-
-    def rest_delete_from_list(self, target, field_name,
-                                item_to_remove, dict_to_remove_from):
-        ''' Given a target url, property name and dictionary removes the item
-        from the list stroed in field and returns the list in the correct
-        Stingray REST format. If not found just returns dictionary with empty
-        list.
+    def rest_delete_from_list(self, target, field_name, item_to_remove):
+        ''' Given a target url and property name removes the item from the
+        list stored in field and returns the list in the correct Stingray REST
+        format. If not found just returns an empty list.
         '''
         #TODO: Get new version of REST so list syntax used.
-        #Requests data from Stingray and extract current list
-        current_json = self.send_request(target, 'GET')
-        current = self.response_to_dict(current_json)
-
-        try:
-            old_list = current['properties'][field_name]
-        except KeyError:
+        old_list = self.get_properties(target).get(field_name)
+        if old_list is None:
             logger.debug('Stingray: No list found, returning empty list')
             old_list = ''
 
-        #remove item and replace list in dictionary
+        #remove item and replace list
         #stripping whitespace means deletions eventually leave empty string
         new_list = old_list.replace(item_to_remove, '').strip()
 
@@ -140,10 +244,8 @@ class StingrayDriver(BaseDriver):
         if new_list == old_list:
             logger.debug('Stingray: Item  ' + item_to_remove
                                             + ' not found in list')
-        #Put in dictionary form
-        dict_to_remove_from['properties'][field_name] = new_list
-
-        return dict_to_remove_from
+        self.set_properties(target, {field_name: new_list})
+        return new_list
 
     def response_to_dict(self, response):
         '''Returns a dictionary of the contents of a response objects body
@@ -237,7 +339,7 @@ class StingrayDriver(BaseDriver):
         '''Remove probe from device
         '''
         target = 'monitors/' + probe['id'] + '/'
-        self.send_request(target, 'DELETE')
+        self.delete_object(target)
 
     def create_server_farm(self, serverfarm, predictor):
         ''' Sets up virtual server and pool and connects the two. Virtual
@@ -283,16 +385,16 @@ class StingrayDriver(BaseDriver):
         '''
         #DELETE request to Pool
         target = 'pools/' + serverfarm['id'] + '/'
-        self.send_request(target, 'DELETE')
+        self.delete_object(target)
 
         #DELETE request to vserver
         target = 'vservers/' + serverfarm['id'] + '/'
-        self.send_request(target, 'DELETE')
+        self.delete_object(target)
 
         #DELETE request to traffic IP group
         try:
             target = 'flipper/' + serverfarm['id'] + '/'
-            self.send_request(target, 'DELETE')
+            self.delete_object(target)
         except HTTPError as e:
             #Traffic IP group may not exist, if so just continue
             if e.response.status_code == 404:
@@ -308,16 +410,9 @@ class StingrayDriver(BaseDriver):
         target = 'pools/' + serverfarm['id'] + '/'
         new_node = rserver['address'] + ':' + rserver['port']
         new_node_weight = new_node + ':' + rserver.get('weight', '1')
-        pool_mod = {'properties': {
-             'nodes': ''
-            }
-        }
 
-        #Modify dictionary and send PUT request with that dictionary
-        pool_mod = self.rest_add_to_list(target, 'nodes', new_node, pool_mod)
-        pool_mod = self.rest_add_to_list(target, 'priority!values',
-                                                    new_node_weight, pool_mod)
-        self.send_request(target, 'PUT', pool_mod)
+        self.rest_add_to_list(target, 'nodes', new_node)
+        self.rest_add_to_list(target, 'priority!values', new_node_weight)
 
     def delete_real_server_from_server_farm(self, serverfarm, rserver):
         '''Remove node from nodelist for pool associated with this serverfarm
@@ -326,49 +421,23 @@ class StingrayDriver(BaseDriver):
         target = 'pools/' + serverfarm['id'] + '/'
         node = rserver['address'] + ':' + rserver['port']
         node_weight = node + ':' + (rserver.get('weight') or '1')
-        pool_mod = {'properties': {
-            'nodes': '',
-            'priority!values': ''
-            }
-        }
-
-        #Modify dictionary and send PUT request with that dictionary
-        pool_mod = self.rest_delete_from_list(target, 'nodes', node, pool_mod)
-        pool_mod = self.rest_delete_from_list(target,
-                                                'priority!values',
-                                                node_weight, pool_mod)
 
-        self.send_request(target, 'PUT', pool_mod)
+        self.rest_delete_from_list(target, 'nodes', node)
+        self.rest_delete_from_list(target, 'priority!values', node_weight)
 
     def add_probe_to_server_farm(self, serverfarm, probe):
         ''' Add the specified probe to the list of monitors for the pool
         associated with this serverfarm
         '''
         target = 'pools/' + serverfarm['id'] + '/'
-
-        node_mod = {
-            'properties': {}
-        }
-
-        #Modify dictionary and send request
-        self.rest_add_to_list(target, 'monitors', probe['id'], node_mod)
-
-        self.send_request(target, 'PUT', node_mod)
+        self.rest_add_to_list(target, 'monitors', probe['id'])
 
     def delete_probe_from_server_farm(self, serverfarm, probe):
         ''' Remove the specified probe from the list of monitors for the
         pool associated with this serverfarm
         '''
         target = 'pools/' + serverfarm['id'] + '/'
-
-        node_mod = {
-            'properties': {}
-        }
-
-        #Modify dictionary and send request
-        node_mod = self.rest_delete_from_list(target, 'monitors',
-                                                probe['id'], node_mod)
-        self.send_request(target, 'PUT', node_mod)
+        self.rest_delete_from_list(target, 'monitors', probe['id'])
 
     def create_virtual_ip(self, vip, serverfarm):
         ''' Add the virtual IP to the traffic IP group associated with this
@@ -380,13 +449,7 @@ class StingrayDriver(BaseDriver):
 
         try:
             #Add IP to existing traffic IP group
-            traffic_ip_mod = {'properties': {
-                'ipaddresses': '',
-                }
-            }
-            traffic_ip_mod = self.rest_add_to_list(target, 'ipaddresses',
-                                            vip['address'], traffic_ip_mod)
-            self.send_request(target, 'PUT', traffic_ip_mod)
+            self.rest_add_to_list(target, 'ipaddresses', vip['address'])
         except HTTPError:
             #No traffic IP group exists, create one
             traffic_ip_new = {'properties': {
@@ -398,11 +461,8 @@ class StingrayDriver(BaseDriver):
 
             #Hook it up to the virtual server
             vserver_target = 'vservers/' + serverfarm['id'] + '/'
-            vserver_mod = {'properties': {
-                        'address': ('!' + serverfarm['id']),
-                }
-            }
-            self.send_request(vserver_target, 'PUT', vserver_mod)
+            self.set_properties(vserver_target,
+                                {'address': ('!' + serverfarm['id'])})
 
     def delete_virtual_ip(self, vip):
         '''Remove the virtual Ip from the traffic IP group associated with
@@ -412,28 +472,16 @@ class StingrayDriver(BaseDriver):
         '''
         target = 'flipper/' + vip['sf_id'] + '/'
 
-        traffic_ip_mod = {'properties': {
-            'ipaddresses': '',
-            }
-        }
-        traffic_ip_mod = self.rest_delete_from_list(target,
-                    'ipaddresses', vip['address'], traffic_ip_mod)
+        ipaddresses = self.rest_delete_from_list(target, 'ipaddresses',
+                                                 vip['address'])
 
-        if traffic_ip_mod['properties']['ipaddresses'] == '':
+        if ipaddresses == '':
             #No more VIPs left in the traffic IP group, delete the group
-            self.send_request(target, 'DELETE')
+            self.delete_object(target)
 
             #Remove group from vserver
             vserver_target = 'vservers/' + vip['sf_id'] + '/'
-            vserver_mod = {'properties': {
-                        'address': ''
-                }
-            }
-            self.send_request(vserver_target, 'PUT', vserver_mod)
-
-        else:
-            #Send request to remove VIP from traffic IP group
-            self.send_request(target, 'PUT', traffic_ip_mod)
+            self.set_properties(vserver_target, {'address': ''})
 
     def suspend_real_server(self, serverfarm, rserver):
         ''' Stop a node from receiving traffic by adding it to disabled
@@ -442,13 +490,7 @@ class StingrayDriver(BaseDriver):
         target = 'pools/' + serverfarm['id'] + '/'
 
         node = rserver['address'] + ':' + rserver['port']
-
-        node_mod = {
-            'properties': {}
-        }
-
-        self.rest_add_to_list(target, 'disabled', node, node_mod)
-        self.send_request(target, 'PUT', node_mod)
+        self.rest_add_to_list(target, 'disabled', node)
 
     def activate_real_server(self, serverfarm, rserver):
         ''' Allow node that was suspended to receive traffic again by removing
@@ -457,14 +499,7 @@ class StingrayDriver(BaseDriver):
         target = 'pools/' + serverfarm['id'] + '/'
 
         node = rserver['address'] + ':' + rserver['port']
-
-        node_mod = {
-            'properties': {}
-        }
-        #Modify dictionary and send requst
-        node_mod = self.rest_delete_from_list(target, 'disabled',
-                                                probe['id'], node_mod)
-        self.send_request(target, 'PUT', node_mod)
+        self.rest_delete_from_list(target, 'disabled', node)
 
     def create_stickiness(self, sticky):
         ''' First create a session persistence class and then associate
@@ -492,13 +527,7 @@ class StingrayDriver(BaseDriver):
 
         #Attach new class to node
         pool_target = 'pools/' + sticky['sf_id'] + '/'
-
-        pool_mod = {'properties': {
-                'persistence': sticky['id']
-            }
-        }
-
-        self.send_request(pool_target, 'PUT', pool_mod)
+        self.set_properties(pool_target, {'persistence': sticky['id']})
 
     def delete_stickiness(self, sticky):
         '''Checks if the persistence class is currently connected to the node,
@@ -507,27 +536,20 @@ class StingrayDriver(BaseDriver):
         '''
         #Check if class is currently connected to the node
         pool_target = 'pools/' + sticky['sf_id'] + '/'
-        response = self.send_request(pool_target, 'GET')
-        pool_dict = self.response_to_dict(response)
+        pool_properties = self.get_properties(pool_target)
 
-        if pool_dict['properties'].get('persistence') == sticky['id']:
+        if pool_properties.get('persistence') == sticky['id']:
             #Set node to using no persistence class
-            pool_mod = {'properties': {
-                'persistence': ''
-                }
-            }
-            self.send_request(pool_target, 'PUT', pool_mod)
+            self.set_properties(pool_target, {'persistence': ''})
         else:
             #Different session persistence class being used, do not modify
             #node
             pass
 
-        self.send_request(pool_target, 'PUT', pool_mod)
-
         #Delete persistance class instance
         pers_target = 'persistence/' + sticky['id'] + '/'
 
-        self.send_request(pers_target, 'DELETE')
+        self.delete_object(pers_target)
 
     ''' Not implemented yet
     '''
@@ -64,3 +64,39 @@ class PredictorNotFound(NotFound):
 
 class VirtualServerNotFound(NotFound):
     message = 'Virtual Server not found'
+
+
+class JobNotFound(NotFound):
+    message = 'Job not found'
+
+
+class JobQueueFull(exception.HTTPServiceUnavailable):
+    message = 'Too many pending jobs for this device type'
+
+    def __init__(self, message=None, **kwargs):
+        super(JobQueueFull, self).__init__(message)
+        self.kwargs = kwargs
+
+
+class BadRequest(exception.HTTPBadRequest):
+    message = 'Bad request'
+
+    def __init__(self, message=None, **kwargs):
+        super(BadRequest, self).__init__(message)
+        self.kwargs = kwargs
+
+
+class InvalidSortKey(BadRequest):
+    message = 'Sort key is not supported'
+
+
+class InvalidSortDir(BadRequest):
+    message = 'Sort direction must be asc or desc'
+
+
+class InvalidLimit(BadRequest):
+    message = 'Limit must be a non-negative integer'
+
+
+class MarkerNotFound(BadRequest):
+    message = 'Marker not found'
@@ -3,6 +3,7 @@ import requests
 import json
 import paramiko
 import re
+import time
 
 config = {'host': '127.0.0.1', 'port': 8181}
 
@@ -120,6 +121,17 @@ class TestCreateLB(unittest.TestCase):
         self.assertIsNone(r.error, 'HTTP error occurred %s' % r.error)
         return r.json
 
+    def _wait_for_job(self, job_id, timeout=60):
+        url = 'http://{0}:{1}/jobs/{2}'.format(config['host'], config['port'],
+            job_id)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            job = requests.get(url).json['job']
+            if job['status'] not in ('QUEUED', 'RUNNING'):
+                return job
+            time.sleep(1)
+        self.fail('Job %s did not finish in %s seconds' % (job_id, timeout))
+
     def _read_haproxy_config(self):
         self.ssh.connect(config_create_device['ip'],
             int(config_create_device['port']),
@@ -158,6 +170,9 @@ class TestCreateLB(unittest.TestCase):
         lb_id = response_lb['loadbalancer']['id']
         self.assertIsNotNone(lb_id, 'lb_id shouldn\'t be empty')
 
+        job = self._wait_for_job(response_lb['job']['id'])
+        self.assertEqual('DONE', job['status'], job['message'])
+
         # validate haproxy config
         haproxy_config = self._read_haproxy_config()
 
@@ -17,7 +17,11 @@
 
 import unittest
 
+import mock
+
 from balancer.drivers.cisco_ace.ace_driver import AceDriver
+from balancer.drivers.cisco_ace.ace_driver import AceCommandError
+from balancer.drivers.cisco_ace.ace_driver import AceRunningConfig
 
 
 class TestDriver(AceDriver):
@@ -646,3 +650,165 @@ class Ace_DriverTestCase(unittest.TestCase):
 
     def test_16b_deleteRServer_typeRedirect(self):
         driver.delete_real_server(rs_redirect)
+
+
+def ace_status(*commands):
+    return ''.join('<config_command>\n<command>\n%s\n</command>\n'
+                   '<status code="%s" text="%s"/>\n</config_command>\n' %
+                   (command, 100 if ok else 1,
+                    'XML_CMD_SUCCESS' if ok else 'Error: ' + command)
+                   for command, ok in commands)
+
+
+class TestAceBatch(unittest.TestCase):
+    def setUp(self):
+        self.driver = AceDriver(conf, dev)
+        self.driver._post = mock.Mock(return_value='XML_CMD_SUCCESS')
+
+    def test_request_context_sends_one_batch(self):
+        with self.driver.request_context():
+            self.driver.create_real_server(rs_host)
+            self.driver.create_probe(probe_dns)
+            self.driver.delete_real_server(rs_redirect)
+            self.assertFalse(self.driver._post.called)
+        self.assertEqual(self.driver._post.call_count, 1)
+        data = self.driver._post.call_args[0][0]
+        self.assertTrue(data.startswith('xml_cmd=<request_raw>\nconfigure\n'))
+        self.assertIn('rserver host LB_test_rs01\n', data)
+        self.assertTrue(data.endswith('no rserver LB_test_rs02\nend\n'
+                                      '</request_raw>'))
+        self.assertEqual(data.count('configure\n'), 3)
+        self.assertIsNone(self.driver.batch)
+
+    def test_outside_request_context(self):
+        self.driver.delete_real_server(rs_host)
+        self.driver.delete_real_server(rs_redirect)
+        self.assertEqual(self.driver._post.call_count, 2)
+
+    def test_get_config_flushes_batch(self):
+        with self.driver.request_context():
+            self.driver.delete_real_server(rs_host)
+            self.driver.getConfig('policy-map global')
+            self.assertEqual(self.driver._post.call_count, 2)
+            self.assertIn('no rserver LB_test_rs01',
+                          self.driver._post.call_args_list[0][0][0])
+        self.assertEqual(self.driver._post.call_count, 2)
+
+    def test_rejected_command_rolls_back(self):
+        self.driver._post.return_value = ace_status(
+            ('configure', True), ('no rserver LB_test_rs01', True),
+            ('end', True), ('configure', True),
+            ('no rserver LB_test_rs02', False), ('end', True))
+        rollback = mock.Mock()
+
+        def request():
+            with self.driver.request_context() as ctx:
+                ctx.add_rollback(rollback)
+                self.driver.delete_real_server(rs_host)
+                self.driver.delete_real_server(rs_redirect)
+
+        self.assertRaises(AceCommandError, request)
+        rollback.assert_called_once_with(False)
+        self.assertFalse(self.driver.lock.locked())
+
+    def test_get_failed_fragments(self):
+        fragments = ['rserver host rs1\nip address 10.0.0.1',
+                     'rserver host rs2\nip address 10.0.0.2']
+        response = ace_status(
+            ('configure', True), ('rserver host rs1', True),
+            ('ip address 10.0.0.1', True), ('end', True),
+            ('configure', True), ('rserver host rs2', True),
+            ('ip address 10.0.0.2', False), ('end', True))
+        self.assertEqual(self.driver.get_failed_fragments(response,
+                                                          fragments),
+                         [(fragments[1], 'Error: ip address 10.0.0.2')])
+        self.assertEqual(self.driver.get_failed_fragments(
+                             'XML_CMD_SUCCESS', fragments), [])
+        self.assertEqual(len(self.driver.get_failed_fragments(
+                             'Error', fragments)), 2)
+
+    @mock.patch('httplib.HTTPSConnection')
+    def test_connection_is_kept_alive(self, mock_connection):
+        driver = AceDriver(conf, dev)
+        response = mock_connection.return_value.getresponse.return_value
+        response.status = 200
+        response.read.return_value = 'XML_CMD_SUCCESS'
+        driver.deployConfig('rserver host rs1')
+        driver.deployConfig('rserver host rs2')
+        mock_connection.assert_called_once_with('10.4.15.21', 10443)
+        self.assertEqual(mock_connection.return_value.request.call_count, 2)
+
+
+running_config = """<response_xml>
+Generating configuration....
+interface vlan 200
+  ip address 10.0.0.2 255.255.255.0
+  nat-pool 1 10.0.0.250 10.0.0.251 netmask 255.255.255.0 pat
+  nat-pool 3 10.0.0.252 netmask 255.255.255.0
+  service-policy input global
+interface vlan 400
+  ip address 10.1.0.2 255.255.255.0
+class-map match-all vip1
+  2 match virtual-address 10.0.0.10 255.255.255.255 tcp eq www
+policy-map type loadbalance first-match vip1-l7slb
+  class class-default
+    serverfarm sf1
+policy-map multi-match global
+  class vip1
+    loadbalance vip inservice
+policy-map multi-match int-empty
+</response_xml>
+"""
+
+
+class TestAceRunningConfig(unittest.TestCase):
+    def setUp(self):
+        self.driver = AceDriver(conf, dev)
+        self.driver._post = mock.Mock(return_value=running_config)
+
+    def test_parse(self):
+        config = AceRunningConfig(running_config)
+        self.assertEqual(sorted(config.interfaces), ['200', '400'])
+        self.assertEqual(config.nat_pools, [
+            {'vlan': '200', 'id': '1', 'ip1': '10.0.0.250',
+             'ip2': '10.0.0.251', 'netmask': '255.255.255.0', 'pat': True},
+            {'vlan': '200', 'id': '3', 'ip1': '10.0.0.252',
+             'ip2': '10.0.0.252', 'netmask': '255.255.255.0'},
+        ])
+        self.assertEqual(config.get_nat_pool_ids(), set(['1', '3']))
+        self.assertEqual(sorted(config.class_maps), ['vip1'])
+        self.assertEqual(sorted(config.policy_maps),
+                         ['global', 'int-empty', 'vip1-l7slb'])
+        self.assertTrue(config.policy_map_has_classes('global'))
+        self.assertFalse(config.policy_map_has_classes('int-empty'))
+        self.assertFalse(config.policy_map_has_classes('unknown'))
+
+    def test_snapshot_is_cached(self):
+        vip = {'address': '10.0.0.10', 'mask': '255.255.255.0',
+               'ipVersion': 'IPv4', 'extra': {'VLAN': ['200']}}
+        self.assertEqual(self.driver.find_nat_pool_for_vip(vip)['id'], '1')
+        nat_pool = self.driver.generate_nat_pool_for_vip(vip)
+        self.assertEqual(nat_pool['id'], 2)
+        self.assertEqual(nat_pool['ip1'], '10.0.0.254')
+        self.assertEqual(self.driver._post.call_count, 1)
+
+    def test_snapshot_expires(self):
+        self.driver.running_config_ttl = 10
+        with mock.patch('time.time') as mock_time:
+            mock_time.return_value = 100
+            self.driver.get_nat_pools()
+            mock_time.return_value = 105
+            self.driver.get_nat_pools()
+            self.assertEqual(self.driver._post.call_count, 1)
+            mock_time.return_value = 111
+            self.driver.get_nat_pools()
+            self.assertEqual(self.driver._post.call_count, 2)
+
+    def test_snapshot_invalidated_by_writes(self):
+        self.driver.get_running_config()
+        self.driver.create_real_server(rs_host)
+        self.assertIsNotNone(self.driver.running_config)
+        self.driver.delete_nat_pool({'vlan': '200', 'id': '3'})
+        self.assertIsNone(self.driver.running_config)
+        self.driver.get_running_config()
+        self.assertEqual(self.driver._post.call_count, 4)
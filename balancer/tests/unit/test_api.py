@@ -9,6 +9,7 @@ from balancer.api.v1 import vips
 from balancer.api.v1 import probes
 from balancer.api.v1 import stickies
 from balancer.api.v1 import devices
+from balancer.api.v1 import jobs
 from balancer.api.v1 import router
 
 LOG = logging.getLogger()
@@ -41,6 +42,7 @@ class TestLoadBalancersController(unittest.TestCase):
     def test_index(self, mock_lb_get_index):
         mock_lb_get_index.return_value = 'foo'
         self.req.headers = {'X-Tenant-Id': 'fake_tenant_id'}
+        self.req.GET = {}
         resp = self.controller.index(self.req)
         self.assertTrue(mock_lb_get_index.called)
         mock_lb_get_index.assert_called_once_with(
@@ -48,25 +50,55 @@ class TestLoadBalancersController(unittest.TestCase):
                                     self.req.headers.get('X-Tenant-Id', ""))
         self.assertEqual(resp, {'loadbalancers': 'foo'})
 
+    @mock.patch('balancer.core.api.lb_get_index', autospec=True)
+    def test_index_paginated(self, mock_lb_get_index):
+        mock_lb_get_index.return_value = 'foo'
+        self.req.headers = {'X-Tenant-Id': 'fake_tenant_id'}
+        self.req.GET = {'marker': '1', 'limit': '10', 'sort_key': 'name',
+                        'sort_dir': 'desc', 'status': 'ACTIVE'}
+        resp = self.controller.index(self.req)
+        mock_lb_get_index.assert_called_once_with(self.conf,
+                'fake_tenant_id', marker='1', limit=10, sort_key='name',
+                sort_dir='desc', filters={'status': 'ACTIVE'})
+        self.assertEqual(resp, {'loadbalancers': 'foo'})
+
+    def test_index_invalid_limit(self):
+        self.req.GET = {'limit': 'many'}
+        self.assertRaises(exception.InvalidLimit, self.controller.index,
+                          self.req)
+
+    @mock.patch('balancer.core.api.lb_get_index_details', autospec=True)
+    def test_detail(self, mock_lb_get_index_details):
+        mock_lb_get_index_details.return_value = 'foo'
+        self.req.headers = {'X-Tenant-Id': 'fake_tenant_id'}
+        self.req.GET.getall.return_value = ['1', '2']
+        resp = self.controller.detail(self.req)
+        self.req.GET.getall.assert_called_once_with('id')
+        mock_lb_get_index_details.assert_called_once_with(
+                self.conf, 'fake_tenant_id', ['1', '2'])
+        self.assertEqual(resp, {'loadbalancers': 'foo'})
+
     @mock.patch('balancer.core.api.create_lb', autospec=True)
     def test_create(self, mock_create_lb):
-        mock_create_lb.return_value = '1'
+        mock_create_lb.return_value = {'id': '2', 'lb_id': '1'}
         self.req.headers = {'X-Tenant-Id': 'fake_tenant_id'}
         resp = self.controller.create(self.req, {})
         self.assertTrue(mock_create_lb.called)
         mock_create_lb.assert_called_once_with(
                     self.conf,
                     {'tenant_id': self.req.headers.get('X-Tenant-Id', "")})
-        self.assertEqual(resp, {'loadbalancer': {'id': '1'}})
+        self.assertEqual(resp, {'loadbalancer': {'id': '1'},
+                                'job': {'id': '2'}})
         self.code_assert(202, self.controller.create)
 
     @mock.patch('balancer.core.api.delete_lb', autospec=True)
     def test_delete(self, mock_delete_lb):
+        mock_delete_lb.return_value = {'id': '2', 'lb_id': 1}
         resp = self.controller.delete(self.req, 1)
         self.assertTrue(mock_delete_lb.called)
-        self.code_assert(204, self.controller.delete)
+        self.code_assert(202, self.controller.delete)
         mock_delete_lb.assert_called_once_with(self.conf, 1)
-        self.assertEqual(resp, None)
+        self.assertEqual(resp, {'job': {'id': '2'}})
 
     @mock.patch('balancer.core.api.lb_get_data', autospec=True)
     def test_show(self, mock_lb_get_data):
@@ -86,11 +118,13 @@ class TestLoadBalancersController(unittest.TestCase):
 
     @mock.patch('balancer.core.api.update_lb', autospec=True)
     def test_update(self, mock_update_lb):
+        mock_update_lb.return_value = {'id': '2', 'lb_id': 1}
         resp = self.controller.update(self.req, 1, {})
         self.assertTrue(mock_update_lb.called)
         self.code_assert(202, self.controller.update)
         mock_update_lb.assert_called_once_with(self.conf, 1, {})
-        self.assertEquals(resp, {"loadbalancer": {"id": 1}})
+        self.assertEquals(resp, {"loadbalancer": {"id": 1},
+                                 "job": {"id": "2"}})
 
 
 class TestNodesController(unittest.TestCase):
@@ -118,9 +152,11 @@ class TestNodesController(unittest.TestCase):
     @mock.patch('balancer.core.api.lb_show_nodes', autospec=True)
     def test_index(self, mock_lb_show_nodes):
         mock_lb_show_nodes.return_value = 'foo'
+        self.req.GET = {'limit': '2', 'address': '10.0.0.1'}
         resp = self.controller.index(self.req, 1)
         self.assertTrue(mock_lb_show_nodes.called)
-        mock_lb_show_nodes.assert_called_once_with(self.conf, 1)
+        mock_lb_show_nodes.assert_called_once_with(self.conf, 1, limit=2,
+                filters={'address': '10.0.0.1'})
         self.assertEqual(resp, {'nodes': 'foo'})
 
     @mock.patch("balancer.db.api.server_get")
@@ -143,6 +179,14 @@ class TestNodesController(unittest.TestCase):
         self.assertEqual(resp, None)
         self.code_assert(204, self.controller.delete)
 
+    @mock.patch('balancer.core.api.lb_delete_nodes', autospec=True)
+    def test_delete_nodes(self, mock_lb_delete_nodes):
+        body = {'nodes': [{'id': 1}, {'id': 2}]}
+        resp = self.controller.deleteNodes(self.req, 1, body)
+        mock_lb_delete_nodes.assert_called_once_with(self.conf, 1, [1, 2])
+        self.assertEqual(resp, None)
+        self.code_assert(204, self.controller.deleteNodes)
+
     @mock.patch('balancer.core.api.lb_change_node_status', autospec=True)
     def test_change_node_status(self, mock_lb_change_node_status):
         mock_lb_change_node_status.return_value = {'nodeID': '1',
@@ -402,6 +446,20 @@ class TestDeviceController(unittest.TestCase):
         self.assertTrue(mock_core_api.called)
 
 
+class TestJobsController(unittest.TestCase):
+    def setUp(self):
+        self.conf = mock.Mock()
+        self.controller = jobs.Controller(self.conf)
+        self.req = mock.Mock()
+
+    @mock.patch('balancer.db.api.job_get', autospec=True)
+    def test_show(self, mock_job_get):
+        mock_job_get.return_value.to_dict.return_value = 'foo'
+        resp = self.controller.show(self.req, 1)
+        mock_job_get.assert_called_once_with(self.conf, 1)
+        self.assertEqual({'job': 'foo'}, resp)
+
+
 class TestRouter(unittest.TestCase):
     def setUp(self):
         config = mock.MagicMock(spec=dict)
@@ -416,6 +474,8 @@ class TestRouter(unittest.TestCase):
                 "show"),
             ("/loadbalancers/{id}/details", "GET", loadbalancers.Controller,
                 "details"),
+            ("/loadbalancers/detail", "GET", loadbalancers.Controller,
+                "detail"),
             ("/loadbalancers/{id}", "DELETE", loadbalancers.Controller,
                 "delete"),
             ("/loadbalancers/{id}", "PUT", loadbalancers.Controller,
@@ -424,6 +484,8 @@ class TestRouter(unittest.TestCase):
                 "create"),
             ("/loadbalancers/{lb_id}/nodes", "GET", nodes.Controller,
                 "index"),
+            ("/loadbalancers/{lb_id}/nodes", "DELETE", nodes.Controller,
+                "deleteNodes"),
             ("/loadbalancers/{lb_id}/nodes/{id}", "DELETE",
                 nodes.Controller, "delete"),
             ("/loadbalancers/{lb_id}/nodes/{id}", "GET",
@@ -465,6 +527,7 @@ class TestRouter(unittest.TestCase):
             ("/devices/{id}/info", "GET", devices.Controller, "info"),
             ("/devices", "POST", devices.Controller, "create"),
             ("/devices/{id}", "DELETE", devices.Controller, "delete"),
+            ("/jobs/{id}", "GET", jobs.Controller, "show"),
         )
         for url, method, controller, action in list_of_methods:
             LOG.info('Verifying %s to %s', method, url)
@@ -477,7 +540,7 @@ class TestRouter(unittest.TestCase):
                 controller))
             self.assertEquals(action0, action)
             mok = mock.mocksignature(getattr(controller, action))
-            if method == "POST" or method == "PUT":
+            if method in ("POST", "PUT") or action == "deleteNodes":
                 m['body'] = {}
             try:
                 mok('SELF', 'REQUEST', **m)
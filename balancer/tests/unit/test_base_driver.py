@@ -2,6 +2,7 @@ import unittest
 import mock
 
 from .test_db_api import device_fake1
+from balancer import drivers
 from balancer.drivers.base_driver import BaseDriver
 
 
@@ -24,3 +25,113 @@ class TestBaseDriver(unittest.TestCase):
         base_driver = BaseDriver(self.conf, device_fake1)
         self.assertDictEqual(base_driver.get_capabilities(),
                              capabilities['capabilities'])
+
+    def test_request_context_lock(self):
+        base_driver = BaseDriver(self.conf, device_fake1)
+        with base_driver.request_context():
+            self.assertTrue(base_driver.lock.locked())
+        self.assertFalse(base_driver.lock.locked())
+
+    def test_request_context_lock_released_on_error(self):
+        base_driver = BaseDriver(self.conf, device_fake1)
+
+        def fail():
+            with base_driver.request_context():
+                raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        self.assertFalse(base_driver.lock.locked())
+
+
+class FakeDriver(BaseDriver):
+    pass
+
+
+class TestDriverRegistry(unittest.TestCase):
+    def setUp(self):
+        super(TestDriverRegistry, self).setUp()
+        self.conf = mock.Mock()
+        self.conf.device_drivers_cache_size = 2
+        self.conf.device_drivers = [
+            'fake=balancer.tests.unit.test_base_driver.FakeDriver']
+        drivers.DRIVER_CLASSES = None
+        drivers.DEVICE_DRIVERS.clear()
+        drivers.DEVICE_LOCKS.clear()
+        drivers.STALE_DRIVERS.clear()
+        self.patcher = mock.patch('balancer.db.api.device_get')
+        self.device_get = self.patcher.start()
+        self.device_get.side_effect = lambda conf, device_id: {
+            'id': device_id, 'type': 'FAKE'}
+
+    def tearDown(self):
+        self.patcher.stop()
+        drivers.DRIVER_CLASSES = None
+        drivers.DEVICE_DRIVERS.clear()
+        drivers.DEVICE_LOCKS.clear()
+        drivers.STALE_DRIVERS.clear()
+
+    def test_get_device_driver(self):
+        driver = drivers.get_device_driver(self.conf, 'dev1')
+        self.assertIsInstance(driver, FakeDriver)
+        self.assertEqual(driver.device_ref['id'], 'dev1')
+        self.assertIs(drivers.get_device_driver(self.conf, 'dev1'), driver)
+        self.assertEqual(self.device_get.call_count, 1)
+
+    @mock.patch('balancer.common.utils.import_class')
+    def test_classes_resolved_once(self, mock_import):
+        mock_import.return_value = FakeDriver
+        drivers.get_device_driver(self.conf, 'dev1')
+        drivers.get_device_driver(self.conf, 'dev2')
+        self.assertEqual(mock_import.call_count, 1)
+
+    def test_unknown_type(self):
+        self.device_get.side_effect = None
+        self.device_get.return_value = {'id': 'dev1', 'type': 'unknown'}
+        self.assertRaises(NotImplementedError, drivers.get_device_driver,
+                          self.conf, 'dev1')
+
+    def test_lru_eviction(self):
+        driver1 = drivers.get_device_driver(self.conf, 'dev1')
+        drivers.get_device_driver(self.conf, 'dev2')
+        # dev1 becomes the most recently used, dev2 is evicted by dev3
+        drivers.get_device_driver(self.conf, 'dev1')
+        drivers.get_device_driver(self.conf, 'dev3')
+        self.assertEqual(list(drivers.DEVICE_DRIVERS), ['dev1', 'dev3'])
+        self.assertIs(drivers.get_device_driver(self.conf, 'dev1'), driver1)
+
+    def test_invalidate(self):
+        driver1 = drivers.get_device_driver(self.conf, 'dev1')
+        drivers.invalidate_device_driver('dev1')
+        driver2 = drivers.get_device_driver(self.conf, 'dev1')
+        self.assertIsNot(driver2, driver1)
+        self.assertEqual(self.device_get.call_count, 2)
+        # the new driver still waits for requests on the old one
+        self.assertIs(driver2.lock, driver1.lock)
+
+    def test_lru_eviction_skips_drivers_in_use(self):
+        driver1 = drivers.get_device_driver(self.conf, 'dev1')
+        driver1.lock.acquire()
+        drivers.get_device_driver(self.conf, 'dev2')
+        drivers.get_device_driver(self.conf, 'dev3')
+        self.assertEqual(list(drivers.DEVICE_DRIVERS), ['dev1', 'dev3'])
+        drivers.get_device_driver(self.conf, 'dev4')
+        self.assertEqual(list(drivers.DEVICE_DRIVERS), ['dev1', 'dev4'])
+        driver1.lock.release()
+        drivers.get_device_driver(self.conf, 'dev5')
+        self.assertEqual(list(drivers.DEVICE_DRIVERS), ['dev4', 'dev5'])
+
+    def test_invalidate_driver_in_use(self):
+        driver1 = drivers.get_device_driver(self.conf, 'dev1')
+        driver1.lock.acquire()
+        drivers.invalidate_device_driver('dev1')
+        self.assertIs(drivers.get_device_driver(self.conf, 'dev1'), driver1)
+        driver1.lock.release()
+        driver2 = drivers.get_device_driver(self.conf, 'dev1')
+        self.assertIsNot(driver2, driver1)
+        self.assertIs(drivers.get_device_driver(self.conf, 'dev1'), driver2)
+
+    def test_device_deleted(self):
+        drivers.get_device_driver(self.conf, 'dev1')
+        drivers.device_deleted('dev1')
+        self.assertNotIn('dev1', drivers.DEVICE_DRIVERS)
+        self.assertNotIn('dev1', drivers.DEVICE_LOCKS)
@@ -210,6 +210,61 @@ class TestRserver(unittest.TestCase):
         self.assertFalse(mock_f1.called, "server_update called")
 
 
+class TestBulkCreate(unittest.TestCase):
+    def setUp(self):
+        self.ctx = mock.MagicMock()
+        self.sf = mock.MagicMock()
+
+    @mock.patch("balancer.db.api.server_update_many")
+    def test_create_rservers(self, mock_upd):
+        rss = [{'id': 1, 'parent_id': None}, {'id': 2, 'parent_id': 1}]
+        cmd.create_rservers(self.ctx, rss)
+        self.ctx.device.create_real_server.assert_called_once_with(rss[0])
+        mock_upd.assert_called_once_with(self.ctx.conf, [rss[0]],
+                                         {'deployed': 'True'})
+
+    @mock.patch("balancer.db.api.server_update_many")
+    def test_create_rservers_rollback(self, mock_upd):
+        rss = [{'id': 1, 'parent_id': None}, {'id': 2, 'parent_id': None}]
+
+        def create_real_server(rs):
+            if rs['id'] == 2:
+                raise Exception()
+        self.ctx.device.create_real_server.side_effect = create_real_server
+        self.assertRaises(Exception, cmd.create_rservers, self.ctx, rss)
+        self.ctx.device.delete_real_server.assert_called_once_with(rss[0])
+        mock_upd.assert_called_once_with(self.ctx.conf, [rss[0]],
+                                         {'deployed': 'False'})
+
+    @mock.patch("balancer.db.api.probe_update_many")
+    def test_create_probes(self, mock_upd):
+        probes = [mock.MagicMock(), mock.MagicMock()]
+        cmd.create_probes(self.ctx, probes)
+        self.assertEqual(self.ctx.device.create_probe.call_args_list,
+                         [mock.call(probe) for probe in probes])
+        mock_upd.assert_called_once_with(self.ctx.conf, probes,
+                                         {'deployed': True})
+
+    @mock.patch("balancer.core.commands.delete_probe")
+    @mock.patch("balancer.db.api.probe_update_many")
+    def test_create_probes_rollback(self, mock_upd, mock_delete):
+        probes = [mock.MagicMock(), mock.MagicMock()]
+        cmd.create_probes(self.ctx, probes)
+        rollback_fn = self.ctx.add_rollback.call_args[0][0]
+        rollback_fn(False)
+        self.assertEqual(mock_delete.call_args_list,
+                         [mock.call(self.ctx, probe) for probe in probes])
+
+    @mock.patch("balancer.db.api.virtualserver_update_many")
+    def test_create_vips(self, mock_upd):
+        vips = [mock.MagicMock(), mock.MagicMock()]
+        cmd.create_vips(self.ctx, vips, self.sf)
+        self.assertEqual(self.ctx.device.create_virtual_ip.call_args_list,
+                         [mock.call(vip, self.sf) for vip in vips])
+        mock_upd.assert_called_once_with(self.ctx.conf, vips,
+                                         {'deployed': True})
+
+
 class TestSticky(unittest.TestCase):
     def setUp(self):
         self.ctx = mock.MagicMock()
@@ -377,6 +432,29 @@ class TestServerFarm(unittest.TestCase):
                 self.ctx.device.delete_real_server_from_server_farm.called,
                 "method not called")
 
+    def test_add_rservers_to_server_farm_0(self):
+        "No exception"
+        rservers = [self.rserver, mock.MagicMock()]
+        cmd.add_rservers_to_server_farm(self.ctx, self.server_farm, rservers)
+        self.ctx.device.add_real_servers_to_server_farm.\
+                assert_called_once_with(self.server_farm, rservers)
+
+    def test_add_rservers_to_server_farm_1(self):
+        "Exception"
+        rservers = [self.rserver]
+        cmd.add_rservers_to_server_farm(self.ctx, self.server_farm, rservers)
+        rollback_fn = self.ctx.add_rollback.call_args[0][0]
+        rollback_fn(False)
+        self.ctx.device.delete_real_servers_from_server_farm.\
+                assert_called_once_with(self.server_farm, rservers)
+
+    def test_delete_rservers_from_server_farm(self):
+        rservers = [self.rserver]
+        cmd.delete_rservers_from_server_farm(self.ctx, self.server_farm,
+                                             rservers)
+        self.ctx.device.delete_real_servers_from_server_farm.\
+                assert_called_once_with(self.server_farm, rservers)
+
     def test_add_probe_to_server_farm_0(self):
         "No exception"
         cmd.add_probe_to_server_farm(self.ctx, self.server_farm, self.probe)
@@ -427,114 +505,77 @@ class TestLoadbalancer(unittest.TestCase):
         self.dictionary = {'id': 1, 'name': 'name', 'extra': {
             'stragearg': value, 'anotherarg': value}, }
 
-    @mock.patch("balancer.db.api.virtualserver_pack_extra")
-    @mock.patch("balancer.db.api.virtualserver_create")
-    @mock.patch("balancer.core.commands.create_vip")
-    @mock.patch("balancer.core.commands.create_server_farm")
-    @mock.patch("balancer.db.api.predictor_create")
-    @mock.patch("balancer.db.api.serverfarm_create")
-    @mock.patch("balancer.db.api.server_pack_extra")
-    @mock.patch("balancer.db.api.server_create")
-    @mock.patch("balancer.core.commands.create_rserver")
-    @mock.patch("balancer.core.commands.add_rserver_to_server_farm")
-    @mock.patch("balancer.db.api.probe_pack_extra")
-    @mock.patch("balancer.db.api.probe_create")
-    @mock.patch("balancer.core.commands.create_probe")
-    @mock.patch("balancer.core.commands.add_probe_to_server_farm")
-    @mock.patch("balancer.db.api.unpack_extra")
-    def test_create_loadbalancer_0(self, *mocks):
+    def _create_loadbalancer(self, nodes, probes, vips):
+        names = ("db.api.serverfarm_create", "db.api.predictor_create",
+                 "core.commands.create_server_farm",
+                 "db.api.server_create_many", "core.commands.create_rservers",
+                 "core.commands.add_rservers_to_server_farm",
+                 "db.api.probe_create_many", "core.commands.create_probes",
+                 "core.commands.add_probe_to_server_farm",
+                 "db.api.virtualserver_create_many",
+                 "core.commands.create_vips")
+        patchers = [mock.patch("balancer." + name) for name in names]
+        mocks = dict((name.split('.')[-1], patcher.start())
+                     for name, patcher in zip(names, patchers))
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+        mocks['probe_create_many'].return_value = ['probe1', 'probe2']
+        cmd.create_loadbalancer(self.ctx, self.dictionary, nodes, probes,
+                                vips)
+        return mocks
+
+    def test_create_loadbalancer_0(self):
         """All here"""
-        mocks[0].return_value = {'id': 1,
-            'nodes': [{'name': 'node0'}, {'name': 'node1'}],
-            'healthMonitoring': [{'name': 'probe0'}, {"name": "probe1"}],
-            'virtualIps': [{'name': "vip0"}, {'name': "vip1"}]}
-        cmd.create_loadbalancer(self.ctx, self.balancer, self.dict_list,
-                self.dict_list, self.dict_list)
-        for mok in mocks:
-            self.assertTrue(mok.called, "This mock didn't call %s"
-                    % mok._mock_name)
-
-    @mock.patch("balancer.db.api.virtualserver_pack_extra")
-    @mock.patch("balancer.db.api.virtualserver_create")
-    @mock.patch("balancer.core.commands.create_vip")
-    @mock.patch("balancer.core.commands.create_server_farm")
-    @mock.patch("balancer.db.api.predictor_create")
-    @mock.patch("balancer.db.api.serverfarm_create")
-    @mock.patch("balancer.db.api.server_create")
-    @mock.patch("balancer.core.commands.create_rserver")
-    @mock.patch("balancer.core.commands.add_rserver_to_server_farm")
-    @mock.patch("balancer.db.api.probe_pack_extra")
-    @mock.patch("balancer.db.api.probe_create")
-    @mock.patch("balancer.core.commands.create_probe")
-    @mock.patch("balancer.core.commands.add_probe_to_server_farm")
-    @mock.patch("balancer.db.api.unpack_extra")
-    def test_create_loadbalancer_1(self, *mocks):
+        mocks = self._create_loadbalancer(self.dict_list, self.dict_list,
+                                          self.dict_list)
+        for name, mok in mocks.iteritems():
+            self.assertTrue(mok.called, "This mock didn't call %s" % name)
+        sf = mocks['serverfarm_create'].return_value
+        values_list = mocks['server_create_many'].call_args[0][1]
+        self.assertEqual([values['sf_id'] for values in values_list],
+                         [sf['id'], sf['id']])
+        rs_refs = mocks['server_create_many'].return_value
+        mocks['create_rservers'].assert_called_once_with(self.ctx, rs_refs)
+        mocks['add_rservers_to_server_farm'].assert_called_once_with(
+                self.ctx, sf, rs_refs)
+        self.assertEqual(mocks['add_probe_to_server_farm'].call_count, 2)
+        mocks['create_vips'].assert_called_once_with(self.ctx,
+                mocks['virtualserver_create_many'].return_value, sf)
+
+    def test_create_loadbalancer_1(self):
         """Nodes not here"""
-        cmd.create_loadbalancer(self.ctx, self.balancer, [],
-                self.dict_list, self.dict_list)
-        for mok in mocks[0:4]:
-            self.assertTrue(mok.called, "This mock didn't call %s"
-                    % mok._mock_name)
-        for mok in mocks[5:7]:
-            self.assertFalse(mok.called, "This mock called %s"
-                    % mok._mock_name)
-        for mok in mocks[8:14]:
-            self.assertTrue(mok.called, "This mock didn't call %s"
-                    % mok._mock_name)
-
-    @mock.patch("balancer.db.api.virtualserver_pack_extra")
-    @mock.patch("balancer.db.api.virtualserver_create")
-    @mock.patch("balancer.core.commands.create_vip")
-    @mock.patch("balancer.core.commands.create_server_farm")
-    @mock.patch("balancer.db.api.predictor_create")
-    @mock.patch("balancer.db.api.serverfarm_create")
-    @mock.patch("balancer.db.api.server_create")
-    @mock.patch("balancer.core.commands.create_rserver")
-    @mock.patch("balancer.core.commands.add_rserver_to_server_farm")
-    @mock.patch("balancer.db.api.probe_pack_extra")
-    @mock.patch("balancer.db.api.probe_create")
-    @mock.patch("balancer.core.commands.create_probe")
-    @mock.patch("balancer.core.commands.add_probe_to_server_farm")
-    @mock.patch("balancer.db.api.unpack_extra")
-    def test_create_loadbalancer_2(self, *mocks):
+        mocks = self._create_loadbalancer([], self.dict_list,
+                                          self.dict_list)
+        for name in ('server_create_many', 'create_rservers',
+                     'add_rservers_to_server_farm'):
+            self.assertFalse(mocks[name].called, "This mock called %s" % name)
+        for name in ('probe_create_many', 'create_probes',
+                     'virtualserver_create_many', 'create_vips'):
+            self.assertTrue(mocks[name].called,
+                            "This mock didn't call %s" % name)
+
+    def test_create_loadbalancer_2(self):
         """probes not here"""
-        cmd.create_loadbalancer(self.ctx, self.balancer, self.dict_list,
-                [], self.dict_list)
-        for mok in mocks[0]:
-            self.assertTrue(mok.called, "This mock didn't call %s"
-                    % mok._mock_name)
-        for mok in mocks[1:4]:
-            self.assertFalse(mok.called, "This mock called %s"
-                    % mok._mock_name)
-        for mok in mocks[5:14]:
-            self.assertTrue(mok.called, "This mock didn't call %s"
-                    % mok._mock_name)
-
-    @mock.patch("balancer.db.api.virtualserver_pack_extra")
-    @mock.patch("balancer.db.api.virtualserver_create")
-    @mock.patch("balancer.core.commands.create_vip")
-    @mock.patch("balancer.core.commands.create_server_farm")
-    @mock.patch("balancer.db.api.predictor_create")
-    @mock.patch("balancer.db.api.serverfarm_create")
-    @mock.patch("balancer.db.api.server_pack_extra")
-    @mock.patch("balancer.db.api.server_create")
-    @mock.patch("balancer.core.commands.create_rserver")
-    @mock.patch("balancer.core.commands.add_rserver_to_server_farm")
-    @mock.patch("balancer.db.api.probe_pack_extra")
-    @mock.patch("balancer.db.api.probe_create")
-    @mock.patch("balancer.core.commands.create_probe")
-    @mock.patch("balancer.core.commands.add_probe_to_server_farm")
-    @mock.patch("balancer.db.api.unpack_extra")
-    def test_create_loadbalancer_3(self, *mocks):
+        mocks = self._create_loadbalancer(self.dict_list, [],
+                                          self.dict_list)
+        for name in ('probe_create_many', 'create_probes',
+                     'add_probe_to_server_farm'):
+            self.assertFalse(mocks[name].called, "This mock called %s" % name)
+        for name in ('server_create_many', 'create_rservers',
+                     'virtualserver_create_many', 'create_vips'):
+            self.assertTrue(mocks[name].called,
+                            "This mock didn't call %s" % name)
+
+    def test_create_loadbalancer_3(self):
         """vips not here"""
-        cmd.create_loadbalancer(self.ctx, self.balancer, self.dict_list,
-                self.dict_list, [])
-        for mok in mocks[0:10]:
-            self.assertTrue(mok.called, "This mock didn't call %s"
-                    % mok._mock_name)
-        for mok in mocks[12:14]:
-            self.assertFalse(mok.called, "This mock called %s"
-                    % mok._mock_name)
+        mocks = self._create_loadbalancer(self.dict_list, self.dict_list,
+                                          [])
+        for name in ('virtualserver_create_many', 'create_vips'):
+            self.assertFalse(mocks[name].called, "This mock called %s" % name)
+        for name in ('server_create_many', 'create_rservers',
+                     'probe_create_many', 'create_probes'):
+            self.assertTrue(mocks[name].called,
+                            "This mock didn't call %s" % name)
 
     @mock.patch("balancer.core.commands.delete_sticky")
     @mock.patch("balancer.core.commands.remove_probe_from_server_farm")
@@ -594,6 +635,26 @@ class TestLoadbalancer(unittest.TestCase):
                                         self.rserver)
         mock_f2.assert_called_once_with(self.ctx, self.rserver)
 
+    @mock.patch("balancer.core.commands.create_rservers")
+    @mock.patch("balancer.core.commands.add_rservers_to_server_farm")
+    def test_add_nodes_to_loadbalancer(self, mock_f1, mock_f2):
+        rservers = [self.rserver, mock.MagicMock()]
+        cmd.add_nodes_to_loadbalancer(self.ctx, self.balancer.sf, rservers)
+        mock_f1.assert_called_once_with(self.ctx, self.balancer.sf,
+                                        rservers)
+        mock_f2.assert_called_once_with(self.ctx, rservers)
+
+    @mock.patch("balancer.core.commands.delete_rserver")
+    @mock.patch("balancer.core.commands.delete_rservers_from_server_farm")
+    def test_remove_nodes_from_loadbalancer(self, mock_f1, mock_f2):
+        rservers = [self.rserver, mock.MagicMock()]
+        cmd.remove_nodes_from_loadbalancer(self.ctx, self.balancer.sf,
+                                           rservers)
+        mock_f1.assert_called_once_with(self.ctx, self.balancer.sf,
+                                        rservers)
+        self.assertEqual(mock_f2.call_args_list,
+                         [mock.call(self.ctx, rs) for rs in rservers])
+
     @mock.patch("balancer.core.commands.create_probe")
     @mock.patch("balancer.core.commands.add_probe_to_server_farm")
     def test_add_probe_to_loadbalancer(self, mock_f1, mock_f2):
@@ -5,24 +5,7 @@ import balancer.core.api as api
 from openstack.common import exception
 from balancer import exception as exc
 import balancer.db.models as models
-
-
-class TestDecorators(unittest.TestCase):
-
-    def setUp(self):
-        self.func = mock.MagicMock(__name__='Test func',
-                return_value=mock.MagicMock(spec=types.FunctionType))
-
-    def test_asynchronous_1(self):
-        wrapped = api.asynchronous(self.func)
-        wrapped(async=False)
-        self.assertEquals(self.func.call_args_list, [mock.call()])
-
-    @mock.patch("eventlet.spawn")
-    def test_asynchronous_2(self, mock_event):
-        wrapped = api.asynchronous(self.func)
-        wrapped(async=True)
-        self.assertTrue(mock_event.called)
+from balancer.db import session as db_session
 
 
 class TestBalancer(unittest.TestCase):
@@ -80,21 +63,35 @@ class TestBalancer(unittest.TestCase):
         self.assertTrue(mock_api.called)
         self.assertEqual(resp, ['foo'])
 
-    @mock.patch("balancer.db.api.serverfarm_get_all_by_lb_id")
-    @mock.patch("balancer.db.api.unpack_extra")
-    @mock.patch("balancer.db.api.loadbalancer_get")
-    @mock.patch("balancer.db.api.virtualserver_get_all_by_sf_id")
-    @mock.patch("balancer.db.api.server_get_all_by_sf_id")
-    @mock.patch("balancer.db.api.probe_get_all_by_sf_id")
-    @mock.patch("balancer.db.api.sticky_get_all_by_sf_id")
-    def test_lb_show_details(self, *mocks):
-        mocks[5].return_value = {"virtualIps": 1, "nodes": 2,
-                "healthMonitor": 3, "sessionPersistence": 4}
-        mocks[6].return_value = mock.MagicMock(spec=models.ServerFarm)
-        api.lb_show_details(self.conf, self.lb_id)
-        for mok in mocks:
-            self.assertTrue(mok.called, "This mock %s didn't call"
-                    % mok._mock_name)
+    def _fake_lb_graph(self, lb_id):
+        sf = {'servers': [{'id': 'rs1'}, {'id': 'rs2'}],
+              'virtualservers': [{'id': 'vip1'}],
+              'probes': [{'id': 'probe1'}],
+              'stickies': []}
+        lb = {'id': lb_id, 'serverfarms': [sf]}
+        return mock.MagicMock(__iter__=lambda _self: iter(['id']),
+                              __getitem__=lambda _self, key: lb[key])
+
+    @mock.patch("balancer.db.api.loadbalancer_get_details")
+    def test_lb_show_details(self, mock_get):
+        mock_get.return_value = self._fake_lb_graph(self.lb_id)
+        resp = api.lb_show_details(self.conf, self.lb_id)
+        mock_get.assert_called_once_with(self.conf, self.lb_id)
+        self.assertEqual(resp, {'id': self.lb_id,
+                                'nodes': [{'id': 'rs1'}, {'id': 'rs2'}],
+                                'virtualIps': [{'id': 'vip1'}],
+                                'healthMonitor': [{'id': 'probe1'}],
+                                'sessionPersistence': []})
+
+    @mock.patch("balancer.db.api.loadbalancer_get_all_details")
+    def test_lb_get_index_details(self, mock_get_all):
+        mock_get_all.return_value = [self._fake_lb_graph(1),
+                                     self._fake_lb_graph(2)]
+        resp = api.lb_get_index_details(self.conf, self.tenant_id, [1, 2])
+        mock_get_all.assert_called_once_with(self.conf, self.tenant_id,
+                                             [1, 2])
+        self.assertEqual([lb['id'] for lb in resp], [1, 2])
+        self.assertEqual(resp[1]['nodes'], [{'id': 'rs1'}, {'id': 'rs2'}])
 
     @mock.patch("balancer.db.api.loadbalancer_get")
     @mock.patch("balancer.db.api.unpack_extra")
@@ -110,48 +107,87 @@ class TestBalancer(unittest.TestCase):
         self.assertTrue(mock_api.called)
         self.assertEquals(res, {"id": 1})
 
-    @mock.patch("balancer.db.api.unpack_extra")
+    @mock.patch("balancer.core.jobs.submit")
     @mock.patch("balancer.db.api.loadbalancer_update")
     @mock.patch("balancer.db.api.loadbalancer_create")
     @mock.patch("balancer.db.api.loadbalancer_pack_extra")
     @patch_scheduler
-    @mock.patch("balancer.core.commands.create_loadbalancer")
-    @mock.patch("balancer.drivers.get_device_driver")
-    def test_create_lb_0(self, *mocks):
-        """No exception"""
-        mocks[6].return_value = {'id': 2}
+    def test_create_lb(self, *mocks):
+        mocks[0].return_value = {'id': 2, 'type': 'HAPROXY'}
         mocks[2].return_value = {'id': 1}
-        mocks[4].return_value = mock.MagicMock()
-        api.create_lb(self.conf, self.dict_list_0)
-        for mok in mocks:
-            self.assertTrue(mok.called, "Mock %s didn't call"
-                    % mok._mock_name)
-
-    @mock.patch("balancer.db.api.unpack_extra")
+        nodes = self.dict_list_0['nodes']
+        vips = self.dict_list_0['virtualIps']
+        resp = api.create_lb(self.conf, self.dict_list_0)
+        self.assertEqual(resp, mocks[4].return_value)
+        mocks[1].return_value.__setitem__.assert_called_once_with('status',
+                                                                  'BUILD')
+        mocks[3].assert_called_once_with(self.conf, 1, {'device_id': 2})
+        mocks[4].assert_called_once_with(self.conf, 'create_lb', 1,
+            'HAPROXY', {'nodes': nodes,
+                        'healthMonitor': [],
+                        'virtualIps': vips})
+
+    @mock.patch("balancer.core.jobs.submit")
     @mock.patch("balancer.db.api.loadbalancer_update")
     @mock.patch("balancer.db.api.loadbalancer_create")
     @mock.patch("balancer.db.api.loadbalancer_pack_extra")
     @patch_scheduler
+    def test_create_lb_queue_full(self, *mocks):
+        mocks[0].return_value = {'id': 2, 'type': 'HAPROXY'}
+        mocks[2].return_value = {'id': 1}
+        mocks[4].side_effect = exc.JobQueueFull
+        self.assertRaises(exc.JobQueueFull, api.create_lb, self.conf,
+                          self.dict_list_0)
+        self.assertEqual(mocks[3].call_args_list,
+                         [mock.call(self.conf, 1, {'device_id': 2}),
+                          mock.call(self.conf, 1, {'status': 'ERROR',
+                                                   'deployed': 'False'})])
+
+    @mock.patch("balancer.db.api.loadbalancer_update")
+    @mock.patch("balancer.db.api.loadbalancer_get")
     @mock.patch("balancer.core.commands.create_loadbalancer")
     @mock.patch("balancer.drivers.get_device_driver")
-    def test_create_lb_1(self, *mocks):
+    def test_run_create_lb_0(self, *mocks):
+        """No exception"""
+        params = {'nodes': [], 'healthMonitor': [], 'virtualIps': []}
+        api.run_create_lb(self.conf, self.lb_id, params)
+        with mocks[0].return_value.request_context() as ctx:
+            mocks[1].assert_called_once_with(ctx, mocks[2].return_value,
+                                             [], [], [])
+        mocks[3].assert_called_once_with(self.conf, self.lb_id,
+                {'status': "ACTIVE", 'deployed': 'True'})
+
+    @mock.patch("balancer.db.api.loadbalancer_update")
+    @mock.patch("balancer.db.api.loadbalancer_get")
+    @mock.patch("balancer.core.commands.create_loadbalancer")
+    @mock.patch("balancer.drivers.get_device_driver")
+    def test_run_create_lb_1(self, *mocks):
         """Exception"""
-        mocks[6].return_value = {'id': 2}
+        params = {'nodes': [], 'healthMonitor': [], 'virtualIps': []}
         mocks[1].side_effect = exception.Invalid
-        mocks[2].return_value = {'id': 1}
-        mocks[4].return_value = mock.MagicMock()
-        api.create_lb(self.conf, self.dict_list_0)
-        mocks[1].called_once_with(exception.Invalid)
+        self.assertRaises(exception.Invalid, api.run_create_lb, self.conf,
+                          self.lb_id, params)
+        mocks[3].assert_called_once_with(self.conf, self.lb_id,
+                {'status': "ERROR", 'deployed': 'False'})
+
+    @mock.patch("balancer.core.jobs.submit")
+    @mock.patch("balancer.db.api.device_get")
+    @mock.patch("balancer.db.api.loadbalancer_get")
+    def test_update_lb(self, *mocks):
+        mocks[1].return_value = {'id': 2, 'type': 'HAPROXY'}
+        resp = api.update_lb(self.conf, self.lb_id, self.lb_body)
+        mocks[2].assert_called_once_with(self.conf, 'update_lb', self.lb_id,
+                                         'HAPROXY', self.lb_body)
+        self.assertEqual(resp, mocks[2].return_value)
 
     @mock.patch("balancer.core.commands.update_loadbalancer")
     @mock.patch("balancer.db.api.loadbalancer_update")
     @mock.patch("balancer.db.api.pack_update")
     @mock.patch("balancer.db.api.loadbalancer_get")
     @mock.patch("balancer.drivers.get_device_driver")
-    def test_update_lb_0(self, *mocks):
+    def test_run_update_lb_0(self, *mocks):
         """No exception"""
-        resp = api.update_lb(self.conf, self.lb_id, self.lb_body,
-                             async=False)
+        resp = api.run_update_lb(self.conf, self.lb_id, self.lb_body)
         for mock in mocks:
             self.assertTrue(mock.called)
         mocks[0].assert_called_once_with(self.conf,
@@ -170,38 +206,88 @@ class TestBalancer(unittest.TestCase):
     @mock.patch("balancer.db.api.pack_update")
     @mock.patch("balancer.db.api.loadbalancer_get")
     @mock.patch("balancer.drivers.get_device_driver")
-    def test_update_lb_1(self, *mocks):
+    def test_run_update_lb_1(self, *mocks):
         """Exception"""
         mocks[4].side_effect = Exception
         with self.assertRaises(Exception):
-            api.update_lb(self.conf, self.lb_id, self.lb_body, async=False)
-            mocks[3].assert_called_with(self.conf, self.lb_id,
-                {'status': "ERROR"})
+            api.run_update_lb(self.conf, self.lb_id, self.lb_body)
+        mocks[3].assert_called_with(self.conf, self.lb_id,
+                                    {'status': "ERROR"})
+
+    @mock.patch("balancer.core.jobs.submit")
+    @mock.patch("balancer.db.api.device_get")
+    @mock.patch("balancer.db.api.loadbalancer_get")
+    def test_delete_lb(self, *mocks):
+        mocks[1].return_value = {'id': 2, 'type': 'HAPROXY'}
+        resp = api.delete_lb(self.conf, self.lb_id)
+        mocks[2].assert_called_once_with(self.conf, 'delete_lb', self.lb_id,
+                                         'HAPROXY')
+        self.assertEqual(resp, mocks[2].return_value)
 
     @mock.patch("balancer.db.api.loadbalancer_get")
     @mock.patch("balancer.drivers.get_device_driver")
     @mock.patch("balancer.core.commands.delete_loadbalancer")
-    def test_delete_lb(self, mock_command, mock_driver, mock_api):
+    def test_run_delete_lb(self, mock_command, mock_driver, mock_api):
         mock_api.return_value = mock.MagicMock()
-        api.delete_lb(self.conf, self.lb_id)
+        api.run_delete_lb(self.conf, self.lb_id, {})
         self.assertTrue(mock_api.called)
         self.assertTrue(mock_command.called)
         self.assertTrue(mock_driver.called)
 
     @mock.patch("balancer.db.api.unpack_extra")
-    @mock.patch("balancer.db.api.server_create")
+    @mock.patch("balancer.db.api.server_create_many")
     @mock.patch("balancer.db.api.server_pack_extra")
     @mock.patch("balancer.db.api.serverfarm_get_all_by_lb_id")
     @mock.patch("balancer.db.api.loadbalancer_get")
     @mock.patch("balancer.drivers.get_device_driver")
-    @mock.patch("balancer.core.commands.add_node_to_loadbalancer")
+    @mock.patch("balancer.core.commands.add_nodes_to_loadbalancer")
     def test_lb_add_nodes(self, *mocks):
         mocks[2].return_value = {'device_id': 1}
         mocks[3].return_value = [{'id': 1}]
+        mocks[5].return_value = ['rs1', 'rs2']
         api.lb_add_nodes(self.conf, self.lb_id, self.lb_nodes)
         for mok in mocks:
             self.assertTrue(mok.called, "This mock didn't call %s"
                     % mok._mock_name)
+        self.assertEqual(mocks[5].call_count, 1)
+        self.assertEqual(mocks[1].return_value.request_context.call_count, 1)
+        mocks[0].assert_called_once_with(
+            mocks[1].return_value.request_context.return_value.__enter__.
+                return_value, {'id': 1}, ['rs1', 'rs2'])
+
+    @mock.patch("balancer.db.api.server_destroy_many")
+    @mock.patch("balancer.db.api.server_create_many")
+    @mock.patch("balancer.db.api.server_pack_extra")
+    @mock.patch("balancer.db.api.serverfarm_get_all_by_lb_id")
+    @mock.patch("balancer.db.api.loadbalancer_get")
+    @mock.patch("balancer.drivers.get_device_driver")
+    @mock.patch("balancer.core.commands.add_nodes_to_loadbalancer")
+    def test_lb_add_nodes_device_failure(self, *mocks):
+        mocks[3].return_value = [{'id': 1}]
+        mocks[5].return_value = [{'id': 3}, {'id': 4}]
+        mocks[0].side_effect = exception.Invalid
+        self.assertRaises(exception.Invalid, api.lb_add_nodes, self.conf,
+                          self.lb_id, self.lb_nodes)
+        mocks[6].assert_called_once_with(self.conf, [3, 4])
+
+    @mock.patch("balancer.db.api.server_create_many")
+    @mock.patch("balancer.db.api.server_pack_extra")
+    @mock.patch("balancer.db.api.serverfarm_get_all_by_lb_id")
+    @mock.patch("balancer.db.api.loadbalancer_get")
+    @mock.patch("balancer.drivers.get_device_driver")
+    @mock.patch("balancer.core.commands.add_nodes_to_loadbalancer")
+    def test_lb_add_nodes_no_transaction_on_device(self, *mocks):
+        units = []
+
+        def add_nodes(ctx, sf, rs_refs):
+            units.append(getattr(db_session._LOCAL, 'unit', None))
+
+        mocks[0].side_effect = add_nodes
+        mocks[3].return_value = [{'id': 1}]
+        mocks[5].return_value = []
+        with mock.patch("balancer.db.session.get_session"):
+            api.lb_add_nodes(self.conf, self.lb_id, self.lb_nodes)
+        self.assertEqual(units, [None])
 
     @mock.patch("balancer.db.api.unpack_extra")
     @mock.patch("balancer.db.api.server_get_all_by_sf_id")
@@ -212,6 +298,15 @@ class TestBalancer(unittest.TestCase):
         self.assertTrue(mock_serverfarm.called)
         self.assertTrue(mock_server.called)
 
+    @mock.patch("balancer.db.api.unpack_extra")
+    @mock.patch("balancer.db.api.server_get_all_by_sf_id")
+    @mock.patch("balancer.db.api.serverfarm_get_all_by_lb_id")
+    def test_lb_show_nodes_paginated(self, mock_serverfarm, mock_server,
+                                     mock_unpack):
+        mock_serverfarm.return_value = self.dict_list
+        api.lb_show_nodes(self.conf, 1, marker=2, limit=5)
+        mock_server.assert_called_once_with(self.conf, 1, marker=2, limit=5)
+
     @mock.patch("balancer.db.api.serverfarm_get_all_by_lb_id")
     @mock.patch("balancer.db.api.loadbalancer_get")
     @mock.patch("balancer.drivers.get_device_driver")
@@ -224,6 +319,22 @@ class TestBalancer(unittest.TestCase):
         for mock in mocks:
             self.assertTrue(mock.called)
 
+    @mock.patch("balancer.db.api.serverfarm_get_all_by_lb_id")
+    @mock.patch("balancer.db.api.loadbalancer_get")
+    @mock.patch("balancer.drivers.get_device_driver")
+    @mock.patch("balancer.core.commands.remove_nodes_from_loadbalancer")
+    @mock.patch("balancer.db.api.server_get")
+    @mock.patch("balancer.db.api.server_destroy_many")
+    def test_lb_delete_nodes(self, *mocks):
+        mocks[1].side_effect = [{'id': 1}, {'id': 2}]
+        mocks[5].return_value = self.dict_list
+        api.lb_delete_nodes(self.conf, self.lb_id, [1, 2])
+        for mock in mocks:
+            self.assertTrue(mock.called)
+        mocks[0].assert_called_once_with(self.conf, [1, 2])
+        self.assertEqual(mocks[3].return_value.request_context.call_count, 1)
+        self.assertEqual(mocks[2].call_args[0][2], [{'id': 1}, {'id': 2}])
+
     @mock.patch("balancer.db.api.serverfarm_get")
     @mock.patch("balancer.db.api.loadbalancer_get")
     @mock.patch("balancer.db.api.server_update")
@@ -628,6 +739,34 @@ class TestDevice(unittest.TestCase):
         mock_f1.assert_caleld_once_with(self.conf, mock_f2.return_value)
         mock_f2.assert_called_once_with({})
 
+    @mock.patch("balancer.core.scheduler.invalidate")
+    @mock.patch("balancer.drivers.invalidate_device_driver")
+    @mock.patch("balancer.db.api.device_update")
+    @mock.patch("balancer.db.api.device_get")
+    def test_device_update(self, mock_get, mock_update, mock_invalidate,
+                           mock_sched):
+        mock_get.return_value = models.Device(id=1, ip='10.0.0.2',
+                                              extra={'vlan': 10})
+        resp = api.device_update(self.conf, 1, ip='10.0.0.1', port=8080)
+        self.assertEqual(resp, mock_update.return_value)
+        mock_get.assert_called_once_with(self.conf, 1)
+        values = mock_update.call_args[0][2]
+        self.assertEqual(mock_update.call_args[0][:2], (self.conf, 1))
+        self.assertEqual((values['ip'], values['port'], values['extra']),
+                         ('10.0.0.1', 8080, {'vlan': 10}))
+        self.assertEqual(mock_get.return_value['ip'], '10.0.0.2')
+        mock_invalidate.assert_called_once_with(1)
+        self.assertTrue(mock_sched.called)
+
+    @mock.patch("balancer.core.scheduler.invalidate")
+    @mock.patch("balancer.drivers.device_deleted")
+    @mock.patch("balancer.db.api.device_destroy")
+    def test_device_delete(self, mock_destroy, mock_deleted, mock_sched):
+        api.device_delete(self.conf, 1)
+        mock_destroy.assert_called_once_with(self.conf, 1)
+        mock_deleted.assert_called_once_with(1)
+        self.assertTrue(mock_sched.called)
+
     def test_device_info(self):
         params = {'query_params': 2}
         res = api.device_info(params)
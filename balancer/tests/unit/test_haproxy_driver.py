@@ -3,8 +3,10 @@
 import unittest
 import os
 import shutil
+import tempfile
 import filecmp
 import mock
+import eventlet
 
 from mock import Mock, MagicMock
 from balancer.drivers.haproxy.HaproxyDriver import HaproxyConfigFile
@@ -13,10 +15,14 @@ from balancer.drivers.haproxy.HaproxyDriver import HaproxyBackend
 from balancer.drivers.haproxy.HaproxyDriver import HaproxyRserver
 from balancer.drivers.haproxy.HaproxyDriver import HaproxyListen
 from balancer.drivers.haproxy.HaproxyDriver import HaproxyDriver
+from balancer.drivers.haproxy.HaproxyDriver import DeployFailed
 from balancer.drivers.haproxy.RemoteControl import RemoteConfig
 from balancer.drivers.haproxy.RemoteControl import RemoteService
 from balancer.drivers.haproxy.RemoteControl import RemoteInterface
 from balancer.drivers.haproxy.RemoteControl import RemoteSocketOperation
+from balancer.drivers.haproxy.RemoteControl import RemoteSocketBatch
+from balancer.drivers.haproxy.RemoteControl import SSHConnectionPool
+from balancer.drivers.haproxy.RemoteControl import PooledSSHClient
 
 device_fake = {'ip': '192.168.19.86',
     'port': '22',
@@ -96,6 +102,178 @@ haproxy_rserver1.port = '12345'
 haproxy_rserver1.fall = '11'
 
 
+class TestSSHConnectionPool (unittest.TestCase):
+    def setUp(self):
+        self.pool = SSHConnectionPool(keepalive=10, idle_timeout=60)
+
+    @mock.patch('paramiko.SSHClient')
+    def test_connection_is_reused(self, mock_client):
+        first = self.pool.get('10.0.0.1', 'user', 'secret')
+        second = self.pool.get('10.0.0.1', 'user', 'secret')
+        self.assertTrue(first is second)
+        self.assertEqual(mock_client.return_value.connect.call_count, 1)
+        first.get_transport.return_value.set_keepalive.assert_called_with(10)
+
+    @mock.patch('paramiko.SSHClient')
+    def test_dead_connection_is_reopened(self, mock_client):
+        client = self.pool.get('10.0.0.1', 'user', 'secret')
+        client.get_transport.return_value.is_active.return_value = False
+        self.pool.get('10.0.0.1', 'user', 'secret')
+        self.assertEqual(client.close.call_count, 1)
+        self.assertEqual(client.connect.call_count, 2)
+
+    @mock.patch('time.time')
+    @mock.patch('paramiko.SSHClient')
+    def test_idle_connection_is_evicted(self, mock_client, mock_time):
+        mock_time.return_value = 1000
+        client = self.pool.get('10.0.0.1', 'user', 'secret')
+        mock_time.return_value = 1100
+        self.pool.evict_idle()
+        self.assertEqual(client.close.call_count, 1)
+        self.assertEqual(self.pool._clients, {})
+
+    def test_pooled_client_reconnects_on_failure(self):
+        pool = Mock()
+        broken, fresh = Mock(), Mock()
+        broken.exec_command.side_effect = EOFError()
+        pool.get.side_effect = [broken, fresh]
+        ssh = PooledSSHClient('10.0.0.1', 'user', 'secret', pool=pool)
+        ssh.connect()
+        ssh.exec_command('ls')
+        pool.invalidate.assert_called_once_with('10.0.0.1', 'user')
+        fresh.exec_command.assert_called_once_with('ls')
+
+
+class TestHaproxyConfigFile (unittest.TestCase):
+    def setUp(self):
+        self.testfiles = os.path.join(os.path.dirname(__file__), 'testfiles')
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'haproxy.cfg')
+        shutil.copy(os.path.join(self.testfiles, 'haproxy.cfg'), self.path)
+        self.config_file = HaproxyConfigFile(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @staticmethod
+    def _dump(config_file):
+        return [(section.header, list(section))
+                for section in config_file._get_sections()]
+
+    def test_delete_block(self):
+        block = HaproxyListen()
+        block.name = 'appli2-insert'
+        self.config_file.delete_block(block)
+        self.config_file.save()
+        expected = HaproxyConfigFile(os.path.join(self.testfiles,
+                                     'haproxy_without_appli2-insert.cfg'))
+        self.assertEqual(self._dump(HaproxyConfigFile(self.path)),
+                         self._dump(expected))
+
+    def test_sections_keep_their_order(self):
+        with open(self.path, 'w') as config:
+            config.write('global\n\tdaemon\n'
+                         'defaults\n\tmode http\n'
+                         'frontend www\n\tbind *:80\n'
+                         '\tdefault_backend web\n'
+                         'backend web\n\tserver web1 10.0.0.1:80\n'
+                         'defaults tcp_defaults\n\tmode tcp\n'
+                         'listen db\n\tbind *:3306\n'
+                         '\tserver db1 10.0.0.2:3306\n'
+                         'defaults\n\tmode tcp\n'
+                         'listen cache\n\tbind *:11211\n')
+        with open(self.path) as config:
+            original = config.read()
+        self.assertEqual(self.config_file.render(), original)
+        self.config_file.add_backend(backend)
+        self.config_file.save()
+        with open(self.path) as config:
+            self.assertEqual(config.read(), original +
+                             'backend test_backend\n\tbalance source\n')
+        copy = HaproxyConfigFile(self.path).copy()
+        self.assertEqual(copy.render(), self.config_file.render())
+
+    def test_changes_are_written_on_save_only(self):
+        self.config_file.add_backend(backend)
+        for i in range(500):
+            rserver = HaproxyRserver()
+            rserver.name = 'node%d' % i
+            rserver.address = '10.0.0.%d' % (i % 250)
+            rserver.port = '80'
+            self.config_file.add_rserver_to_backend_block(backend, rserver)
+        self.assertTrue(filecmp.cmp(self.path,
+                        os.path.join(self.testfiles, 'haproxy.cfg')))
+        self.config_file.save()
+        section = HaproxyConfigFile(self.path).get_section('backend',
+                                                            'test_backend')
+        self.assertEqual(len(list(section)), 501)
+        self.assertTrue(section.get_server('node499').startswith(
+                        '\tserver node499 10.0.0.249:80 check'))
+
+    def test_enable_disable_rserver(self):
+        self.config_file.add_backend(backend)
+        self.config_file.add_rserver_to_backend_block(backend,
+                                                      haproxy_rserver)
+        self.config_file.add_rserver_to_backend_block(backend,
+                                                      haproxy_rserver1)
+        self.config_file.enable_disable_reserver_in_backend_block(
+                backend, haproxy_rserver, 'disable')
+        section = self.config_file.get_section('backend', 'test_backend')
+        self.assertTrue(section.get_server('new_test_server').endswith(
+                        ' disabled'))
+        self.assertFalse(section.get_server('new_test_server_2').endswith(
+                         ' disabled'))
+        self.config_file.enable_disable_reserver_in_backend_block(
+                backend, haproxy_rserver, 'enable')
+        self.assertFalse(section.get_server('new_test_server').endswith(
+                         ' disabled'))
+
+    def test_validate(self):
+        self.assertEqual(self.config_file.validate(), [])
+        self.config_file.add_frontend(frontend, backend)
+        self.config_file.add_backend(backend)
+        self.config_file.get_section('backend', 'test_backend').append(
+                '\tserver new_test_server')
+        self.assertEqual(self.config_file.validate(), [
+                'backend test_backend: incomplete server line '
+                '"server new_test_server"'])
+        self.config_file.delete_block(backend)
+        self.assertEqual(self.config_file.validate(), [
+                'frontend test_frontend: unknown backend in '
+                '"default_backend test_backend"'])
+
+    def test_validate_accepts_what_haproxy_accepts(self):
+        with open(self.path, 'w') as config:
+            config.write('global\n\tdaemon\n'
+                         'frontend www\n\tbind *:80\n'
+                         '\tuse_backend bk_%[req.hdr(host),lower] '
+                         'if { req.hdr(host) -m found }\n'
+                         '\tuse_backend web if { path_beg /web }\n'
+                         '\tdefault_backend web\n'
+                         'backend web\n\tserver web1 10.0.0.1:80\n')
+        self.assertEqual(self.config_file.validate(), [])
+        self.config_file.get_section('frontend', 'www').append(
+                '\tuse_backend missing if { path_beg /missing }')
+        self.assertEqual(self.config_file.validate(), [
+                'frontend www: unknown backend in '
+                '"use_backend missing if { path_beg /missing }"'])
+
+    def test_lines_and_frontend(self):
+        self.config_file.add_backend(backend)
+        self.config_file.add_lines_to_backend_block(backend,
+                                                    ['option httpchk'])
+        self.config_file.del_lines_from_backend_block(backend,
+                                                      ['option httpchk'])
+        section = self.config_file.get_section('backend', 'test_backend')
+        self.assertEqual(list(section), ['\tbalance source'])
+        self.config_file.add_frontend(frontend, backend)
+        self.assertTrue(self.config_file.find_string_in_the_block('frontend',
+                                                                  '1.1.1.1'))
+        self.config_file.delete_block(frontend)
+        self.assertFalse(self.config_file.find_string_in_the_block(
+                         'frontend', '1.1.1.1'))
+
+
 class TestHaproxyDriverRemoteConfig (unittest.TestCase):
     def setUp(self):
         self.remote_config = RemoteConfig(device_fake, '/tmp',
@@ -115,10 +293,50 @@ class TestHaproxyDriverRemoteConfig (unittest.TestCase):
         self.assertFalse(self.remote_config.validate_config())
 
 
+class TestHaproxyDriverRemoteConfigCommit (unittest.TestCase):
+    def setUp(self):
+        self.remote_config = RemoteConfig(device_fake, '/tmp',
+                        '/etc/haproxy', 'haproxy.cfg')
+        self.remote_config.ssh = Mock()
+        self.stdout = Mock()
+        self.stdout.channel.recv_exit_status.return_value = 0
+        self.remote_config.ssh.exec_command.return_value = [Mock(),
+                                                  self.stdout, Mock()]
+
+    def test_put_config_uploads_to_staging(self):
+        self.remote_config.put_config()
+        sftp = self.remote_config.ssh.open_sftp.return_value
+        sftp.put.assert_called_once_with('/tmp/haproxy.cfg',
+                                         '/tmp/haproxy.cfg.remote')
+        self.assertFalse(self.remote_config.ssh.exec_command.called)
+
+    def test_validate_staged_config(self):
+        self.stdout.read.return_value = 'Configuration file is valid'
+        self.assertTrue(self.remote_config.validate_config())
+        self.remote_config.ssh.exec_command.assert_called_once_with(
+                'haproxy -c -f /tmp/haproxy.cfg.remote')
+
+    def test_commit_config_renames_atomically(self):
+        self.assertTrue(self.remote_config.commit_config())
+        self.remote_config.ssh.exec_command.assert_called_once_with(
+                'sudo cp /tmp/haproxy.cfg.remote /etc/haproxy/.haproxy.cfg.new'
+                ' && sudo mv -f /etc/haproxy/.haproxy.cfg.new '
+                '/etc/haproxy/haproxy.cfg')
+        self.stdout.channel.recv_exit_status.return_value = 1
+        self.assertFalse(self.remote_config.commit_config())
+
+
 class TestHaproxyDriverRemoteService (unittest.TestCase):
     def setUp(self):
         self.remote_service = RemoteService(device_fake)
         self.remote_service.ssh = Mock()
+        self.stdout = Mock()
+        self.stdout.channel.recv_exit_status.return_value = 0
+        self.remote_service.ssh.exec_command.return_value = [Mock(),
+                                                   self.stdout, Mock()]
+
+    def _command(self):
+        return self.remote_service.ssh.exec_command.call_args[0][0]
 
     def test_start_service(self):
         self.assertTrue(self.remote_service.start())
@@ -129,6 +347,53 @@ class TestHaproxyDriverRemoteService (unittest.TestCase):
     def test_restart_service(self):
         self.assertTrue(self.remote_service.restart())
 
+    def test_soft_reload(self):
+        self.assertTrue(self.remote_service.reload('soft'))
+        self.assertEqual(self._command(),
+                'sudo haproxy -D -f /etc/haproxy/haproxy.cfg '
+                '-p /var/run/haproxy.pid -sf $(cat /var/run/haproxy.pid)')
+
+    def test_master_worker_reload(self):
+        self.assertTrue(self.remote_service.reload('master-worker'))
+        self.assertEqual(self._command(),
+                         'sudo kill -USR2 $(cat /var/run/haproxy.pid)')
+
+    def test_failed_reload(self):
+        self.stdout.channel.recv_exit_status.return_value = 1
+        self.assertFalse(self.remote_service.reload('service'))
+
+    def test_unknown_reload_mode(self):
+        self.assertRaises(ValueError, self.remote_service.reload, 'magic')
+
+
+class TestHaproxyDriverReload (unittest.TestCase):
+    def setUp(self):
+        self.driver = HaproxyDriver(conf, device_fake)
+
+    @mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteService')
+    def test_reload_by_default(self, mock_service):
+        mock_service.RELOAD_MODES = RemoteService.RELOAD_MODES
+        mock_service.return_value.reload.return_value = True
+        self.assertTrue(self.driver._reload_service())
+        mock_service.return_value.reload.assert_called_once_with('soft')
+        self.assertFalse(mock_service.return_value.restart.called)
+
+    @mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteService')
+    def test_restart_when_reload_fails(self, mock_service):
+        mock_service.RELOAD_MODES = RemoteService.RELOAD_MODES
+        mock_service.return_value.reload.return_value = False
+        mock_service.return_value.restart.return_value = True
+        self.assertTrue(self.driver._reload_service())
+        mock_service.return_value.restart.assert_called_once_with()
+
+    @mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteService')
+    def test_restart_mode(self, mock_service):
+        mock_service.RELOAD_MODES = RemoteService.RELOAD_MODES
+        self.driver.reload_mode = 'restart'
+        self.driver._reload_service()
+        self.assertFalse(mock_service.return_value.reload.called)
+        mock_service.return_value.restart.assert_called_once_with()
+
 
 class TestHaproxyDriverRemoteInterface (unittest.TestCase):
     def setUp(self):
@@ -158,7 +423,350 @@ class TestHaproxyDriverRemoteSocketOperation (unittest.TestCase):
         self.assertTrue(self.remote_socket.get_statistics())
 
 
-@unittest.skip()
+class TestHaproxyDriverRemoteSocketBatch (unittest.TestCase):
+    def setUp(self):
+        self.batch = RemoteSocketBatch(device_fake, '/tmp/haproxy.sock')
+        self.batch.ssh = Mock()
+        self.stdout = Mock()
+        self.batch.ssh.exec_command.return_value = [Mock(), self.stdout,
+                                                    Mock()]
+
+    def test_semicolon_batch(self):
+        self.stdout.read.return_value = ('\n# pxname,svname\n'
+                                         'SFname,node1\n\n\n')
+        self.batch.disable_server('SFname', 'node1')
+        self.batch.show_stat()
+        self.batch.set_weight('SFname', 'node1', 10)
+        results = self.batch.execute()
+        self.assertEqual(results, ['', '# pxname,svname\nSFname,node1', ''])
+        command = self.batch.ssh.exec_command.call_args[0][0]
+        self.assertTrue('disable server SFname/node1;show stat;'
+                        'set weight SFname/node1 10' in command)
+        self.assertEqual(self.batch.ssh.exec_command.call_count, 1)
+        self.assertEqual(len(self.batch), 0)
+
+    def test_prompt_batch(self):
+        self.batch.mode = 'prompt'
+        self.stdout.read.return_value = ('\n> \n> No such server.\n\n> ')
+        self.batch.enable_server('SFname', 'node1')
+        self.batch.enable_server('SFname', 'node2')
+        results = self.batch.execute()
+        self.assertEqual(results, ['', 'No such server.'])
+        command = self.batch.ssh.exec_command.call_args[0][0]
+        self.assertTrue('prompt' in command)
+        self.assertTrue('quit' in command)
+
+    def test_empty_batch(self):
+        self.assertEqual(self.batch.execute(), [])
+        self.assertFalse(self.batch.ssh.exec_command.called)
+
+
+class TestHaproxyDriverSocketCommands (unittest.TestCase):
+    def setUp(self):
+        self.driver = HaproxyDriver(conf, device_fake)
+        self.driver.config_file = Mock()
+
+    @mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteSocketBatch')
+    def test_node_operations_share_one_batch(self, mock_batch):
+        self.driver.finalize_config = Mock()
+        with self.driver.request_context():
+            self.driver.suspend_real_server(server_farm, {'id': 'node1'})
+            self.driver.activate_real_server(server_farm, {'id': 'node2'})
+        batch = mock_batch.return_value
+        self.assertEqual(mock_batch.call_count, 1)
+        batch.disable_server.assert_called_once_with('SFname', 'node1')
+        batch.enable_server.assert_called_once_with('SFname', 'node2')
+        batch.execute.assert_called_once_with()
+
+    @mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteSocketBatch')
+    def test_get_statistics(self, mock_batch):
+        fields = ['SFname', 'node1'] + [str(i) for i in range(2, 40)]
+        mock_batch.return_value.execute.return_value = [
+                '# header\nSFname,node10,1\n%s' % ','.join(fields)]
+        statistics = self.driver.get_statistics(server_farm, {'id': 'node1'})
+        self.assertEqual(statistics['weight'], '18')
+        self.assertEqual(statistics['connCurrent'], '4')
+
+
+class TestHaproxyDriverRuntimeApi (unittest.TestCase):
+    def setUp(self):
+        device = dict(device_fake)
+        device['extra'] = dict(device_fake['extra'], runtime_api='True',
+                               server_slots=2)
+        self.driver = HaproxyDriver(conf, device)
+        self.driver._schedule_persist = Mock()
+        self.batch = MagicMock()
+        self.driver._new_socket_batch = Mock(return_value=self.batch)
+        self.driver.runtime_slots['SFname'] = {
+                'free': ['slot1', 'slot2'], 'used': {},
+                'lines': {'slot1': self.driver._free_slot_line('slot1'),
+                          'slot2': self.driver._free_slot_line('slot2')}}
+        self.driver._get_config = Mock()
+        self.driver.finalize_config = Mock()
+        self.node = {'id': 'node1', 'address': '10.0.0.1', 'port': '80',
+                     'weight': 3, 'extra': {}}
+
+    def test_add_rserver_uses_free_slot(self):
+        with self.driver.request_context():
+            self.driver.add_real_server_to_server_farm(server_farm,
+                                                       self.node)
+        self.assertFalse(self.driver._get_config.called)
+        self.batch.set_server_addr.assert_called_once_with('SFname', 'slot1',
+                                                           '10.0.0.1', '80')
+        self.batch.set_weight.assert_called_once_with('SFname', 'slot1', 3)
+        self.batch.set_server_state.assert_called_once_with('SFname',
+                                                            'slot1', 'ready')
+        self.batch.execute.assert_called_once_with()
+        line = self.driver.runtime_pending[('SFname', 'slot1')]
+        self.assertTrue(line.endswith('10.0.0.1:80 weight 3 maxconn 10000 '
+                                      'check # rserver node1'))
+        self.driver._schedule_persist.assert_called_once_with()
+
+    def test_rejected_socket_command_reloads_config(self):
+        self.batch.commands = ['set server SFname/slot1 addr 10.0.0.1 '
+                               'port 80', 'set weight SFname/slot1 3',
+                               'set server SFname/slot1 state ready']
+        self.batch.execute.return_value = ['', 'No such server.', '']
+        self.driver._load_config = Mock()
+        self.driver.deploy_queue.submit = Mock()
+        self.driver.deploy_queue.submit.return_value.wait.return_value = True
+        with self.driver.request_context():
+            self.driver.add_real_server_to_server_farm(server_farm,
+                                                       self.node)
+        self.driver.deploy_queue.submit.assert_called_once_with()
+        self.assertFalse(self.driver.config_was_deployed)
+        self.assertTrue(self.driver.config_needs_reload)
+        self.assertFalse(self.driver._schedule_persist.called)
+
+    def test_rejected_socket_command_and_failed_reload(self):
+        self.batch.commands = ['set server SFname/slot1 state ready']
+        self.batch.execute.return_value = ['No such server.']
+        self.driver._load_config = Mock()
+        self.driver.deploy_queue.submit = Mock()
+        self.driver.deploy_queue.submit.return_value.wait.return_value = False
+
+        def request():
+            with self.driver.request_context():
+                self.driver.add_real_server_to_server_farm(server_farm,
+                                                           self.node)
+
+        self.assertRaises(DeployFailed, request)
+
+    def test_failed_socket_session_releases_lock(self):
+        self.batch.execute.side_effect = IOError('ssh failed')
+
+        def request():
+            with self.driver.request_context():
+                self.driver.add_real_server_to_server_farm(server_farm,
+                                                           self.node)
+
+        self.assertRaises(IOError, request)
+        self.assertFalse(self.driver.lock.locked())
+        self.batch.execute.side_effect = None
+        self.batch.execute.return_value = []
+        with self.driver.request_context():
+            self.driver.suspend_real_server(server_farm, self.node)
+        self.assertFalse(self.driver.lock.locked())
+
+    def test_suspend_and_delete_rserver(self):
+        with self.driver.request_context():
+            self.driver.add_real_server_to_server_farm(server_farm,
+                                                       self.node)
+            self.driver.suspend_real_server(server_farm, self.node)
+        line = self.driver.runtime_pending[('SFname', 'slot1')]
+        self.assertTrue(line.endswith('check disabled # rserver node1'))
+        with self.driver.request_context():
+            self.driver.delete_real_server_from_server_farm(server_farm,
+                                                            self.node)
+        self.assertEqual(self.driver.runtime_pending[('SFname', 'slot1')],
+                         self.driver._free_slot_line('slot1'))
+        self.assertEqual(self.driver.runtime_slots['SFname']['free'],
+                         ['slot2', 'slot1'])
+        self.assertFalse(self.driver._get_config.called)
+
+    def test_failed_request_releases_slot(self):
+        try:
+            with self.driver.request_context():
+                self.driver.add_real_server_to_server_farm(server_farm,
+                                                           self.node)
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertFalse(self.batch.execute.called)
+        self.assertEqual(self.driver.runtime_pending, {})
+        self.assertEqual(self.driver.runtime_slots['SFname']['free'],
+                         ['slot1', 'slot2'])
+
+    def test_config_path_when_slots_exhausted(self):
+        self.driver.runtime_slots['SFname']['free'] = []
+        self.driver.add_real_server_to_server_farm(server_farm, self.node)
+        self.assertTrue(self.driver._get_config.called)
+
+    def test_add_rservers_fills_slots(self):
+        node2 = dict(self.node, id='node2', address='10.0.0.2')
+        with self.driver.request_context():
+            self.driver.add_real_servers_to_server_farm(server_farm,
+                                                        [self.node, node2])
+        self.assertFalse(self.driver._get_config.called)
+        self.assertEqual(self.driver.runtime_slots['SFname']['used'],
+                         {'node1': 'slot1', 'node2': 'slot2'})
+        self.batch.execute.assert_called_once_with()
+
+    def test_add_rservers_config_path_when_slots_short(self):
+        nodes = [dict(self.node, id='node%d' % i) for i in range(3)]
+        self.driver.add_real_servers_to_server_farm(server_farm, nodes)
+        self.assertEqual(self.driver._get_config.return_value.
+                         add_rserver_to_backend_block.call_count, 3)
+        self.assertEqual(self.driver.runtime_slots['SFname']['free'],
+                         ['slot1', 'slot2'])
+        self.assertFalse(self.batch.set_server_addr.called)
+
+    def test_get_statistics_of_slot(self):
+        self.driver.runtime_slots['SFname']['used']['node1'] = 'slot2'
+        fields = ['SFname', 'slot2'] + [str(i) for i in range(2, 40)]
+        self.batch.execute.return_value = [
+                '# header\nSFname,slot1,1\n%s' % ','.join(fields)]
+        statistics = self.driver.get_statistics(server_farm, self.node)
+        self.assertEqual(statistics['weight'], '18')
+        self.assertEqual(statistics['connCurrent'], '4')
+
+
+class TestHaproxyDriverDeployQueue (unittest.TestCase):
+    def setUp(self):
+        self.driver = HaproxyDriver(conf, device_fake)
+        self.config_file = MagicMock()
+        self.driver._load_config = Mock(side_effect=self._load_config)
+        self.deploy = Mock(return_value=True)
+        self.driver.deploy_queue.deploy = self.deploy
+        self.driver.deploy_queue.window = 0.01
+
+    def _load_config(self):
+        self.driver.config_file = self.config_file
+        return self.config_file
+
+    def _request(self, name, fail=False):
+        with self.driver.request_context():
+            self.driver.create_server_farm({'id': name}, [])
+            if fail:
+                raise RuntimeError()
+
+    def test_concurrent_requests_share_one_deploy(self):
+        threads = [eventlet.spawn(self._request, 'sf%d' % i)
+                   for i in range(5)]
+        for thread in threads:
+            thread.wait()
+        self.assertEqual(self.config_file.add_backend.call_count, 5)
+        self.assertEqual(self.deploy.call_count, 1)
+        self.assertEqual(self.driver.deploy_queue.deploys, 1)
+
+    def test_in_use_until_deployed(self):
+        self.assertFalse(self.driver.in_use())
+        thread = eventlet.spawn(self._request, 'sf1')
+        eventlet.sleep(0)
+        self.assertTrue(self.driver.in_use())
+        self.assertFalse(self.driver.lock.locked())
+        thread.wait()
+        self.assertFalse(self.driver.in_use())
+
+    def test_failed_deploy_is_reported(self):
+        self.deploy.return_value = False
+        self.assertRaises(DeployFailed, self._request, 'sf1')
+
+    def test_failed_request_keeps_pending_edits(self):
+        self.driver.config_file = self.config_file
+        self.driver.config_was_deployed = False
+        self.assertRaises(RuntimeError, self._request, 'sf1', True)
+        self.assertTrue(self.driver.config_file is
+                        self.config_file.copy.return_value)
+        self.assertFalse(self.driver.config_was_deployed)
+        self.assertFalse(self.deploy.called)
+
+
+class TestHaproxyDriverDeployDiff (unittest.TestCase):
+    def setUp(self):
+        self.testfiles = os.path.join(os.path.dirname(__file__), 'testfiles')
+        self.tmpdir = tempfile.mkdtemp()
+        device = dict(device_fake)
+        device['extra'] = dict(device_fake['extra'],
+                               local_conf_dir=self.tmpdir)
+        self.driver = HaproxyDriver(conf, device)
+        self.driver.localpath = self.tmpdir
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _fake_get_config(self):
+        # The local copy is what the last put_config uploaded
+        path = os.path.join(self.tmpdir, 'haproxy.cfg')
+        if not os.path.exists(path):
+            shutil.copy(os.path.join(self.testfiles, 'haproxy.cfg'), path)
+        return True
+
+    @mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteService')
+    @mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteConfig')
+    def test_unchanged_config_is_not_deployed(self, mock_remote,
+                                              mock_service):
+        mock_remote.return_value.get_config.side_effect = \
+                self._fake_get_config
+        self.driver._get_config()
+        self.assertTrue(self.driver._deploy_config())
+        self.assertFalse(mock_remote.return_value.put_config.called)
+        self.assertFalse(mock_service.called)
+        self.assertEqual(self.driver.deploy_counters,
+                         {'performed': 0, 'skipped': 1})
+
+    @mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteConfig')
+    def test_invalid_config_is_not_uploaded(self, mock_remote):
+        mock_remote.return_value.get_config.side_effect = \
+                self._fake_get_config
+        config_file = self.driver._get_config()
+        config_file.add_frontend(frontend, backend)
+        self.assertFalse(self.driver._deploy_config())
+        self.assertFalse(mock_remote.return_value.put_config.called)
+
+    @mock.patch('subprocess.Popen')
+    @mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteService')
+    @mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteConfig')
+    def test_local_haproxy_validation(self, mock_remote, mock_service,
+                                      mock_popen):
+        mock_remote.return_value.get_config.side_effect = \
+                self._fake_get_config
+        mock_service.RELOAD_MODES = RemoteService.RELOAD_MODES
+        mock_popen.return_value.communicate.return_value = ('', None)
+        mock_popen.return_value.returncode = 0
+        self.driver.local_validation = 'haproxy'
+        self.driver.create_server_farm(server_farm, predictor)
+        self.assertTrue(self.driver._deploy_config())
+        self.assertEqual(mock_popen.call_args[0][0][:3],
+                         ['haproxy', '-c', '-f'])
+        self.assertFalse(mock_remote.return_value.validate_config.called)
+        mock_remote.return_value.commit_config.assert_called_once_with()
+        mock_popen.return_value.returncode = 1
+        self.driver.create_server_farm({'id': 'other'}, predictor)
+        self.assertFalse(self.driver._deploy_config())
+        self.assertEqual(mock_remote.return_value.put_config.call_count, 1)
+
+    @mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteService')
+    @mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteConfig')
+    def test_changed_config_is_deployed(self, mock_remote, mock_service):
+        mock_remote.return_value.get_config.side_effect = \
+                self._fake_get_config
+        mock_service.RELOAD_MODES = RemoteService.RELOAD_MODES
+        self.driver.create_server_farm(server_farm, predictor)
+        self.assertTrue(self.driver._deploy_config())
+        self.assertEqual(mock_remote.return_value.put_config.call_count, 1)
+        self.assertEqual(mock_service.return_value.reload.call_count, 1)
+        self.assertEqual(self.driver.deploy_counters,
+                         {'performed': 1, 'skipped': 0})
+        # The same change again renders to the deployed config
+        self.driver.create_server_farm(server_farm, predictor)
+        self.assertTrue(self.driver._deploy_config())
+        self.assertEqual(mock_remote.return_value.put_config.call_count, 1)
+        self.assertEqual(self.driver.deploy_counters,
+                         {'performed': 1, 'skipped': 1})
+
+
+@unittest.skip("requires a live HAProxy device")
 class TestHaproxyDeriverAllFunctions (unittest.TestCase):
     def setUp(self):
         self.remote_socket = RemoteSocketOperation(device_fake,
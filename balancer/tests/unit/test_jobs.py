@@ -0,0 +1,139 @@
+import mock
+import os
+import unittest
+
+import eventlet
+
+from balancer.core import jobs
+from balancer import exception
+
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.conf = mock.Mock()
+
+    @mock.patch("balancer.core.jobs.run_job")
+    def test_runs_queued_jobs(self, mock_run_job):
+        pool = jobs.WorkerPool(self.conf, 2, 10)
+        pool.put('job1')
+        pool.put('job2')
+        eventlet.sleep(0)
+        for worker in pool.workers:
+            worker.kill()
+        self.assertEqual(mock_run_job.call_args_list,
+                         [mock.call(self.conf, 'job1'),
+                          mock.call(self.conf, 'job2')])
+
+    @mock.patch("balancer.core.jobs.run_job")
+    def test_worker_survives_failed_job(self, mock_run_job):
+        mock_run_job.side_effect = Exception('database is down')
+        pool = jobs.WorkerPool(self.conf, 1, 10)
+        pool.put('job1')
+        pool.put('job2')
+        eventlet.sleep(0)
+        dead = pool.workers[0].dead
+        pool.workers[0].kill()
+        self.assertFalse(dead)
+        self.assertEqual(mock_run_job.call_args_list,
+                         [mock.call(self.conf, 'job1'),
+                          mock.call(self.conf, 'job2')])
+
+    @mock.patch("balancer.core.jobs.run_job")
+    def test_queue_full(self, mock_run_job):
+        pool = jobs.WorkerPool(self.conf, 0, 1)
+        pool.put('job1')
+        self.assertRaises(exception.JobQueueFull, pool.put, 'job2')
+
+
+class TestJobs(unittest.TestCase):
+    def setUp(self):
+        self.conf = mock.Mock()
+        self.func = mock.Mock()
+        jobs.handler('test_action')(self.func)
+        self.job = {'id': 'job1', 'action': 'test_action', 'lb_id': 'lb1',
+                    'device_type': 'HAPROXY', 'params': {'foo': 'bar'}}
+
+    def tearDown(self):
+        jobs.HANDLERS.pop('test_action')
+
+    @mock.patch("balancer.core.jobs.get_pool")
+    @mock.patch("balancer.db.api.job_create")
+    def test_submit(self, mock_create, mock_get_pool):
+        mock_create.return_value = self.job
+        resp = jobs.submit(self.conf, 'test_action', 'lb1', 'HAPROXY',
+                           {'foo': 'bar'})
+        self.assertEqual(resp, self.job)
+        mock_create.assert_called_once_with(self.conf,
+            {'action': 'test_action', 'lb_id': 'lb1',
+             'device_type': 'HAPROXY', 'status': 'QUEUED',
+             'params': {'foo': 'bar'}})
+        mock_get_pool.assert_called_once_with(self.conf, 'HAPROXY')
+        mock_get_pool.return_value.put.assert_called_once_with('job1')
+
+    @mock.patch("balancer.db.api.job_update")
+    @mock.patch("balancer.core.jobs.get_pool")
+    @mock.patch("balancer.db.api.job_create")
+    def test_submit_queue_full(self, mock_create, mock_get_pool,
+                               mock_update):
+        mock_create.return_value = self.job
+        mock_get_pool.return_value.put.side_effect = exception.JobQueueFull
+        self.assertRaises(exception.JobQueueFull, jobs.submit, self.conf,
+                          'test_action', 'lb1', 'HAPROXY')
+        mock_update.assert_called_once_with(self.conf, 'job1',
+            {'status': 'ERROR', 'message': 'Job queue is full'})
+
+    @mock.patch("balancer.db.api.job_update")
+    @mock.patch("balancer.db.api.job_get")
+    def test_run_job_0(self, mock_get, mock_update):
+        """No exception"""
+        mock_get.return_value = self.job
+        jobs.run_job(self.conf, 'job1')
+        self.func.assert_called_once_with(self.conf, 'lb1', {'foo': 'bar'})
+        self.assertEqual(mock_update.call_args_list,
+                         [mock.call(self.conf, 'job1', {'status': 'RUNNING'}),
+                          mock.call(self.conf, 'job1', {'status': 'DONE'})])
+
+    @mock.patch("balancer.db.api.job_update")
+    @mock.patch("balancer.db.api.job_get")
+    def test_run_job_1(self, mock_get, mock_update):
+        """Exception"""
+        mock_get.return_value = self.job
+        self.func.side_effect = Exception('device is down')
+        jobs.run_job(self.conf, 'job1')
+        mock_update.assert_called_with(self.conf, 'job1',
+            {'status': 'ERROR', 'message': 'device is down'})
+
+    @mock.patch("balancer.core.jobs.WorkerPool")
+    def test_get_pool_after_fork(self, mock_pool):
+        mock_pool.side_effect = lambda *args: mock.Mock()
+        pool = jobs.get_pool(self.conf, 'HAPROXY')
+        self.assertIs(jobs.get_pool(self.conf, 'HAPROXY'), pool)
+        with mock.patch('os.getpid') as mock_getpid:
+            mock_getpid.return_value = os.getpid() + 1
+            self.assertIsNot(jobs.get_pool(self.conf, 'HAPROXY'), pool)
+        jobs.POOLS.clear()
+        jobs.POOLS_PID = None
+
+    @mock.patch("balancer.core.jobs.get_pool")
+    @mock.patch("balancer.db.api.job_claim")
+    @mock.patch("balancer.db.api.job_get_all_unfinished")
+    def test_recover(self, mock_get_all, mock_claim, mock_get_pool):
+        mock_get_all.return_value = [self.job]
+        mock_claim.return_value = True
+        jobs.recover(self.conf, 'started_at')
+        mock_get_all.assert_called_once_with(self.conf,
+                                             updated_before='started_at')
+        mock_claim.assert_called_once_with(self.conf, self.job)
+        mock_get_pool.assert_called_once_with(self.conf, 'HAPROXY')
+        mock_get_pool.return_value.put.assert_called_once_with('job1')
+
+    @mock.patch("balancer.core.jobs.get_pool")
+    @mock.patch("balancer.db.api.job_claim")
+    @mock.patch("balancer.db.api.job_get_all_unfinished")
+    def test_recover_claimed_job(self, mock_get_all, mock_claim,
+                                 mock_get_pool):
+        """Another process recovered the job first"""
+        mock_get_all.return_value = [self.job]
+        mock_claim.return_value = False
+        jobs.recover(self.conf)
+        self.assertFalse(mock_get_pool.called)
@@ -22,8 +22,10 @@ class TestScheduler(unittest.TestCase):
                  ['%s.fake_filter' % __name__],
                  'device_cost_functions':
                  ['%s.fake_cost' % __name__],
-                 'device_cost_fake_cost_weight': 1.}
+                 'device_cost_fake_cost_weight': 1.,
+                 'scheduler_cache_ttl': 300}
         self.conf.configure_mock(**self.attrs)
+        scheduler.invalidate()
 
     @mock.patch('balancer.db.api.device_get_all')
     def test_scheduler_no_proper_devs(self, dev_get_all):
@@ -65,6 +67,7 @@ class TestFilterCapabilities(unittest.TestCase):
         self.conf.device_filter_capabilities = ['algorithm']
         self.lb_ref = {'id': 5}
         self.dev_ref = {'id': 1}
+        scheduler.invalidate()
 
     @mock.patch("balancer.drivers.get_device_driver", autospec=True)
     def test_proper(self, mock_getdev):
@@ -122,9 +125,33 @@ class TestWeigthsFunctions(unittest.TestCase):
         self.lb_ref = {}
         self.dev_ref = {}
 
-    @mock.patch('balancer.db.api.lb_count_active_by_device')
+        scheduler.invalidate()
+
+    @mock.patch('balancer.db.api.lb_count_active_by_devices')
     def test_lbs_on(self, lb_count):
-        lb_count.return_value = 3
+        lb_count.return_value = {'1': 3}
         self.dev_ref['id'] = '1'
         res = scheduler.lbs_on(self.conf, self.lb_ref, self.dev_ref)
         self.assertEqual(res, 3)
+        self.dev_ref['id'] = '2'
+        res = scheduler.lbs_on(self.conf, self.lb_ref, self.dev_ref)
+        self.assertEqual(res, 0)
+        lb_count.assert_called_once_with(self.conf)
+
+    @mock.patch('balancer.db.api.lb_count_active_by_devices')
+    def test_lb_status_changed(self, lb_count):
+        lb_count.return_value = {'1': 3}
+        self.dev_ref['id'] = '1'
+        scheduler.lbs_on(self.conf, self.lb_ref, self.dev_ref)
+        scheduler.lb_status_changed('1', 'BUILD', 'ACTIVE')
+        scheduler.lb_status_changed('2', 'BUILD', 'ACTIVE')
+        self.assertEqual(scheduler.lbs_on(self.conf, self.lb_ref,
+                                          self.dev_ref), 4)
+        scheduler.lb_status_changed('1', 'ACTIVE', None)
+        scheduler.lb_status_changed('1', 'ACTIVE', 'ERROR')
+        scheduler.lb_status_changed('1', 'ERROR', 'ERROR')
+        self.assertEqual(scheduler.lbs_on(self.conf, self.lb_ref,
+                                          self.dev_ref), 2)
+        self.assertEqual(scheduler.lbs_on(self.conf, self.lb_ref,
+                                          {'id': '2'}), 1)
+        self.assertEqual(lb_count.call_count, 1)
@@ -1,10 +1,14 @@
 # vim: tabstop=4 shiftwidth=4 softtabstop=4
 
 import unittest
+import json
+import mock
 import requests
 import logging
 
+from balancer.core import commands
 from balancer.drivers.riverbed_stingray.StingrayDriver import StingrayDriver
+from balancer.drivers.riverbed_stingray.StingrayDriver import ObjectConflict
 from requests.exceptions import HTTPError
 
 ''' Missing fields in test values may be due to lack of implmementation
@@ -411,3 +415,170 @@ class StingrayDriverTestCase(unittest.TestCase):
         self.rest_assert_field_is(target, 'type', 'sardine')
 
         self.driver.delete_stickiness(sticky_cookie)
+
+
+class TestStingraySession(unittest.TestCase):
+    def setUp(self):
+        self.driver = StingrayDriver(conf, device)
+        self.request = mock.Mock()
+        self.request.return_value.text = '{}'
+        self.driver.session.request = self.request
+
+    def test_session_settings(self):
+        session = self.driver.session
+        adapter = session.get_adapter(self.driver.url)
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertEqual(adapter.max_retries.total, 3)
+        self.assertTrue(adapter.max_retries.is_retry('PUT', 503))
+        self.assertFalse(adapter.max_retries.is_retry('POST', 503))
+        self.assertFalse(session.verify)
+        self.assertIs(session.auth, self.driver.basic_auth)
+        self.assertEqual(session.headers['Content-Type'], 'application/json')
+
+    def test_session_settings_from_extra(self):
+        device_tuned = dict(device, extra={'pool_size': '8',
+                                           'max_retries': '0',
+                                           'connect_timeout': '1',
+                                           'read_timeout': '5'})
+        driver = StingrayDriver(conf, device_tuned)
+        adapter = driver.session.get_adapter(driver.url)
+        self.assertEqual(adapter._pool_maxsize, 8)
+        self.assertEqual(adapter.max_retries.total, 0)
+        self.assertEqual(driver.timeout, (1., 5.))
+
+    def test_send_request_reuses_session(self):
+        self.driver.send_request('pools/1/', 'PUT', {'properties': {}})
+        self.driver.send_request('pools/1/', 'GET')
+        self.assertEqual(self.request.call_args_list, [
+            mock.call('PUT', self.driver.url + 'pools/1/',
+                      data='{"properties": {}}', headers=None,
+                      timeout=(10., 60.)),
+            mock.call('GET', self.driver.url + 'pools/1/',
+                      data=None, headers=None, timeout=(10., 60.)),
+        ])
+        self.assertEqual(
+            self.request.return_value.raise_for_status.call_count, 2)
+
+    def test_send_request_error(self):
+        self.request.return_value.raise_for_status.side_effect = HTTPError()
+        self.assertRaises(HTTPError, self.driver.send_request, 'pools/1/',
+                          'DELETE')
+
+
+class TestStingrayObjectCache(unittest.TestCase):
+    def setUp(self):
+        self.driver = StingrayDriver(conf, device)
+        self.objects = {
+            'pools/server_farm_1_id/': {'nodes': '10.0.0.1:80',
+                                        'priority!values': '10.0.0.1:80:1',
+                                        'monitors': 'Ping'},
+            'flipper/server_farm_1_id/': {'ipaddresses': vip['address']},
+        }
+        self.requests = []
+        self.put_status = 200
+        self.driver.session.request = self.request
+
+    def request(self, method, url, data=None, headers=None, timeout=None):
+        target = url[len(self.driver.url):]
+        self.requests.append((method, target))
+        response = mock.Mock(headers={'ETag': 'etag-' + target},
+                             status_code=200)
+        if method == 'GET':
+            if target not in self.objects:
+                response.status_code = 404
+            response.text = json.dumps(
+                    {'properties': self.objects.get(target, {})})
+        else:
+            response.text = ''
+            if method == 'PUT':
+                self.put = (target, json.loads(data), headers)
+                response.status_code = self.put_status
+        if response.status_code >= 400:
+            response.raise_for_status.side_effect = HTTPError(
+                    response=response)
+        return response
+
+    def test_add_real_servers_one_get_one_put(self):
+        with self.driver.request_context():
+            self.driver.add_real_server_to_server_farm(serverfarm, rserver)
+            self.driver.add_real_server_to_server_farm(serverfarm,
+                                                       rserver_weighted)
+            self.driver.add_probe_to_server_farm(serverfarm, probe_http)
+            self.assertEqual(self.requests,
+                             [('GET', 'pools/server_farm_1_id/')])
+        self.assertEqual(self.requests, [('GET', 'pools/server_farm_1_id/'),
+                                         ('PUT', 'pools/server_farm_1_id/')])
+        target, payload, headers = self.put
+        self.assertEqual(headers, {'If-Match':
+                                   'etag-pools/server_farm_1_id/'})
+        properties = payload['properties']
+        self.assertEqual(properties['nodes'],
+                         '10.0.0.1:80 10.62.166.28:8080 10.62.166.28:8080')
+        self.assertEqual(properties['monitors'], 'Ping ' + probe_http['id'])
+        self.assertEqual(len(properties['priority!values'].split()), 3)
+        self.assertIsNone(self.driver.objects)
+
+    def test_failed_context_discards_edits(self):
+        def fail():
+            with self.driver.request_context():
+                self.driver.add_real_server_to_server_farm(serverfarm,
+                                                           rserver)
+                raise RuntimeError()
+
+        self.assertRaises(RuntimeError, fail)
+        self.assertEqual(self.requests, [('GET', 'pools/server_farm_1_id/')])
+        self.assertFalse(self.driver.lock.locked())
+
+    def test_conflict(self):
+        self.put_status = 412
+
+        def request():
+            with self.driver.request_context():
+                self.driver.suspend_real_server(serverfarm, rserver)
+
+        self.assertRaises(ObjectConflict, request)
+        self.assertFalse(self.driver.lock.locked())
+
+    def test_conflict_rolls_back_commands(self):
+        self.put_status = 412
+        rollback = mock.Mock()
+
+        def request():
+            with self.driver.request_context() as ctx:
+                ctx.add_rollback(rollback)
+                self.driver.suspend_real_server(serverfarm, rserver)
+
+        self.assertRaises(ObjectConflict, request)
+        rollback.assert_called_once_with(False)
+        self.assertIsNone(self.driver.objects)
+
+    def test_rollback_edits_are_sent(self):
+        def fail():
+            with self.driver.request_context() as ctx:
+                commands.add_rserver_to_server_farm(ctx, serverfarm,
+                                                    rserver)
+                raise RuntimeError()
+
+        self.assertRaises(RuntimeError, fail)
+        self.assertEqual(self.requests, [('GET', 'pools/server_farm_1_id/'),
+                                         ('GET', 'pools/server_farm_1_id/'),
+                                         ('PUT', 'pools/server_farm_1_id/'),
+                                         ('GET', 'pools/server_farm_1_id/'),
+                                         ('PUT', 'pools/server_farm_1_id/')])
+        self.assertIsNone(self.driver.objects)
+        self.assertFalse(self.driver.lock.locked())
+
+    def test_deleted_object_is_not_flushed(self):
+        with self.driver.request_context():
+            self.driver.delete_virtual_ip(vip)
+        self.assertEqual(self.requests, [
+            ('GET', 'flipper/server_farm_1_id/'),
+            ('DELETE', 'flipper/server_farm_1_id/'),
+            ('PUT', 'vservers/server_farm_1_id/'),
+        ])
+
+    def test_without_context(self):
+        self.driver.delete_probe_from_server_farm(serverfarm, {'id': 'Ping'})
+        self.assertEqual(self.requests, [('GET', 'pools/server_farm_1_id/'),
+                                         ('PUT', 'pools/server_farm_1_id/')])
+        self.assertEqual(self.put[1], {'properties': {'monitors': ''}})
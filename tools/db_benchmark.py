@@ -0,0 +1,202 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measures the hot database lookups with and without the lookup indexes.
+
+The database is filled with synthetic load balancers and measured with the
+lookup indexes dropped, then measured again once they are recreated. For every
+lookup the query plan and the median latency are printed.
+
+    python tools/db_benchmark.py --lbs 100000 --servers 10
+"""
+
+import datetime
+import importlib
+import optparse
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy import event
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+from balancer.common import cfg
+from balancer.db import api as db_api
+from balancer.db import models
+from balancer.db import session
+
+# The current schema is kept, only the lookup indexes are dropped
+lookup_indexes = importlib.import_module(
+        'balancer.db.migrate_repo.versions.003_Add_lookup_indexes')
+CHUNK = 10000
+
+
+def make_conf(connection):
+    conf = cfg.ConfigOpts()
+    conf(args=[])
+    session.register_conf_opts(conf)
+    conf.set_override('connection', connection, group='sql')
+    return conf
+
+
+def populate(conf, lbs, servers_per_lb, devices, tenants):
+    engine = session.get_engine(conf)
+    now = datetime.datetime.utcnow()
+    engine.execute(models.Device.__table__.insert(),
+                   [{'id': 'dev%d' % i, 'name': 'dev%d' % i,
+                     'type': 'HAPROXY', 'extra': '{}'}
+                    for i in range(devices)])
+    for start in range(0, lbs, CHUNK):
+        ids = range(start, min(start + CHUNK, lbs))
+        engine.execute(models.LoadBalancer.__table__.insert(),
+            [{'id': 'lb%d' % i, 'device_id': 'dev%d' % (i % devices),
+              'name': 'lb%d' % i, 'status': ('ACTIVE', 'ERROR')[i % 10 == 0],
+              'tenant_id': 'tenant%d' % (i % tenants),
+              'created_at': now, 'updated_at': now, 'extra': '{}'}
+             for i in ids])
+        engine.execute(models.ServerFarm.__table__.insert(),
+            [{'id': 'sf%d' % i, 'lb_id': 'lb%d' % i, 'extra': '{}'}
+             for i in ids])
+        for table in (models.Probe, models.Sticky, models.Predictor):
+            engine.execute(table.__table__.insert(),
+                [{'id': '%s%d' % (table.__tablename__, i),
+                  'sf_id': 'sf%d' % i, 'extra': '{}'} for i in ids])
+        engine.execute(models.VirtualServer.__table__.insert(),
+            [{'id': 'vip%d' % i, 'sf_id': 'sf%d' % i, 'lb_id': 'lb%d' % i,
+              'address': '10.%d.%d.%d' % (i >> 16, (i >> 8) & 255, i & 255),
+              'extra': '{}'} for i in ids])
+        engine.execute(models.Server.__table__.insert(),
+            [{'id': 'rs%d-%d' % (i, j), 'sf_id': 'sf%d' % i,
+              'address': '172.%d.%d.%d' % (i >> 12, (i >> 4) & 255,
+                                           ((i & 15) << 4) + j),
+              'parent_id': i * servers_per_lb + j, 'deployed': 'True',
+              'extra': '{}'}
+             for i in ids for j in range(servers_per_lb)])
+        sys.stderr.write('.')
+    sys.stderr.write('\n')
+
+
+def lookups(conf, lbs):
+    i = lbs / 2
+    sf_id = 'sf%d' % i
+    return (
+        ('loadbalancer_get_all_by_project',
+            db_api.loadbalancer_get_all_by_project, ('tenant7',)),
+        ('lb_count_active_by_device',
+            db_api.lb_count_active_by_device, ('dev3',)),
+        ('serverfarm_get_all_by_lb_id',
+            db_api.serverfarm_get_all_by_lb_id, ('lb%d' % i,)),
+        ('server_get_all_by_sf_id', db_api.server_get_all_by_sf_id,
+            (sf_id,)),
+        ('server_get_all_by_parent_id',
+            db_api.server_get_all_by_parent_id, (i * 10,)),
+        ('server_get_by_address', db_api.server_get_by_address,
+            ('172.%d.%d.%d' % (i >> 12, (i >> 4) & 255, (i & 15) << 4),)),
+        ('virtualserver_get_all_by_sf_id',
+            db_api.virtualserver_get_all_by_sf_id, (sf_id,)),
+        ('probe_get_all_by_sf_id', db_api.probe_get_all_by_sf_id,
+            (sf_id,)),
+        ('sticky_get_all_by_sf_id', db_api.sticky_get_all_by_sf_id,
+            (sf_id,)),
+        ('predictor_get_all_by_sf_id', db_api.predictor_get_all_by_sf_id,
+            (sf_id,)),
+    )
+
+
+def query_plan(engine, statement, parameters):
+    if engine.dialect.name == 'sqlite':
+        rows = engine.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        return '; '.join(list(row)[-1] for row in rows)
+    rows = engine.execute('EXPLAIN ' + statement, parameters)
+    return '; '.join(str(tuple(row)) for row in rows)
+
+
+def record_statements(conf):
+    engine = session.get_engine(conf)
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, *args):
+        statements.append((statement, parameters))
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    return statements
+
+
+def measure(conf, lbs, repeat, statements):
+    engine = session.get_engine(conf)
+    results = []
+    for name, func, args in lookups(conf, lbs):
+        timings = []
+        for _i in range(repeat):
+            del statements[:]
+            start = time.time()
+            func(conf, *args)
+            timings.append(time.time() - start)
+        timings.sort()
+        statement, parameters = statements[-1]
+        results.append((name, timings[len(timings) / 2] * 1000,
+                        query_plan(engine, statement, parameters)))
+    return results
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--lbs', type='int', default=100000)
+    parser.add_option('--servers', type='int', default=10,
+                      help='servers per load balancer')
+    parser.add_option('--devices', type='int', default=10)
+    parser.add_option('--tenants', type='int', default=1000)
+    parser.add_option('--repeat', type='int', default=5)
+    parser.add_option('--connection',
+                      help='database URL, a temporary sqlite file by default')
+    options, _args = parser.parse_args()
+
+    filename = None
+    connection = options.connection
+    if connection is None:
+        _fd, filename = tempfile.mkstemp(suffix='.sqlite')
+        connection = 'sqlite:///%s' % filename
+    conf = make_conf(connection)
+    try:
+        session.sync(conf)
+        engine = session.get_engine(conf)
+        lookup_indexes.downgrade(engine)
+        populate(conf, options.lbs, options.servers, options.devices,
+                 options.tenants)
+        statements = record_statements(conf)
+        before = measure(conf, options.lbs, options.repeat, statements)
+        lookup_indexes.upgrade(engine)
+        after = measure(conf, options.lbs, options.repeat, statements)
+    finally:
+        if filename is not None:
+            os.remove(filename)
+
+    print '%d load balancers, %d servers' % (options.lbs,
+                                             options.lbs * options.servers)
+    for (name, before_ms, before_plan), (_, after_ms, after_plan) in \
+            zip(before, after):
+        print
+        print '%s: %.2f ms -> %.2f ms' % (name, before_ms, after_ms)
+        print '  before: %s' % before_plan
+        print '  after:  %s' % after_plan
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measures how long the models take to serialize into API dicts.
+
+Unsaved servers are unpacked with db_api.unpack_extra the way listings do,
+the total and per-row times are printed.
+
+    python tools/serialization_benchmark.py --rows 1000 --repeat 100
+"""
+
+import optparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+from balancer.db import api as db_api
+from balancer.db import models
+
+
+def make_servers(rows):
+    servers = []
+    for i in range(rows):
+        server = models.Server()
+        server.update({'sf_id': 'sf1',
+                       'name': 'server%d' % i,
+                       'type': 'host',
+                       'address': '10.0.%d.%d' % (i >> 8, i & 255),
+                       'port': '80',
+                       'weight': 2,
+                       'status': 'ACTIVE',
+                       'parent_id': 0,
+                       'deployed': 'True',
+                       'vm_id': i,
+                       'extra': {'maxCon': 400000,
+                                 'minCon': 10}})
+        servers.append(server)
+    return servers
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--rows', type='int', default=1000)
+    parser.add_option('--repeat', type='int', default=100)
+    options, _args = parser.parse_args()
+
+    servers = make_servers(options.rows)
+    start = time.time()
+    for _i in range(options.repeat):
+        for server in servers:
+            db_api.unpack_extra(server)
+    elapsed = time.time() - start
+
+    total = options.rows * options.repeat
+    print '%d rows: %.2f s, %.2f us per row' % (total, elapsed,
+                                                elapsed * 1000000 / total)
+
+
+if __name__ == '__main__':
+    main()